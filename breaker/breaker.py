@@ -6,14 +6,39 @@ Date: 15/06/2025
 """
 
 import socket
-import struct
 import json
 import threading
+import time
+import os
 from flask import Flask, jsonify, request
+import prp
+from goose_sub import GooseSubscriber
+from frame_filter import FrameFilter, goose_id, sources_from_env
 
 MCAST = '224.1.1.1'
 PORT = 10200
 
+# Position push channel: published on every change and as a 1 s heartbeat
+POS_MCAST = '224.1.1.2'
+POS_PORT = 10202
+POS_HEARTBEAT = 1.0
+pos_changed = threading.Event()
+
+# PRP duplicate discard for the GOOSE subscription
+goose_prp = prp.DuplicateDiscard()
+
+# Early drop ahead of the JSON decode: only GOOSE1, only from
+# GOOSE_SOURCES when set, and no more than GOOSE_RATE frames a second
+# from any one source, so a flood cannot starve the real publishers
+goose_filter = FrameFilter("goose", ["GOOSE1"], goose_id, sources_from_env(os.getenv("GOOSE_SOURCES", "")),
+                           max_len=1024, rate=float(os.getenv("GOOSE_RATE", "200")),
+                           burst=int(os.getenv("GOOSE_BURST", "50")))
+
+# stNum and sqNum of every GOOSE publisher, with the same state rules as
+# the IEDs: retransmissions, heartbeats and out of sequence frames are
+# not acted on
+goose_sub = GooseSubscriber(["GOOSE1"], None)
+
 state = "CLOSED"
 fault_simulation = False
 
@@ -23,6 +48,18 @@ app = Flask(__name__)
 def get_status():
     return jsonify({"state": state})
 
+@app.route('/prp')
+def get_prp_status():
+    return jsonify({"goose": goose_prp.counters()})
+
+@app.route('/goose')
+def get_goose_status():
+    return jsonify({"subscribed": goose_sub.counters()})
+
+@app.route('/filters')
+def get_filter_status():
+    return jsonify({"goose": goose_filter.counters()})
+
 def update_state(cmd):
     global state
     if fault_simulation:
@@ -37,20 +74,44 @@ def update_state(cmd):
     elif cmd == "RESET":
         state = "CLOSED"
     print(f"State updated to: {state}")
+    pos_changed.set()
+
+def publish_position():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    print(f"Publishing position on {POS_MCAST}:{POS_PORT}")
+
+    seq = 0
+    while True:
+        msg = {
+            "ln": "XCBR1",
+            "do": "Pos",
+            "stVal": state,
+            "seq": seq,
+            "timestamp": time.time()
+        }
+        s.sendto(json.dumps(msg).encode(), (POS_MCAST, POS_PORT))
+        seq += 1
+        pos_changed.wait(POS_HEARTBEAT)
+        pos_changed.clear()
 
 def listener():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s.bind(('', PORT))
-    mreq = struct.pack("4sl", socket.inet_aton(MCAST), socket.INADDR_ANY)
-    s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    prp.join_groups(s, MCAST)
     print(f"Listening on {MCAST}:{PORT}")
 
     while True:
-        data, _ = s.recvfrom(1024)
+        data, src = s.recvfrom(1024)
+        if not goose_filter.accept(data, src):
+            continue
+        data = goose_prp.accept(data, src)
+        if data is None:
+            continue
         try:
             msg = json.loads(data.decode())
-            if msg.get("goID") == "GOOSE1":
+            if goose_sub.receive(msg, src):
                 update_state(msg.get("status"))
         except Exception as e:
             print("Invalid message:", e)
@@ -68,4 +129,5 @@ def get_fault_mode():
 
 if __name__ == "__main__":
     threading.Thread(target=listener, daemon=True).start()
+    threading.Thread(target=publish_position, daemon=True).start()
     app.run(host="0.0.0.0", port=5002, threaded=True, use_reloader=False)
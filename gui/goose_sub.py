@@ -0,0 +1,145 @@
+"""
+GOOSE Subscriber
+
+Author: Zein Ali
+Date: 04/08/2025
+
+Keeps the (stNum, sqNum) of every GOOSE publisher, keyed by sender
+address and goID, so the IED acts once per state change rather than on
+every retransmission, heartbeat or flood frame. Per frame:
+
+    same stNum, higher sqNum     retransmission or heartbeat; refreshes TAL
+    same stNum, sqNum not higher duplicate or replay; ignored
+    stNum one step on (or a few) new state; returned to the caller
+    sqNum 0                      new state (also after a publisher restart)
+    anything else                out of sequence; ignored
+
+A publisher first heard mid-state (sqNum above 0) is only learned: its
+state was set before this IED was listening. Each frame's
+timeAllowedtoLive sets when the next must arrive. A timer on the event
+loop, moved on by every frame that refreshes it, marks a publisher that
+has gone quiet for longer. Subscribers without an event loop (the
+breaker, GUI and IDS) pass loop=None and get the same state rules
+without the timeAllowedtoLive supervision.
+
+The same file is copied into each subscriber's directory, so keep the
+copies identical.
+"""
+
+
+# How far stNum may move on from the last state and still be taken as a
+# new one, allowing for state changes lost in between
+max_st_step = 4
+
+COUNTER_MAX = 2 ** 32 - 1
+
+
+class PublisherState:
+    """What is known of one publisher's control block"""
+
+    __slots__ = ("st_num", "sq_num", "status", "timer", "alive",
+                 "frames", "changes", "repeats", "stale", "out_of_sequence", "expiries")
+
+    def __init__(self, st_num, sq_num, status):
+        self.st_num = st_num
+        self.sq_num = sq_num
+        self.status = status
+        self.timer = None
+        self.alive = True
+        self.frames = 1
+        self.changes = 0
+        self.repeats = 0
+        self.stale = 0
+        self.out_of_sequence = 0
+        self.expiries = 0
+
+    def as_dict(self):
+        return {
+            "stNum": self.st_num,
+            "sqNum": self.sq_num,
+            "status": self.status,
+            "alive": self.alive,
+            "frames": self.frames,
+            "changes": self.changes,
+            "repeats": self.repeats,
+            "stale": self.stale,
+            "outOfSequence": self.out_of_sequence,
+            "expiries": self.expiries
+        }
+
+
+class GooseSubscriber:
+    def __init__(self, go_ids, loop, on_expire=None):
+        self.go_ids = set(go_ids)
+        self.loop = loop
+        self.on_expire = on_expire
+        self.publishers = {}
+        self.other = 0
+        self.malformed = 0
+
+    def receive(self, msg, src):
+        """Take one decoded frame; returns it if it starts a new state"""
+        go_id = msg.get("goID")
+        if go_id not in self.go_ids:
+            self.other += 1
+            return None
+        st_num, sq_num = msg.get("stNum"), msg.get("sqNum")
+        if not isinstance(st_num, int) or not isinstance(sq_num, int):
+            self.malformed += 1
+            return None
+
+        key = (src[0], go_id)
+        pub = self.publishers.get(key)
+        if pub is None:
+            pub = self.publishers[key] = PublisherState(st_num, sq_num, msg.get("status"))
+            self.refresh(key, pub, msg)
+            if sq_num != 0:
+                return None
+            pub.changes += 1
+            return msg
+
+        pub.frames += 1
+        if st_num == pub.st_num:
+            if sq_num > pub.sq_num:
+                pub.repeats += 1
+                pub.sq_num = sq_num
+                self.refresh(key, pub, msg)
+            else:
+                pub.stale += 1
+            return None
+
+        step = (st_num - pub.st_num) % COUNTER_MAX
+        if sq_num != 0 and not 0 < step <= max_st_step:
+            pub.out_of_sequence += 1
+            return None
+
+        pub.st_num, pub.sq_num = st_num, sq_num
+        pub.status = msg.get("status")
+        pub.changes += 1
+        self.refresh(key, pub, msg)
+        return msg
+
+    def refresh(self, key, pub, msg):
+        pub.alive = True
+        if self.loop is None:
+            return
+        if pub.timer is not None:
+            self.loop.cancel(pub.timer)
+            pub.timer = None
+        tal = msg.get("timeAllowedtoLive")
+        if isinstance(tal, (int, float)) and tal > 0:
+            pub.timer = self.loop.call_later(tal / 1000, "goose_tal", self.expire, key, pub)
+
+    def expire(self, key, pub):
+        pub.timer = None
+        pub.alive = False
+        pub.expiries += 1
+        if self.on_expire:
+            self.on_expire(key, pub)
+
+    def counters(self):
+        return {
+            "publishers": {f"{ip}/{go_id}": pub.as_dict() for (ip, go_id), pub in self.publishers.items()},
+            "other": self.other,
+            "malformed": self.malformed
+        }
@@ -10,13 +10,15 @@ from flask import Flask, render_template, request, jsonify
 import requests
 import threading
 import socket
-import struct
 import json
 import time
 import threading
 from datetime import datetime
 import os
 from flask import Response, stream_with_context
+import prp
+from goose_sub import GooseSubscriber
+from frame_filter import FrameFilter, goose_id, sources_from_env
 
 SCADA_API = "http://scada:5001"
 PRIMARY_IED = "http://ied:5003"
@@ -35,6 +37,17 @@ sv_status = {
 last_sv_quality = None
 
 goose_messages = []
+goose_prp = prp.DuplicateDiscard()
+# Early drop ahead of the JSON decode; spoofed frames still get through
+# to be shown, but no source can send more than GOOSE_RATE a second
+goose_filter = FrameFilter("goose", ["GOOSE1"], goose_id, sources_from_env(os.getenv("GOOSE_SOURCES", "")),
+                           max_len=1024, rate=float(os.getenv("GOOSE_RATE", "200")),
+                           burst=int(os.getenv("GOOSE_BURST", "50")))
+
+# stNum and sqNum of every GOOSE publisher, with the same state rules as
+# the IEDs: retransmissions, heartbeats and out of sequence frames are
+# not acted on
+goose_sub = GooseSubscriber(["GOOSE1"], None)
 last_fault_state = None 
 last_breaker_state = None
 previous_ied = None
@@ -183,6 +196,18 @@ def get_status():
 def goose_log():
     return jsonify(goose_messages[-20:])
 
+@app.route('/prp')
+def prp_status():
+    return jsonify({"goose": goose_prp.counters()})
+
+@app.route('/goose')
+def goose_status():
+    return jsonify({"subscribed": goose_sub.counters()})
+
+@app.route('/filters')
+def filter_status():
+    return jsonify({"goose": goose_filter.counters()})
+
 @app.route('/fault')
 def fault_proxy():
     global last_fault_state
@@ -210,14 +235,19 @@ def listen_goose():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind(('', GOOSE_PORT))
-    mreq = struct.pack("4sl", socket.inet_aton(GOOSE_GROUP), socket.INADDR_ANY)
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    prp.join_groups(sock, GOOSE_GROUP)
     print(f"[GUI] Listening for GOOSE messages on {GOOSE_GROUP}:{GOOSE_PORT}")
 
     while True:
         try:
-            data, _ = sock.recvfrom(1024)
+            data, src = sock.recvfrom(1024)
+            if not goose_filter.accept(data, src):
+                continue
+            data = goose_prp.accept(data, src)
+            if data is None:
+                continue
             msg = json.loads(data.decode())
+            new_state = goose_sub.receive(msg, src) is not None
 
             role = msg.get("role", "UNKNOWN").upper()
             entry = {
@@ -234,7 +264,7 @@ def listen_goose():
             if len(goose_messages) > 50:
                 goose_messages.pop(0)
 
-            if entry["status"] == "TRIP":
+            if entry["status"] == "TRIP" and new_state:
                 role = msg.get("role", "UNKNOWN").upper()
                 reason = msg.get("reason", "NO_REASON")
                 if role == "ATTACKER":
@@ -14,6 +14,10 @@ import threading
 import subprocess
 import os
 import requests
+from collections import deque
+import sv_codec
+import prp
+from goose_sub import GooseSubscriber
 from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
@@ -27,12 +31,27 @@ SV_PORT = 10010
 GOOSE_GROUP = "224.1.1.1"
 SV_GROUP = "239.192.0.1"
 
+# Both PRP LANs count as the same traffic once duplicates are dropped
+GOOSE_GROUPS = {GOOSE_GROUP, prp.lan_b_group(GOOSE_GROUP)}
+SV_GROUPS = {SV_GROUP, prp.lan_b_group(SV_GROUP)}
+goose_prp = prp.DuplicateDiscard()
+sv_prp = prp.DuplicateDiscard()
+
+# stNum and sqNum of every GOOSE publisher, with the same state rules as
+# the IEDs: retransmissions, heartbeats and out of sequence frames are
+# not acted on
+goose_sub = GooseSubscriber(["GOOSE1"], None)
+
 KNOWN_SV_SENDER_IP = "172.20.0.20"
 KNOWN_GOOSE_SENDER_IPS = {"172.20.0.14", "172.20.0.16", "172.20.0.17", "172.20.0.18"}
 
+# MU publishes 80 samples/cycle at 50 Hz; anything well above that is a flood
+SV_EXPECTED_RATE = float(os.getenv("SV_EXPECTED_RATE", "4000"))
+SV_FLOOD_RATE = SV_EXPECTED_RATE * 1.5
+
 
 alerts = []
-sv_rate_window = []
+sv_rate_window = deque(maxlen=100)
 system_events = []
 current_capture_process = None
 current_capture_file = None
@@ -69,12 +88,17 @@ def log_event(event):
 def parse_packet(pkt):
     if UDP in pkt and IP in pkt:
         try:
-            payload = pkt[UDP].payload.load.decode()
-            msg = json.loads(payload)
+            payload = bytes(pkt[UDP].payload)
             src_ip = pkt[IP].src
+            src = (src_ip, pkt[UDP].sport)
 
-            if pkt[UDP].dport == GOOSE_PORT and pkt[IP].dst == GOOSE_GROUP:
+            if pkt[UDP].dport == GOOSE_PORT and pkt[IP].dst in GOOSE_GROUPS:
+                payload = goose_prp.accept(payload, src)
+                if payload is None:
+                    return
+                msg = json.loads(payload.decode())
                 role = msg.get("role", "UNKNOWN").upper()
+                new_state = goose_sub.receive(msg, src) is not None
 
                 if src_ip not in KNOWN_GOOSE_SENDER_IPS:
                     log_event({
@@ -83,7 +107,7 @@ def parse_packet(pkt):
                         "status": msg.get("status"),
                         "src_ip": src_ip
                     })
-                elif msg.get("status") in ["TRIP", "RESET"]:
+                elif msg.get("status") in ["TRIP", "RESET"] and new_state:
                     log_event({
                         "type": "goose",
                         "status": msg.get("status"),
@@ -91,27 +115,28 @@ def parse_packet(pkt):
                         "src_ip": src_ip
                     })
 
-            elif pkt[UDP].dport == SV_PORT and pkt[IP].dst == SV_GROUP:
-                freq = msg.get("freq", 50)
-                Ia = msg.get("Ia", 0)
-                Ib = msg.get("Ib", 0)
-                Ic = msg.get("Ic", 0)
+            elif pkt[UDP].dport == SV_PORT and pkt[IP].dst in SV_GROUPS:
+                payload = sv_prp.accept(payload, src)
+                if payload is None:
+                    return
+                batch = sv_codec.decode(payload)
 
                 if src_ip != KNOWN_SV_SENDER_IP:
+                    sample = batch.latest()
                     log_event({
                         "type": "spoofed_sv",
                         "src_ip": src_ip,
-                        "freq": freq,
-                        "Ia": Ia,
-                        "Ib": Ib,
-                        "Ic": Ic
+                        "freq": sample["freq"],
+                        "Ia": sample["Ia"],
+                        "Ib": sample["Ib"],
+                        "Ic": sample["Ic"]
                     })
                 else:
-                    sv_rate_window.append(time.time())
-                    if len(sv_rate_window) > 100:
-                        sv_rate_window.pop(0)
-                    rate = len(sv_rate_window) / (sv_rate_window[-1] - sv_rate_window[0] + 0.01)
-                    if rate > 2000:
+                    # Rate is in samples/s, so multi-ASDU frames count per sample
+                    sv_rate_window.append((time.time(), len(batch)))
+                    samples = sum(n for _, n in sv_rate_window)
+                    rate = samples / (sv_rate_window[-1][0] - sv_rate_window[0][0] + 0.01)
+                    if rate > SV_FLOOD_RATE:
                         log_event({"type": "sv_flood", "rate_hz": round(rate, 1)})
 
         except Exception:
@@ -178,6 +203,10 @@ def stop_pcap():
 def health_check():
     return jsonify({"status": "ok"})
 
+@app.route("/prp")
+def prp_status():
+    return jsonify({"sv": sv_prp.counters(), "goose": goose_prp.counters()})
+
 
 @app.route("/pcap/<filename>")
 def download_pcap(filename):
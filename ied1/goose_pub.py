@@ -0,0 +1,123 @@
+"""
+GOOSE Publisher
+
+Author: Zein Ali
+Date: 03/08/2025
+
+Publishes GOOSE control blocks with the IEC 61850-8-1 retransmission
+scheme, driven by the IED event loop's timers. A state change goes out at
+once with stNum raised and sqNum 0. The same frame is then repeated with
+sqNum counting up, first after T1 and then at intervals doubling up to
+T0, which it keeps as a heartbeat until the next change:
+
+    change  T1  2*T1  4*T1  ...  T0  T0  T0  ...
+
+Each frame carries timeAllowedtoLive, twice the wait until the next one,
+so a subscriber can tell a publisher that has gone silent from one with
+nothing new to say. Any number of control blocks share the loop. A
+block sends nothing until its first publish(): the control IEDs publish
+their initial state (stNum 1, or one past the stNum resumed from the
+other IED) as they become active, so subscribers have a heartbeat to
+supervise even if no command is ever sent.
+"""
+import json
+import os
+import time
+
+
+# First retransmission after a change and the heartbeat interval, seconds
+T1 = float(os.getenv("GOOSE_T1", "0.004"))
+T0 = float(os.getenv("GOOSE_T0", "1.0"))
+
+# stNum and sqNum roll over past this back to 1
+COUNTER_MAX = 2 ** 32 - 1
+
+
+class ControlBlock:
+    """One GOOSE control block: its dataset values and counters"""
+
+    __slots__ = ("go_id", "fields", "values", "st_num", "sq_num", "changed", "interval", "timer")
+
+    def __init__(self, go_id, fields):
+        self.go_id = go_id
+        self.fields = fields
+        self.values = None
+        self.st_num = 0
+        self.sq_num = 0
+        self.changed = 0.0
+        self.interval = 0.0
+        self.timer = None
+
+
+class GoosePublisher:
+    def __init__(self, loop, sender, group, port, checksum, t1=T1, t0=T0):
+        self.loop = loop
+        self.sender = sender
+        self.dest = (group, port)
+        self.checksum = checksum
+        self.t1 = t1
+        self.t0 = t0
+        self.blocks = {}
+
+    def add(self, go_id, **fields):
+        """Register a control block; fields are sent unchanged in every frame"""
+        self.blocks[go_id] = ControlBlock(go_id, fields)
+
+    def publish(self, go_id, **values):
+        """New dataset values: send now and restart the retransmission curve.
+        Returns the new stNum.
+        """
+        block = self.blocks[go_id]
+        # The old state's curve stops here
+        if block.timer is not None:
+            self.loop.cancel(block.timer)
+        block.values = values
+        block.st_num = block.st_num % COUNTER_MAX + 1
+        block.sq_num = 0
+        block.changed = time.time()
+        block.interval = self.t1
+        self.send(block)
+        return block.st_num
+
+    def resume(self, go_id, st_num):
+        """Carry on the stNum replicated from another IED, so the next change
+        published here is numbered after the last one published there.
+        May be called from any thread; it touches no timers.
+        """
+        block = self.blocks[go_id]
+        block.st_num = max(block.st_num, st_num)
+
+    def stop(self, go_id):
+        """Stop a block's retransmissions and heartbeat, as when the IED
+        stands down; its counters are kept for the next publish()
+        """
+        block = self.blocks[go_id]
+        if block.timer is not None:
+            self.loop.cancel(block.timer)
+            block.timer = None
+
+    def send(self, block):
+        wait = block.interval
+        msg = {"goID": block.go_id}
+        msg.update(block.values)
+        msg.update({
+            "stNum": block.st_num,
+            "sqNum": block.sq_num,
+            "timestamp": block.changed,
+            "timeAllowedtoLive": int(2000 * wait)
+        })
+        msg.update(block.fields)
+        msg["checksum"] = self.checksum(msg)
+        self.sender.sendto(json.dumps(msg).encode(), self.dest)
+
+        block.timer = self.loop.call_later(wait, "goose_tx", self.retransmit, block)
+        block.interval = min(wait * 2, self.t0)
+
+    def retransmit(self, block):
+        block.sq_num = block.sq_num % COUNTER_MAX + 1
+        self.send(block)
+
+    def counters(self):
+        return {go_id: {"stNum": b.st_num, "sqNum": b.sq_num,
+                        "intervalMs": round(b.interval * 1e3, 1)}
+                for go_id, b in self.blocks.items()}
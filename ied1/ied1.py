@@ -8,7 +8,6 @@ Date: 15/06/2025
 
 
 import socket
-import struct
 import json
 import threading
 import time
@@ -16,17 +15,35 @@ import math
 import random
 import requests
 import os
-from flask import Flask, jsonify, request
+import queue
+from flask import Flask, Response, jsonify, request, send_from_directory
 from collections import deque
 from threading import Lock
 import concurrent.futures
 from datetime import datetime
+import sv_codec
+import prp
+from phasor import PhasorEstimator
+from sv_supervision import StreamSupervisor
+from disturbance import DisturbanceRecorder
+from mms_ring import RingWriter
+from ioloop import EventLoop
+from goose_pub import GoosePublisher
+from goose_sub import GooseSubscriber
+from datamodel import DataModel, MMXU_PATHS, mmxu_template, status_layout
+from power_quality import PowerQuality, pq_template
+from energy import EnergyMeter, mmtr_template, MMTR_DATASET
+from mms_server import MmsServer, ReportControl
+from control import ControlObject, Interlocks, is_protection
+from frame_filter import FrameFilter, goose_id, sv_id, sources_from_env
 
 
 MMS_PORT = 10201
 IED_MODE = "active" 
-current_mode = IED_MODE
-MMS_FILE = f"/app/shared/mms_{os.environ.get('DEVICE_NAME', 'IED1')}.json"
+# IED1 listens for an active IED2 before taking over (see handle_replication)
+current_mode = "standby"
+# Shared memory ring of MMS status snapshots read by SCADA (see mms_ring)
+MMS_FILE = f"/app/shared/mms_{os.environ.get('DEVICE_NAME', 'IED1')}.ring"
 
 mode_lock = Lock()
 
@@ -40,33 +57,165 @@ sv_health = {
     "last_sample_time": 0,
     "packet_count": 0,
     "rate_hz": 0,
-    "quality": "UNKNOWN"
+    "quality": "UNKNOWN",
+    "other_svid": 0,
+    "lost": 0,
+    "cpu_pct": 0,
+    "cpu_us_per_sample": 0
 }
 
+# SV stream to subscribe to, picked by svID: MU1-SV is the 80 samples/cycle
+# protection stream, MU1-PQ the 256 samples/cycle power quality stream
+SV_ID = os.getenv("SV_ID", "MU1-SV")
+SV_GROUP = os.getenv("SV_GROUP", "239.192.0.1")
+
+# SV handler time already counted into sv_health, for the per rate cost
+sv_busy_seen = 0.0
+
+# Samples per cycle of the subscribed stream, and how often its phasors
+# are published into MMXU
+SV_SPC = int(os.getenv("SV_SPC", "80"))
+MMXU_RATE_HZ = float(os.getenv("MMXU_RATE_HZ", "10"))
+sv_phasors = PhasorEstimator(SV_SPC)
+# Sequence, jitter and latency statistics of the subscribed stream
+sv_supervisor = StreamSupervisor(SV_SPC)
+# SV quality each second, from the supervisor's counts against the
+# SV_SPC * 50 samples a second the stream carries: LOST with no samples,
+# LATE with more than SV_LATE_LOSS_PCT of them lost or fewer than
+# SV_LATE_RATE_PCT arriving, else GOOD
+SV_EXPECTED_RATE = SV_SPC * 50
+SV_LATE_LOSS_PCT = float(os.getenv("SV_LATE_LOSS_PCT", "1"))
+SV_LATE_RATE_PCT = float(os.getenv("SV_LATE_RATE_PCT", "90"))
+# Supervisor counts (received, duplicate, lost) at the last health check
+sv_counts_seen = (0, 0, 0)
+
+# Disturbance recorder: full rate SV and binary states around a GOOSE TRIP,
+# an instantaneous phase current over DR_TRIGGER_A or a manual trigger
+DR_DIR = os.getenv("DR_DIR", "/app/recordings")
+DR_TRIGGER_A = float(os.getenv("DR_TRIGGER_A", "3000")) or None
+recorder = DisturbanceRecorder(
+    DR_DIR, "SUBSTATION", os.getenv("DEVICE_NAME", "IED1"), SV_SPC * 50.0,
+    ("XCBR1_CLOSED", "GOOSE_TRIP", "CMD_TRIP"),
+    pre=float(os.getenv("DR_PRE_MS", "200")) / 1000, post=float(os.getenv("DR_POST_MS", "500")) / 1000,
+    threshold=DR_TRIGGER_A, keep=int(os.getenv("DR_KEEP", "20")))
+# Power quality: harmonics, THD, sequence components, unbalance and
+# frequency every 10 cycles, worked out on a thread of its own into
+# MHAI1 and MSQI1
+power_quality = PowerQuality(SV_SPC, on_result=lambda values: datamodel.update(values))
+# Energy registers (MMTR1), integrated from the SV stream in blocks of
+# ENERGY_BLOCK samples (one cycle by default) and checkpointed to the
+# shared volume so they carry on after a restart
+ENERGY_FILE = os.getenv("ENERGY_FILE", f"/app/shared/energy_{os.getenv('DEVICE_NAME', 'IED1')}.json")
+ENERGY_CHECKPOINT_S = float(os.getenv("ENERGY_CHECKPOINT_S", "5"))
+energy = EnergyMeter(SV_SPC, ENERGY_FILE, block=int(os.getenv("ENERGY_BLOCK", "0")))
+mmxu_period = 1.0 / MMXU_RATE_HZ
+next_mmxu = 0.0
+
 
 
 GOOSE_GROUP = '224.1.1.1'
 GOOSE_PORT = 10200
-stNum = 1
+
+# PRP duplicate discard for the SV and GOOSE subscriptions
+sv_prp = prp.DuplicateDiscard()
+goose_prp = prp.DuplicateDiscard()
+
+# Early drop of frames this IED does not subscribe to, before any decode.
+# GOOSE_SOURCES and SV_SOURCES list the publishers allowed (empty: any);
+# each GOOSE source is held to GOOSE_RATE frames a second
+GOOSE_RATE = float(os.getenv("GOOSE_RATE", "200"))
+goose_filter = FrameFilter("goose", ["GOOSE1"], goose_id, sources_from_env(os.getenv("GOOSE_SOURCES", "")),
+                           max_len=1024, rate=GOOSE_RATE, burst=int(os.getenv("GOOSE_BURST", "50")))
+sv_filter = FrameFilter("sv", [SV_ID], sv_id, sources_from_env(os.getenv("SV_SOURCES", "")))
+
+# GOOSE commands dropped as redundant, and the pending check of the
+# breaker against the last command sent (a timer, None when there is none)
+goose_coalesced = 0
+breaker_check = None
+
+# Position the breaker multicasts on every change and once a second
+BREAKER_POS_GROUP = '224.1.1.2'
+BREAKER_POS_PORT = 10202
+# Three missed pushes and the breaker is taken as gone
+BREAKER_SILENT = 3.0
+breaker_pos_rx = None
 IED1_UDP_PORT = 10500
 
+# Hot-standby replication: the control state is multicast to IED2 on every
+# change and as a heartbeat, which IED2 also uses to detect losing this IED
+REPL_GROUP = os.getenv("REPL_GROUP", "224.1.1.3")
+REPL_PORT = int(os.getenv("REPL_PORT", "10510"))
+REPL_HEARTBEAT = float(os.getenv("REPL_HEARTBEAT_MS", "50")) / 1000
+repl_seq = 0
+# IED2 replicates back while it is active. Only its address is listened to
+REPL_PEER = os.getenv("REPL_PEER", "172.20.0.16")
+# How long IED1 listens at start-up, or after IED2 falls silent, before
+# taking over; longer than IED2's heartbeat
+REPL_LISTEN = float(os.getenv("REPL_LISTEN_MS", "300")) / 1000
+PEER_CHECK = 0.02
+listen_since = time.monotonic()
+peer_active_rx = None
+
 
 
 BREAKER_IP = 'breaker'
-BREAKER_HTTP_PORT = 5002
 
 
 breaker_status = "UNKNOWN"
 last_cmd = None
 fault_active = False
 
-mmxu_measurements = {
-    "Ua": None, "Ub": None, "Uc": None,
-    "Ia": None, "Ib": None, "Ic": None,
-    "Freq": None,
-    "timestamp": None
+# Breaker control: select-before-operate with enhanced security, checked
+# against the CILO1 interlocking rules. The rules are expressions over
+# data model paths; CILO_RULES (JSON) replaces any of them
+CTL_MODEL = os.getenv("CTL_MODEL", "sbo-with-enhanced-security")
+SBO_TIMEOUT = float(os.getenv("SBO_TIMEOUT_MS", "30000")) / 1000
+OPER_TIMEOUT = float(os.getenv("OPER_TIMEOUT_MS", "2000")) / 1000
+CILO_RULES = {
+    # Opening is always allowed
+    "EnaOpn": "True",
+    # Closing only an open breaker, with no fault pending and the SV
+    # stream healthy
+    "EnaCls": 'XCBR1.Pos.stVal == "OPEN" and not LLN0.fault and LLN0.sv.quality == "GOOD"'
 }
-mmxu_lock = threading.Lock()
+CILO_RULES.update(json.loads(os.getenv("CILO_RULES", "{}")))
+# GOOSE publishers whose TRIP is a protection trip, by role prefix: the
+# P-IEDs send their DEVICE_NAME, P-IED1 and P-IED2
+PROTECTION_ROLES = tuple(os.getenv("PROTECTION_ROLES", "P-IED").split(","))
+
+# The IED's data model: XCBR1 position, MMXU1 measurements, and LLN0 with
+# the mode and SV health. /mms/status, the MMS ring and MMS reads and
+# writes all go through it
+datamodel = DataModel(os.getenv("DEVICE_NAME", "IED1"), {
+    "LLN0": {"mode": current_mode, "fault": fault_active, "timestamp": None, "sv": dict(sv_health)},
+    "XCBR1": {"Pos": {"stVal": breaker_status, "ctlVal": "UNKNOWN", "stSeld": False, "ctlModel": CTL_MODEL,
+                      "sboTimeout": int(SBO_TIMEOUT * 1000), "operTimeout": int(OPER_TIMEOUT * 1000),
+                      "SBOw": None, "Oper": None, "Cancel": None}},
+    "CILO1": {name: {"stVal": None} for name in CILO_RULES},
+    "MMXU1": mmxu_template(),
+    **pq_template(power_quality.harmonics),
+    **mmtr_template()
+}, layout=status_layout)
+datamodel.update(energy.values())
+
+
+def control_blocked(ctl_val):
+    return "Blocked-by-Mode" if current_mode != "active" else None
+
+def execute_control(ctl_val, origin):
+    loop.submit("control", operate_breaker, ctl_val, origin)
+
+interlocks = Interlocks(datamodel, CILO_RULES)
+breaker_control = ControlObject(datamodel, "XCBR1.Pos", interlocks, execute_control, blocked=control_blocked,
+                                ctl_model=CTL_MODEL, sbo_timeout=SBO_TIMEOUT, oper_timeout=OPER_TIMEOUT)
+interlocks.refresh()
+
+# MMS report server: SCADA holds one association and is sent the control
+# state as it changes (buffered, so nothing is lost over a reconnect) and
+# the measurements gathered over 100 ms
+MMS_TCP_PORT = int(os.getenv("MMS_TCP_PORT", "10102"))
+STATUS_DATASET = ("XCBR1.Pos.stVal", "XCBR1.Pos.ctlVal", "LLN0.mode", "LLN0.fault", "LLN0.sv.quality")
+MEAS_DATASET = tuple(MMXU_PATHS.values()) + MMTR_DATASET + ("LLN0.sv.rate_hz",)
 
 app = Flask(__name__)
 
@@ -74,179 +223,283 @@ app = Flask(__name__)
 system_events = []
 
 
-with open(MMS_FILE, "w") as f:
-    f.write("[]")
-print(f"[IED] Cleared MMS log file at startup: {MMS_FILE}")
+mms_ring = RingWriter(MMS_FILE)
+print(f"[IED] Created MMS snapshot ring at startup: {MMS_FILE}")
 
+# All UDP sockets and periodic jobs of the IED run on this one loop
+loop = EventLoop()
+# MMS socket, also used for read responses; RTU command socket, also
+# used for control responses
+mms_sock = None
+command_sock = None
 
+goose_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+goose_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+goose_sender = prp.PrpSender(goose_sock)
 
-def compute_checksum(msg):
-    return abs(hash(json.dumps(msg))) % 100000
+repl_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+repl_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
 
-def broadcast_goose(status):
-    global stNum
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-
-    print(f"[IED1] Broadcasting GOOSE: {status} (stNum {stNum})")
-    for sq in range(1, 5):
-        msg = {
-            "goID": "GOOSE1",
-            "status": status,
-            "reason": "Manual Override",
-            "stNum": stNum,
-            "sqNum": sq,
-            "timestamp": time.time(),
-            "role": "C-IED1"
-        }
-        msg["checksum"] = compute_checksum(msg)
-        sock.sendto(json.dumps(msg).encode(), (GOOSE_GROUP, GOOSE_PORT))
-        time.sleep(0.3)
-    
-    stNum += 1
-
-def listen_for_commands():
-    print(f"[IED1] Listening for TRIP/RESET on UDP port {IED1_UDP_PORT}")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(("0.0.0.0", IED1_UDP_PORT))
+# Events waiting to be forwarded to SCADA off the loop
+log_queue = queue.Queue(maxsize=1000)
 
-    while True:
-        data, addr = sock.recvfrom(1024)
-        try:
-            msg = json.loads(data.decode())
-            cmd = msg.get("command", "").upper()
-            if cmd in ["TRIP", "RESET"]:
-                broadcast_goose(cmd)
-            else:
-                log_system_event(f"[IED1] Invalid command received: {cmd}")
-        except Exception as e:
-            log_system_event(f"[IED1] Error parsing command: {e}")
 
 
-def write_mms_to_file():
-    while True:
-        try:
-            with mmxu_lock:
-                mmxu = dict(mmxu_measurements)
-
-            if mmxu["timestamp"] and all(v is not None for v in [mmxu["Ua"], mmxu["Ub"], mmxu["Uc"], mmxu["Ia"], mmxu["Ib"], mmxu["Ic"], mmxu["Freq"]]):
-                status = {
-                    "timestamp": mmxu["timestamp"],
-                    "ln": "XCBR1",
-                    "Pos": {
-                        "stVal": breaker_status,
-                        "ctlVal": last_cmd or "UNKNOWN"
-                    },
-                    "sv": sv_health,
-                    "mode": current_mode,
-                    "MMXU1": {
-                        "PhV": {
-                            "phsA": {"mag": {"f": mmxu["Ua"]}},
-                            "phsB": {"mag": {"f": mmxu["Ub"]}},
-                            "phsC": {"mag": {"f": mmxu["Uc"]}}
-                        },
-                        "A": {
-                            "phsA": {"mag": {"f": mmxu["Ia"]}},
-                            "phsB": {"mag": {"f": mmxu["Ib"]}},
-                            "phsC": {"mag": {"f": mmxu["Ic"]}}
-                        },
-                        "Freq": mmxu["Freq"]
-                    }
-                }
-
-
-                entries = []
-                if os.path.exists(MMS_FILE):
-                    with open(MMS_FILE, "r", encoding="utf-8") as f:
-                        try:
-                            entries = json.load(f)
-                        except json.JSONDecodeError:
-                            print("[IED] Corrupted MMS file — resetting.")
-
-                entries.append(status)
-                entries = entries[-100:]
-                if len(entries) > 100:
-                    print(f"[IED] ❌ Trim logic failed! {len(entries)} entries remaining.")
-                else:
-                    print(f"[IED] ✅ Trimmed to {len(entries)} entries.")
-                
-
-                with open(MMS_FILE, "w", encoding="utf-8") as f:
-                    json.dump(entries, f, indent=2, ensure_ascii=False)
-
-        except Exception as e:
-            print("[IED] Failed to write MMS file:", e)
+def compute_checksum(msg):
+    return abs(hash(json.dumps(msg))) % 100000
 
-        time.sleep(1.5)
+goose_pub = GoosePublisher(loop, goose_sender, GOOSE_GROUP, GOOSE_PORT, compute_checksum)
+# Published from take_over() on, once this IED is active
+goose_pub.add("GOOSE1", role="C-IED1")
 
+def goose_expired(key, pub):
+    ip, go_id = key
+    log_system_event(f"[IED] GOOSE {go_id} from {ip} silent beyond timeAllowedtoLive (stNum {pub.st_num})")
 
+goose_sub = GooseSubscriber(["GOOSE1"], loop, on_expire=goose_expired)
 
-def listen_for_sv():
-    global mmxu_measurements
+def broadcast_goose(status):
+    st_num = goose_pub.publish("GOOSE1", status=status, reason="Manual Override")
+    print(f"[IED1] Broadcasting GOOSE: {status} (stNum {st_num})")
+    replicate_state()
+
+def publish_initial_state():
+    """Start GOOSE1 on becoming active: a state carrying no command, so
+    no subscriber acts on it, with its retransmissions and heartbeat
+    """
+    st_num = goose_pub.publish("GOOSE1", status="NONE", reason="Initial state")
+    print(f"[IED1] Publishing initial GOOSE state (stNum {st_num})")
+    replicate_state()
+
+def replicate_state():
+    global repl_seq
+    repl_seq += 1
+    block = goose_pub.blocks["GOOSE1"]
+    state = {
+        "type": "ied_state",
+        "source": os.getenv("DEVICE_NAME", "IED1"),
+        "seq": repl_seq,
+        "timestamp": time.time(),
+        "mode": current_mode,
+        "stNum": block.st_num,
+        "status": (block.values or {}).get("status"),
+        "last_cmd": last_cmd,
+        "fault_active": fault_active,
+        "breaker_status": breaker_status
+    }
+    repl_sock.sendto(json.dumps(state).encode(), (REPL_GROUP, REPL_PORT))
+
+def handle_replication(data, src):
+    """IED2's control state, sent while it is active. A listening IED1
+    carries on from it, and takes over when IED2 hands back or falls
+    silent. An active IED1 stands down for an IED2 promoted by SCADA.
+    """
+    global last_cmd, fault_active, peer_active_rx
+    if src[0] != REPL_PEER:
+        return
+    msg = json.loads(data.decode())
+    if msg.get("type") != "ied_state" or msg.get("source") == os.getenv("DEVICE_NAME", "IED1"):
+        return
+    if current_mode == "active":
+        if msg.get("mode") == "active" and msg.get("held"):
+            stand_down("IED2 promoted by SCADA")
+        else:
+            return
+    goose_pub.resume("GOOSE1", msg.get("stNum") or 0)
+    last_cmd = msg.get("last_cmd") or last_cmd
+    fault_active = bool(msg.get("fault_active"))
+    if msg.get("mode") == "active":
+        peer_active_rx = time.monotonic()
+    else:
+        # IED2's last word on standing down
+        take_over("IED2 hand-back")
+
+def check_listen():
+    """Take over once no active IED2 has been heard for REPL_LISTEN"""
+    if current_mode == "active":
+        return
+    if time.monotonic() - (peer_active_rx or listen_since) >= REPL_LISTEN:
+        take_over("no active IED2" if peer_active_rx is None else "IED2 heartbeat loss")
+
+def take_over(source):
+    """Become the active IED, on the loop thread, from the state adopted
+    while listening
+    """
+    global current_mode
+    if current_mode == "active":
+        return
+    current_mode = "active"
+    sync_datamodel()
+    publish_initial_state()
+    log_system_event(f"🟢 IED1 ACTIVE via {source}")
+
+def stand_down(reason):
+    """Go back to listening, on the loop thread; the GOOSE heartbeat stops
+    and the replication heartbeat goes on as standby
+    """
+    global current_mode, listen_since, peer_active_rx
+    current_mode = "standby"
+    listen_since = time.monotonic()
+    peer_active_rx = None
+    goose_pub.stop("GOOSE1")
+    sync_datamodel()
+    replicate_state()
+    log_system_event(f"🔄 {reason} — IED1 to STANDBY")
+
+def open_udp_socket(port, group=None):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(('', 10010))
-    mreq = struct.pack("4sl", socket.inet_aton("239.192.0.1"), socket.INADDR_ANY)
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-
-    print("[IED] Listening for Sampled Values on 239.192.0.1:10010")
-
-    while True:
-        try:
-            data, _ = sock.recvfrom(4096)
-            sv = json.loads(data.decode())
-
-            with mmxu_lock:
-                mmxu_measurements.update({
-                    "Ua": sv.get("Ua"),
-                    "Ub": sv.get("Ub"),
-                    "Uc": sv.get("Uc"),
-                    "Ia": sv.get("Ia"),
-                    "Ib": sv.get("Ib"),
-                    "Ic": sv.get("Ic"),
-                    "Freq": sv.get("freq"),
-                    "timestamp": datetime.utcnow().isoformat() + "Z"
-                })
-
-            sv_health["last_sample_time"] = time.time()
-            sv_health["packet_count"] += 1
-
-        except Exception as e:
-            print("[IED] SV parse error:", e)
+    if group:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    if group:
+        prp.join_groups(sock, group)
+    return sock
+
+def handle_command(data, addr):
+    """RTU control: {"command": "TRIP", "action": "select" | "operate" |
+    "cancel", "ctlNum": n}, answered with the decision and, for an
+    operate, later the command termination
+    """
+    try:
+        msg = json.loads(data.decode())
+        cmd = msg.get("command", "").upper()
+        action = msg.get("action", "operate")
+        if cmd not in ["TRIP", "RESET"] or action not in ("select", "operate", "cancel"):
+            log_system_event(f"[IED1] Invalid command received: {cmd} ({action})")
+            return
+    except Exception as e:
+        log_system_event(f"[IED1] Error parsing command: {e}")
+        return
+
+    def reply(term):
+        command_sock.sendto(json.dumps(dict(term, type="cmd_term")).encode(), addr)
+    accepted, cause = breaker_control.request(action, f"rtu:{addr[0]}:{addr[1]}", cmd, msg.get("ctlNum"), reply)
+    command_sock.sendto(json.dumps({"type": "command_resp", "action": action, "command": cmd,
+                                    "ctlNum": msg.get("ctlNum"), "ok": accepted, "addCause": cause}).encode(), addr)
+    if not accepted:
+        log_system_event(f"[IED1] RTU {action} {cmd} refused: {cause}")
+
+
+
+def sync_datamodel():
+    """Bring the position and mode into the data model; a write that
+    changes nothing leaves the version, and the cached status, as they are
+    """
+    datamodel.update({
+        "XCBR1.Pos.stVal": breaker_status,
+        "XCBR1.Pos.ctlVal": last_cmd or "UNKNOWN",
+        "LLN0.mode": current_mode,
+        "LLN0.fault": fault_active
+    })
 
 
+# MMS write -> control service of XCBR1.Pos
+CONTROL_SERVICES = {"SBOw": "select", "Oper": "operate", "Cancel": "cancel"}
+
+def mms_write(ref, value, origin=None, reply=None):
+    """Write over MMS: only the SBOw, Oper and Cancel services of
+    XCBR1.Pos, with the ctlVal and ctlNum in the value. Returns why a write
+    is refused (an AddCause for a control), or None
+    """
+    obj, _, service = ref.rpartition(".")
+    if obj != "XCBR1.Pos" or service not in CONTROL_SERVICES:
+        return f"{ref} is not writable"
+    if not isinstance(value, dict):
+        return "Inconsistent-parameters"
+    accepted, cause = breaker_control.request(CONTROL_SERVICES[service], origin, value.get("ctlVal"),
+                                              value.get("ctlNum"), reply)
+    print(f"[IED] MMS {service} {value.get('ctlVal')} from {origin}: {'accepted' if accepted else cause}")
+    return cause
+
+
+# Two instances of each block, one per SCADA worker
+mms_server = MmsServer(datamodel, MMS_TCP_PORT, [
+    rcb for n in (1, 2) for rcb in (
+        ReportControl(f"brcbStatus{n:02d}", STATUS_DATASET, buffered=True, intg_pd=5.0),
+        ReportControl(f"urcbMeas{n:02d}", MEAS_DATASET, intg_pd=2.0, buf_tm=0.1))
+], on_write=lambda ref, value, client: mms_write(
+    ref, value, f"mms:{client.peer[0]}:{client.peer[1]}", lambda term: mms_server.send(client, term)))
+
+
+def write_mms_snapshot():
+    sync_datamodel()
+    status, _ = datamodel.snapshot()
+    m = status["MMXU1"]
+    if m["timestamp"] and all(m[do][phs]["mag"]["f"] is not None for do in ("PhV", "A") for phs in m[do]) \
+            and m["Freq"] is not None:
+        mms_ring.write(status)
+
+
+
+def handle_sv(data, src):
+    global next_mmxu
+    if not sv_filter.accept(data, src):
+        # Another stream sharing the group or port, or not a frame at all
+        sv_health["other_svid"] = sv_filter.dropped["id"]
+        return
+    data = sv_prp.accept(data, src)
+    if data is None:
+        return
+    batch = sv_codec.decode(data)
+    sv_supervisor.frame(batch.smp_cnt, batch.utc_timestamp)
+    recorder.add(batch.values, batch.utc_timestamp)
+    power_quality.add(batch.values)
+    energy.add(batch.values)
+    sv_phasors.update(batch.smp_cnt, batch.values)
+
+    now = time.monotonic()
+    if now >= next_mmxu:
+        next_mmxu = now + mmxu_period
+        measured = sv_phasors.measure()
+        if measured:
+            measured["timestamp"] = datetime.utcnow().isoformat() + "Z"
+            values = {MMXU_PATHS[k]: v for k, v in measured.items() if k in MMXU_PATHS}
+            values["LLN0.timestamp"] = measured["timestamp"]
+            energy.set_frequency(measured["Freq"])
+            values.update(energy.values())
+            datamodel.update(values)
+
+    sv_health["last_sample_time"] = time.time()
+    sv_health["packet_count"] += len(batch)
 
 
 def log_debug(msg):
     print(f"[DEBUG] {time.strftime('%H:%M:%S')} | {msg}", flush=True)
 
 
-def mms_listener():
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('', MMS_PORT))
-    print(f"[IED] Listening for simulated MMS messages on UDP {MMS_PORT}")
-
-    while True:
-        data, addr = sock.recvfrom(4096)
-        try:
-            msg = json.loads(data.decode())
-            if msg.get("type") == "mms_write" and msg.get("ln") == "XCBR1":
-                if msg["do"] == "Pos" and msg["da"] == "ctlVal":
-                    cmd = msg["value"]
-                    if cmd in ["TRIP", "RESET"]:
-                        print(f"[IED] Received MMS ctlVal: {cmd}")
-                        send_command_to_breaker(cmd)
-        except Exception as e:
-            print("[IED] MMS decode error:", e)
+def handle_mms(data, addr):
+    try:
+        msg = json.loads(data.decode())
+        path = f"{msg.get('ln')}.{msg.get('do')}.{msg.get('da')}"
+        if datamodel.resolve(path) is None:
+            print(f"[IED] MMS object not found: {path}")
+            return
+        if msg.get("type") == "mms_read":
+            sync_datamodel()
+            reply = {"type": "mms_read_resp", "ln": msg["ln"], "do": msg["do"], "da": msg["da"],
+                     "value": datamodel.get(path), "version": datamodel.version}
+            mms_sock.sendto(json.dumps(reply).encode(), addr)
+        elif msg.get("type") == "mms_write":
+            def reply(term):
+                mms_sock.sendto(json.dumps(dict(term, type="mms_cmd_term")).encode(), addr)
+            error = mms_write(path, msg.get("value"), f"udp:{addr[0]}:{addr[1]}", reply)
+            resp = {"type": "mms_write_resp", "ln": msg["ln"], "do": msg["do"], "da": msg["da"],
+                    "ok": error is None, "addCause": error}
+            mms_sock.sendto(json.dumps(resp).encode(), addr)
+    except Exception as e:
+        print("[IED] MMS decode error:", e)
 
 @app.route('/failover', methods=["POST"])
 def manual_failover():
-    global current_mode
-    with mode_lock:
-        if current_mode == "active":
-            return jsonify({"result": "already_active"}), 200
-        current_mode = "active"
-    log_system_event(f"🟢 Promoted to ACTIVE via SCADA instruction")
+    if current_mode == "active":
+        return jsonify({"result": "already_active"}), 200
+    # The mode only changes on the loop thread, between frames
+    done = threading.Event()
+    def take_over_now():
+        take_over("SCADA instruction")
+        done.set()
+    loop.submit("failover", take_over_now)
+    done.wait(1.0)
     return jsonify({"result": "promoted", "new_mode": current_mode})
 
 
@@ -271,9 +524,61 @@ def get_sv_status():
     return jsonify({
         "status": sv_health["quality"],
         "last_sample": sv_health["last_sample_time"],
-        "rateHz": sv_health["rate_hz"]
+        "rateHz": sv_health["rate_hz"],
+        "svID": SV_ID,
+        "cpuPct": sv_health["cpu_pct"],
+        "cpuUsPerSample": sv_health["cpu_us_per_sample"],
+        "supervision": {SV_ID: sv_supervisor.as_dict()},
+        "filter": sv_filter.counters()
     })
 
+@app.route('/prp')
+def get_prp_status():
+    return jsonify({"sv": sv_prp.counters(), "goose": goose_prp.counters()})
+
+@app.route('/goose')
+def get_goose_status():
+    return jsonify({"published": goose_pub.counters(), "subscribed": goose_sub.counters(),
+                    "coalesced": goose_coalesced, "filter": goose_filter.counters()})
+
+@app.route('/recordings')
+def list_recordings():
+    return jsonify({"recorder": recorder.counters(), "recordings": recorder.recordings()})
+
+@app.route('/recordings/trigger', methods=["POST"])
+def trigger_recording():
+    if recorder.trigger("MANUAL"):
+        return jsonify({"result": "triggered"})
+    return jsonify({"result": "busy"}), 409
+
+@app.route('/recordings/<path:filename>')
+def download_recording(filename):
+    return send_from_directory(DR_DIR, filename, as_attachment=True)
+
+@app.route('/power-quality')
+def get_power_quality():
+    status, _ = datamodel.snapshot()
+    return jsonify({"analysis": power_quality.counters(),
+                    "MHAI1": status["MHAI1"], "MSQI1": status["MSQI1"]})
+
+@app.route('/energy')
+def get_energy():
+    status, _ = datamodel.snapshot()
+    return jsonify({"meter": energy.counters(), "MMTR1": status["MMTR1"]})
+
+@app.route('/control')
+def get_control():
+    return jsonify({"XCBR1.Pos": breaker_control.counters(), "CILO1": interlocks.as_dict(),
+                    "interlockEvaluations": interlocks.evaluations})
+
+@app.route('/mms/server')
+def get_mms_server():
+    return jsonify(mms_server.counters())
+
+@app.route('/loop-stats')
+def get_loop_stats():
+    return jsonify(loop.snapshot())
+
 @app.route("/health")
 def health():
     return jsonify({"status": "ok"}), 200
@@ -282,35 +587,19 @@ def health():
 @app.route('/mms/status')
 def get_mms_status():
     try:
-        with mmxu_lock:
-            return jsonify({
-                "ln": "XCBR1",
-                "Pos": {
-                    "stVal": breaker_status,
-                    "ctlVal": last_cmd or "UNKNOWN"
-                },
-                "sv": sv_health,
-                "mode": current_mode,
-                "MMXU1": {
-                    "PhV": {
-                        "phsA": {"mag": {"f": mmxu_measurements.get("Ua")}},
-                        "phsB": {"mag": {"f": mmxu_measurements.get("Ub")}},
-                        "phsC": {"mag": {"f": mmxu_measurements.get("Uc")}}
-                    },
-                    "A": {
-                        "phsA": {"mag": {"f": mmxu_measurements.get("Ia")}},
-                        "phsB": {"mag": {"f": mmxu_measurements.get("Ib")}},
-                        "phsC": {"mag": {"f": mmxu_measurements.get("Ic")}}
-                    },
-                    "Freq": mmxu_measurements.get("Freq"),
-                    "timestamp": mmxu_measurements.get("timestamp")
-                }
-            })
+        sync_datamodel()
+        _, data = datamodel.snapshot()
+        return Response(data, mimetype="application/json")
     except Exception as e:
         print("[IED] MMS status error:", e)
         return jsonify({"error": "Failed to generate MMS status"}), 500
 
 
+@app.route('/mms/model')
+def get_mms_model():
+    return jsonify(datamodel.counters())
+
+
 
 
 def check_ied1_reachable():
@@ -342,33 +631,83 @@ def wait_for_ied_ready(timeout_sec=10):
                 return
 
 
-def listen_goose():
-    global last_cmd
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(('', GOOSE_PORT))
-    mreq = struct.pack("4sl", socket.inet_aton(GOOSE_GROUP), socket.INADDR_ANY)
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-
-    print(f"[IED] Listening for GOOSE messages on {GOOSE_GROUP}:{GOOSE_PORT}")
-
-    while True:
-        with mode_lock:
-            if current_mode != "active":
-                time.sleep(1)
-                continue
+def handle_goose(data, src):
+    if not goose_filter.accept(data, src):
+        return
+    data = goose_prp.accept(data, src)
+    if data is None:
+        return
+    try:
+        msg = json.loads(data.decode())
+    except ValueError as e:
+        print("[IED] GOOSE parse error:", e)
+        return
+    # Publishers are tracked in standby as well, just not acted on, so a
+    # promotion applies to the next state change and no old one is replayed
+    if not goose_sub.receive(msg, src):
+        return
+    cmd = msg.get("status", "")
+    recorder.set_digital("GOOSE_TRIP", cmd == "TRIP")
+    if cmd == "TRIP":
+        recorder.trigger("GOOSE_TRIP")
+    role = msg.get("role")
+    # This IED's own GOOSE carries a command it has already executed
+    if current_mode != "active" or role == "C-IED1" or cmd not in ("TRIP", "RESET"):
+        return
+    accepted, cause = breaker_control.request("direct", f"goose:{role}:{src[0]}", cmd,
+                                              msg.get("stNum"), protection=is_protection(role, PROTECTION_ROLES))
+    if accepted:
+        log_system_event(f"[IED] Received GOOSE Command: {cmd}")
+    elif cause != "Position-reached":
+        log_system_event(f"[IED] GOOSE {cmd} from {role} refused: {cause}")
+
+def operate_breaker(cmd, origin):
+    """Carry out an accepted command. The breaker acts on GOOSE, so an
+    operator's command is published; one that came as GOOSE has already
+    reached it
+    """
+    command_breaker(cmd)
+    if not origin.startswith("goose:"):
+        broadcast_goose(cmd)
+
+def command_breaker(cmd):
+    """Pass a command on to the breaker. A command that would change
+    nothing, because the breaker is already there or the same command is
+    still awaiting its check, is dropped. Each command sent replaces the
+    pending check with one a second later.
+    """
+    global last_cmd, goose_coalesced, breaker_check
+    expected = "OPEN" if cmd == "TRIP" else "CLOSED"
+    if cmd == last_cmd and (breaker_check is not None or breaker_status == expected):
+        goose_coalesced += 1
+        return False
 
-        data, _ = sock.recvfrom(1024)
-        try:
-            msg = json.loads(data.decode())
-            if msg.get("goID") == "GOOSE1":
-                cmd = msg.get("status", "")
-                log_system_event(f"[IED] Received GOOSE Command: {cmd}")
-                send_command_to_breaker(cmd)
-                last_cmd = cmd
-                threading.Timer(1.0, check_breaker_response).start()
-        except Exception as e:
-            print("[IED] GOOSE parse error:", e)
+    send_command_to_breaker(cmd)
+    last_cmd = cmd
+    recorder.set_digital("CMD_TRIP", cmd == "TRIP")
+    sync_datamodel()
+    replicate_state()
+    if breaker_check is not None:
+        loop.cancel(breaker_check)
+    breaker_check = loop.call_later(1.0, "breaker_check", check_breaker_response)
+    return True
+
+def handle_breaker_position(data, src):
+    """Breaker position push; confirms a command early, ending its check"""
+    global breaker_status, breaker_check, fault_active, breaker_pos_rx
+    msg = json.loads(data.decode())
+    if msg.get("ln") != "XCBR1" or msg.get("do") != "Pos":
+        return
+    breaker_pos_rx = time.monotonic()
+    breaker_status = msg.get("stVal", breaker_status)
+    recorder.set_digital("XCBR1_CLOSED", breaker_status == "CLOSED")
+    sync_datamodel()
+    if breaker_check is not None and breaker_status == ("OPEN" if last_cmd == "TRIP" else "CLOSED"):
+        loop.cancel(breaker_check)
+        breaker_check = None
+        fault_active = False
+        sync_datamodel()
+        replicate_state()
 
 def send_command_to_breaker(cmd):
     try:
@@ -376,28 +715,32 @@ def send_command_to_breaker(cmd):
             s.sendto(cmd.encode(), (BREAKER_IP, 10000))
         log_system_event(f"[IED] Sent '{cmd}' to Breaker")
     except Exception as e:
-        log_system_event("[IED] Failed to send command:", e)
+        log_system_event(f"[IED] Failed to send command: {e}")
+
+def check_breaker_silence():
+    """The breaker pushes its position once a second; mark it
+    DISCONNECTED once it has missed BREAKER_SILENT worth of pushes
+    """
+    global breaker_status
+    if breaker_pos_rx is None or breaker_status == "DISCONNECTED":
+        return
+    if time.monotonic() - breaker_pos_rx > BREAKER_SILENT:
+        breaker_status = "DISCONNECTED"
+        sync_datamodel()
+        log_system_event(f"[IED] No breaker position for {BREAKER_SILENT:.0f} s — DISCONNECTED")
 
 def check_breaker_response():
-    global fault_active
+    global fault_active, breaker_check
+    breaker_check = None
+
     expected = "OPEN" if last_cmd == "TRIP" else "CLOSED"
     if breaker_status != expected:
         log_system_event(f"[IED] FAULT: expected {expected}, got {breaker_status}")
         fault_active = True
     else:
         fault_active = False
-
-def poll_breaker_status():
-    global breaker_status
-    while True:
-        try:
-            r = requests.get(f"http://{BREAKER_IP}:{BREAKER_HTTP_PORT}/status", timeout=1)
-            breaker_status = r.json().get("state", "UNKNOWN")
-        except Exception as e:
-            log_system_event(f"[IED] Failed to poll breaker:", e)
-            breaker_status = "DISCONNECTED"
-        time.sleep(1)
-
+    sync_datamodel()
+    replicate_state()
 
 try:
     resolved_ied_ip = socket.gethostbyname("ied")
@@ -454,11 +797,20 @@ def log_system_event(message):
         system_events.pop(0)
     print(f"[C-IED1 LOG] {message}")
 
-
+    # Forwarded from its own thread so a slow SCADA never holds up the loop
     try:
-        requests.post("http://scada:5001/log", json=event, timeout=1)
-    except Exception as e:
-        print(f"[C-IED1] Failed to forward log to SCADA: {e}")
+        log_queue.put_nowait(event)
+    except queue.Full:
+        pass
+
+
+def forward_logs():
+    while True:
+        event = log_queue.get()
+        try:
+            requests.post("http://scada:5001/log", json=event, timeout=1)
+        except Exception as e:
+            print(f"[C-IED1] Failed to forward log to SCADA: {e}")
 
 
 
@@ -466,46 +818,76 @@ import select
 
 
 
-def monitor_sv_health():
-    global sv_health, mmxu_measurements
-    while True:
-        with mode_lock:
-            if current_mode != "active":
-                time.sleep(1)
-                continue
+def update_sv_health():
+    global sv_busy_seen, sv_counts_seen
+    rate = sv_health["packet_count"]
+    sv_window.append(rate)
+    avg_rate = sum(sv_window) / len(sv_window)
 
-        rate = sv_health["packet_count"]
-        sv_window.append(rate)
-        avg_rate = sum(sv_window) / len(sv_window)
+    sv_health["rate_hz"] = round(avg_rate, 1)
+    sv_health["packet_count"] = 0
 
-        sv_health["rate_hz"] = round(avg_rate, 1)
-        sv_health["packet_count"] = 0
+    # SV handler time over the last second, in total and per sample taken
+    busy = loop.stats["sv"].busy
+    cpu, sv_busy_seen = busy - sv_busy_seen, busy
+    sv_health["cpu_pct"] = round(cpu * 100, 2)
+    sv_health["cpu_us_per_sample"] = round(cpu * 1e6 / rate, 2) if rate else 0
 
-        if avg_rate == 0:
-            sv_health["quality"] = "LOST"
-        elif avg_rate < 5:
-            sv_health["quality"] = "LATE"
-        else:
-            sv_health["quality"] = "GOOD"
+    counts = (sv_supervisor.received, sv_supervisor.duplicate, sv_supervisor.lost)
+    received, duplicate, lost = (n - seen for n, seen in zip(counts, sv_counts_seen))
+    sv_counts_seen = counts
+    sv_health["lost"] = lost
+    if received == 0:
+        sv_health["quality"] = "LOST"
+    elif lost > SV_EXPECTED_RATE * SV_LATE_LOSS_PCT / 100 \
+            or received - duplicate < SV_EXPECTED_RATE * SV_LATE_RATE_PCT / 100:
+        sv_health["quality"] = "LATE"
+    else:
+        sv_health["quality"] = "GOOD"
+
+    values = {f"LLN0.sv.{k}": v for k, v in sv_health.items()}
+    # The samples counted over the last second rather than the running count
+    values["LLN0.sv.packet_count"] = rate
+    datamodel.update(values)
 
-        print(f"[IED] SV Health: {sv_health['quality']} ({avg_rate:.1f} Hz)")
-        time.sleep(1)
+    print(f"[IED] SV Health: {sv_health['quality']} ({avg_rate:.1f} Hz, {lost} lost, "
+          f"{sv_health['cpu_pct']}% CPU, {sv_health['cpu_us_per_sample']} us/sample)")
 
 
 
 
 def start_ied_threads():
+    global mms_sock, command_sock
     log_system_event(f"[IED] Starting in {IED_MODE.upper()} mode")
     log_debug(f"{os.getenv('HOSTNAME')} STARTUP — MODE = {IED_MODE}")
 
     if IED_MODE == "active":
-        threading.Thread(target=listen_goose, daemon=True).start()
-        threading.Thread(target=poll_breaker_status, daemon=True).start()
-        threading.Thread(target=listen_for_sv, daemon=True).start()
-        threading.Thread(target=monitor_sv_health, daemon=True).start()
-        threading.Thread(target=mms_listener, daemon=True).start()
-        threading.Thread(target=write_mms_to_file, daemon=True).start()
-        threading.Thread(target=listen_for_commands, daemon=True).start()
+        loop.add_datagram_handler("goose", open_udp_socket(GOOSE_PORT, GOOSE_GROUP), handle_goose, 1024)
+        print(f"[IED] Listening for GOOSE messages on {GOOSE_GROUP}:{GOOSE_PORT}")
+        loop.add_datagram_handler("sv", open_udp_socket(MERGING_UNIT_PORT, SV_GROUP), handle_sv)
+        print(f"[IED] Listening for Sampled Values {SV_ID} on {SV_GROUP}:{MERGING_UNIT_PORT}")
+        mms_sock = open_udp_socket(MMS_PORT)
+        loop.add_datagram_handler("mms", mms_sock, handle_mms, 4096)
+        print(f"[IED] Listening for simulated MMS messages on UDP {MMS_PORT}")
+        command_sock = open_udp_socket(IED1_UDP_PORT)
+        loop.add_datagram_handler("command", command_sock, handle_command, 1024)
+        print(f"[IED1] Listening for TRIP/RESET on UDP port {IED1_UDP_PORT}")
+        loop.call_every(1.0, "sv_health", update_sv_health)
+        loop.call_every(1.5, "mms_snapshot", write_mms_snapshot)
+        loop.call_every(ENERGY_CHECKPOINT_S, "energy_checkpoint", energy.checkpoint)
+        loop.call_every(0.1, "control_timeouts", breaker_control.poll)
+        loop.add_datagram_handler("breaker_pos", open_udp_socket(BREAKER_POS_PORT, BREAKER_POS_GROUP), handle_breaker_position, 1024)
+        loop.call_every(1.0, "breaker_silence", check_breaker_silence)
+        loop.call_every(REPL_HEARTBEAT, "replication", replicate_state)
+        loop.add_datagram_handler("replication", open_udp_socket(REPL_PORT, REPL_GROUP), handle_replication, 4096)
+        loop.call_every(PEER_CHECK, "listen_watch", check_listen)
+
+        # Only the blocking HTTP work keeps threads of its own
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        threading.Thread(target=forward_logs, daemon=True).start()
+        threading.Thread(target=recorder.run_writer, daemon=True).start()
+        threading.Thread(target=power_quality.run, daemon=True).start()
+        threading.Thread(target=mms_server.run, daemon=True).start()
 
 
 
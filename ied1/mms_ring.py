@@ -0,0 +1,241 @@
+"""
+Shared Memory MMS Snapshot Ring
+
+Author: Zein Ali
+Date: 30/07/2025
+
+The control IEDs publish their MMS status (XCBR1 position, SV health,
+MMXU1) to SCADA through a file in /app/shared. Rather than a JSON list
+that is re-read, appended and rewritten on every update, the file is a
+fixed size ring of binary records mapped into memory by both sides:
+
+    header  magic "MMSR" | version | slots | slot size | records written
+    slot    sequence number | one SNAPSHOT record
+
+Writing is O(1): the IED sets the slot's sequence number odd, fills the
+record, sets it even and then advances the record count. A reader takes
+the newest slot from the count and keeps its copy only if the sequence
+number was even and unchanged across it (a seqlock), so it never sees a
+half written record and never holds up the writer.
+
+A restarted IED creates a fresh file and renames it into place; readers
+notice the new inode and map it again.
+"""
+import math
+import mmap
+import os
+import struct
+import threading
+
+
+MAGIC = b"MMSR"
+VERSION = 1
+
+HEADER = struct.Struct("<4sHHIQ")
+HEADER_SIZE = 64
+COUNT = struct.Struct("<Q")
+COUNT_OFFSET = 12
+SEQ = struct.Struct("<Q")
+
+# History kept in the ring, as the JSON file used to keep
+SLOTS = 100
+
+# Attempts at a consistent copy before a read gives up
+read_retries = 10
+
+MMXU_FIELDS = ("Ua", "Ub", "Uc", "Ia", "Ib", "Ic",
+               "UaAng", "UbAng", "UcAng", "IaAng", "IbAng", "IcAng",
+               "Freq", "P", "Q", "PF")
+
+# timestamp, ln, Pos.stVal, Pos.ctlVal, mode and SV quality as fixed width
+# text, then SV rate, last sample time, CPU % and CPU us/sample, then the
+# MMXU1 values (NaN for one not measured yet)
+SNAPSHOT = struct.Struct("<32s8s12s12s12s12s4d%dd" % len(MMXU_FIELDS))
+SLOT_SIZE = SEQ.size + SNAPSHOT.size + (-(SEQ.size + SNAPSHOT.size) % 8)
+
+PHASES = ("phsA", "phsB", "phsC")
+
+
+def _text(value, size):
+    return str(value if value is not None else "").encode()[:size]
+
+
+def _str(raw):
+    return raw.rstrip(b"\0").decode(errors="replace")
+
+
+def _num(value):
+    return float("nan") if value is None else float(value)
+
+
+def _opt(x):
+    return None if math.isnan(x) else x
+
+
+def pack_status(status):
+    """Flatten an IED MMS status (the dict served at /mms/status) into a record"""
+    pos = status.get("Pos", {})
+    sv = status.get("sv", {})
+    mmxu = status.get("MMXU1", {})
+    flat = {}
+    for prefix, group in (("U", "PhV"), ("I", "A")):
+        for phs in PHASES:
+            cval = mmxu.get(group, {}).get(phs, {})
+            name = prefix + phs[-1].lower()
+            flat[name] = cval.get("mag", {}).get("f")
+            flat[name + "Ang"] = cval.get("ang", {}).get("f")
+    flat["Freq"] = mmxu.get("Freq")
+    flat["P"] = mmxu.get("TotW", {}).get("mag", {}).get("f")
+    flat["Q"] = mmxu.get("TotVAr", {}).get("mag", {}).get("f")
+    flat["PF"] = mmxu.get("TotPF", {}).get("mag", {}).get("f")
+
+    return SNAPSHOT.pack(
+        _text(status.get("timestamp"), 32), _text(status.get("ln"), 8),
+        _text(pos.get("stVal"), 12), _text(pos.get("ctlVal"), 12),
+        _text(status.get("mode"), 12), _text(sv.get("quality"), 12),
+        _num(sv.get("rate_hz")), _num(sv.get("last_sample_time")),
+        _num(sv.get("cpu_pct")), _num(sv.get("cpu_us_per_sample")),
+        *(_num(flat[k]) for k in MMXU_FIELDS)
+    )
+
+
+def unpack_status(record):
+    """Rebuild the nested MMS status from a record"""
+    fields = SNAPSHOT.unpack(record)
+    timestamp, ln, st_val, ctl_val, mode, quality = (_str(f) for f in fields[:6])
+    rate, last_sample, cpu_pct, cpu_us = (_opt(f) for f in fields[6:10])
+    m = dict(zip(MMXU_FIELDS, (_opt(f) for f in fields[10:])))
+
+    def cval(name):
+        return {"mag": {"f": m[name]}, "ang": {"f": m[name + "Ang"]}}
+
+    return {
+        "timestamp": timestamp,
+        "ln": ln,
+        "Pos": {"stVal": st_val, "ctlVal": ctl_val},
+        "sv": {"quality": quality, "rate_hz": rate, "last_sample_time": last_sample,
+               "cpu_pct": cpu_pct, "cpu_us_per_sample": cpu_us},
+        "mode": mode,
+        "MMXU1": {
+            "PhV": {phs: cval("U" + phs[-1].lower()) for phs in PHASES},
+            "A": {phs: cval("I" + phs[-1].lower()) for phs in PHASES},
+            "TotW": {"mag": {"f": m["P"]}},
+            "TotVAr": {"mag": {"f": m["Q"]}},
+            "TotPF": {"mag": {"f": m["PF"]}},
+            "Freq": m["Freq"]
+        }
+    }
+
+
+class RingWriter:
+    """Writer side, owned by one IED"""
+
+    def __init__(self, path, slots=SLOTS):
+        self.path = path
+        self.slots = slots
+        self.file = self.map = self.inode = None
+        self.create()
+
+    def create(self):
+        """Start an empty ring. It is built beside the old one and swapped
+        in whole, so a reader never maps a file still being laid out.
+        """
+        self.close()
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.slots, SLOT_SIZE, 0).ljust(HEADER_SIZE, b"\0"))
+            f.write(b"\0" * (self.slots * SLOT_SIZE))
+        os.replace(tmp, self.path)
+        self.file = open(self.path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), HEADER_SIZE + self.slots * SLOT_SIZE)
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.count = 0
+
+    def write(self, status):
+        # SCADA removes the file of an IED it cannot reach; start over
+        # rather than keep writing to a file nobody can open
+        try:
+            if os.stat(self.path).st_ino != self.inode:
+                self.create()
+        except FileNotFoundError:
+            self.create()
+
+        n = self.count
+        off = HEADER_SIZE + (n % self.slots) * SLOT_SIZE
+        SEQ.pack_into(self.map, off, 2 * n + 1)
+        self.map[off + SEQ.size:off + SEQ.size + SNAPSHOT.size] = pack_status(status)
+        SEQ.pack_into(self.map, off, 2 * n + 2)
+        self.count = n + 1
+        COUNT.pack_into(self.map, COUNT_OFFSET, self.count)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+        self.file = self.map = self.inode = None
+
+
+class RingReader:
+    """Reader side; latest() returns the newest status or None. Safe to
+    share between threads, which only hold the lock for the copy.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.map = None
+        self.inode = None
+        self.slots = 0
+
+    def _open(self):
+        """Map the ring, again if the IED has replaced it; False if there is none"""
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            self.close()
+            return False
+        if inode == self.inode:
+            return True
+        self.close()
+        f = open(self.path, "rb")
+        header = f.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            f.close()
+            return False
+        magic, version, slots, slot_size, _ = HEADER.unpack_from(header)
+        if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE:
+            f.close()
+            raise ValueError(f"{self.path} is not a version {VERSION} MMS ring")
+        self.file = f
+        self.map = mmap.mmap(f.fileno(), HEADER_SIZE + slots * slot_size, access=mmap.ACCESS_READ)
+        self.inode = os.fstat(f.fileno()).st_ino
+        self.slots = slots
+        return True
+
+    def latest(self):
+        with self.lock:
+            return self._latest()
+
+    def _latest(self):
+        if not self._open():
+            return None
+        for _ in range(read_retries):
+            count = COUNT.unpack_from(self.map, COUNT_OFFSET)[0]
+            if count == 0:
+                return None
+            off = HEADER_SIZE + ((count - 1) % self.slots) * SLOT_SIZE
+            seq = SEQ.unpack_from(self.map, off)[0]
+            if seq != 2 * count:
+                # The writer has moved on into this slot; try the new newest
+                continue
+            record = self.map[off + SEQ.size:off + SEQ.size + SNAPSHOT.size]
+            if SEQ.unpack_from(self.map, off)[0] == seq:
+                return unpack_status(record)
+        return None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+        self.file = self.map = self.inode = None
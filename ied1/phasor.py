@@ -0,0 +1,113 @@
+"""
+Phasor Estimation
+
+Author: Zein Ali
+Date: 28/07/2025
+
+Turns a Sampled Values stream into MMXU measurements. The stream keeps a
+one cycle ring buffer of its six channels, slot smpCnt % N, and slides
+the one cycle DFT at the fundamental along with it:
+
+    X = sum over the last N samples of x[n] * exp(-j 2 pi n / N)
+
+A new sample replaces the one a cycle older in the same slot, so X moves
+by (new - old) * exp(-j 2 pi n / N). A whole SV frame is applied as one
+small matrix product, and X is rebuilt from the ring once per cycle so
+rounding errors never build up.
+
+Because n counts absolute samples, X stands still at nominal frequency
+and turns at 2 pi (f - f0) rad/s away from it, which gives the frequency.
+"""
+import math
+import numpy as np
+
+
+A_OP = np.exp(2j * math.pi / 3)
+
+# Channel order of SvBatch.values
+IA, IB, IC, UA, UB, UC = range(6)
+
+# Slowest measurement interval the frequency is worked out over; beyond
+# this the positive sequence angle may have turned more than half a turn
+max_freq_interval = 0.5
+
+
+class PhasorEstimator:
+    """Sliding one cycle DFT over one SV stream.
+
+    update() takes each decoded frame; measure() returns RMS magnitudes,
+    angles referenced to Ua, frequency and three phase P, Q and PF.
+    """
+
+    def __init__(self, spc, nominal_freq=50.0):
+        self.n = spc
+        self.f0 = nominal_freq
+        self.wrap = int(round(nominal_freq * spc))
+        self.twiddle = np.exp(-2j * np.pi * np.arange(spc) / spc)
+        self.ring = np.zeros((spc, 6))
+        self.acc = np.zeros(6, dtype=complex)
+        self.filled = 0
+        self.since_rebuild = 0
+
+        # Absolute sample count, following smpCnt across its wraps
+        self.last_cnt = None
+        self.samples = 0
+        self.last_v1 = None
+        self.freq = None
+
+    def update(self, smp_cnts, values):
+        """Slide the DFT over one frame: smpCnts and an (k, 6) sample array"""
+        cnts = np.asarray(smp_cnts)
+        slots = cnts % self.n
+        self.acc += self.twiddle[slots] @ (values - self.ring[slots])
+        self.ring[slots] = values
+
+        last = int(cnts[-1])
+        if self.last_cnt is not None:
+            step = (last - self.last_cnt) % self.wrap
+            # A step of more than half the wrap is an old or repeated frame
+            if step < self.wrap // 2:
+                self.samples += step
+                self.last_cnt = last
+        else:
+            self.last_cnt = last
+
+        self.filled = min(self.filled + len(cnts), self.n)
+        self.since_rebuild += len(cnts)
+        if self.since_rebuild >= self.n:
+            self.acc = self.twiddle @ self.ring
+            self.since_rebuild = 0
+
+    def measure(self):
+        """MMXU values, or None until a full cycle has arrived"""
+        if self.filled < self.n:
+            return None
+        ph = self.acc * (math.sqrt(2) / self.n)
+        volts, currs = ph[UA:UC + 1], ph[IA:IC + 1]
+        power = volts * np.conj(currs)
+        p, q = float(power.real.sum()), float(power.imag.sum())
+        s = math.hypot(p, q)
+
+        # Frequency from how far the positive sequence voltage turned
+        v1 = (volts[0] + A_OP * volts[1] + A_OP ** 2 * volts[2]) / 3
+        if abs(v1) > 1e-6:
+            if self.last_v1 is not None:
+                dt = (self.samples - self.last_v1[0]) / (self.f0 * self.n)
+                if 0 < dt <= max_freq_interval:
+                    turn = math.remainder(np.angle(v1) - self.last_v1[1], 2 * math.pi)
+                    self.freq = self.f0 + turn / (2 * math.pi * dt)
+            self.last_v1 = (self.samples, float(np.angle(v1)))
+
+        ref = np.angle(ph[UA])
+        angles = np.degrees(np.angle(ph * np.exp(-1j * ref)))
+        result = {}
+        for k, name in enumerate(("Ia", "Ib", "Ic", "Ua", "Ub", "Uc")):
+            result[name] = round(float(abs(ph[k])), 2)
+            result[name + "Ang"] = round(float(angles[k]), 2) + 0.0
+        result.update({
+            "Freq": round(self.freq, 3) if self.freq is not None else None,
+            "P": round(p, 1),
+            "Q": round(q, 1),
+            "PF": round(p / s, 3) if s else None
+        })
+        return result
@@ -0,0 +1,189 @@
+"""
+SV Stream Supervision
+
+Author: Zein Ali
+Date: 08/08/2025
+
+Follows each subscribed SV stream sample by sample from its smpCnt, which
+counts up once per sample and wraps at samples per cycle times the
+nominal frequency (4000 for 80 samples a cycle at 50 Hz):
+
+    one on from the last     in order
+    more than one on         the samples in between are lost
+    one seen recently        duplicate
+    behind, not yet seen     out of order; no longer lost
+    far behind               publisher restarted; followed from there
+
+Recently seen counts are kept in a small ring, so every check is O(1)
+and a late sample can be told from a repeated one. Per frame, two
+histograms are kept: arrival jitter (how far the gap since the last
+frame is from what the smpCnt step says it should be) and latency (from
+the newest sample's refrTm to arrival, for streams that carry one).
+"""
+import time
+
+
+# Window of recent samples a late or repeated one is checked against
+RECENT = 256
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram:
+    """HDR-style histogram of non-negative integers (microseconds).
+
+    Values below 2**sub_bits have a bucket each; above that every power of
+    two is split into 2**(sub_bits - 1) buckets, so a value is recorded
+    to within 2**(1 - sub_bits) of itself (under 1.6%) in O(1), over a
+    range up to 2**max_bits.
+    """
+
+    __slots__ = ("sub_bits", "max_value", "counts", "count", "total", "max")
+
+    def __init__(self, sub_bits=7, max_bits=24):
+        self.sub_bits = sub_bits
+        self.max_value = (1 << max_bits) - 1
+        self.counts = [0] * self.index(self.max_value) + [0]
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def index(self, v):
+        shift = v.bit_length() - self.sub_bits
+        if shift <= 0:
+            return v
+        half = 1 << (self.sub_bits - 1)
+        return (1 << self.sub_bits) + (shift - 1) * half + (v >> shift) - half
+
+    def value_at(self, i):
+        """Highest value that lands in bucket i"""
+        size = 1 << self.sub_bits
+        if i < size:
+            return i
+        half = size >> 1
+        shift = (i - size) // half + 1
+        return (((i - size) % half + half + 1) << shift) - 1
+
+    def record(self, v):
+        v = min(max(int(v), 0), self.max_value)
+        self.counts[self.index(v)] += 1
+        self.count += 1
+        self.total += v
+        if v > self.max:
+            self.max = v
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        rank = max(1, -int(-self.count * p // 100))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.value_at(i), self.max)
+        return self.max
+
+    def as_dict(self):
+        out = {f"p{p:g}": self.percentile(p) for p in PERCENTILES}
+        out.update({
+            "count": self.count,
+            "mean": round(self.total / self.count, 1) if self.count else 0,
+            "max": self.max
+        })
+        return out
+
+
+class StreamSupervisor:
+    """Sequence, jitter and latency statistics of one svID"""
+
+    __slots__ = ("wrap", "period", "last", "abs_cnt", "base", "recent", "last_arrival",
+                 "received", "lost", "duplicate", "out_of_order", "resyncs",
+                 "jitter", "latency", "latency_negative")
+
+    def __init__(self, spc, nominal_hz=50.0):
+        self.wrap = int(round(spc * nominal_hz))
+        self.period = 1.0 / (spc * nominal_hz)
+        self.last = None
+        # smpCnt extended past its wrap, where it was last (re)started, and
+        # the last RECENT of them seen
+        self.abs_cnt = 0
+        self.base = 0
+        self.recent = [-1] * RECENT
+        self.last_arrival = None
+        self.received = 0
+        self.lost = 0
+        self.duplicate = 0
+        self.out_of_order = 0
+        self.resyncs = 0
+        self.jitter = Histogram()
+        self.latency = Histogram()
+        self.latency_negative = 0
+
+    def sample(self, cnt):
+        """Account for one sample; returns how far it moved the stream on"""
+        self.received += 1
+        if self.last is None:
+            self.last = cnt
+            self.recent[0] = 0
+            return 0
+        step = (cnt - self.last) % self.wrap
+        if 0 < step <= self.wrap // 2:
+            self.lost += step - 1
+            self.last = cnt
+            self.abs_cnt += step
+            self.recent[self.abs_cnt % RECENT] = self.abs_cnt
+            return step
+        behind = self.wrap - step if step else 0
+        n = self.abs_cnt - behind
+        if behind >= RECENT:
+            # Too far back to be late: start again from here
+            self.resyncs += 1
+            self.last = cnt
+            self.abs_cnt += RECENT
+            self.base = self.abs_cnt
+            self.recent[self.abs_cnt % RECENT] = self.abs_cnt
+        elif self.recent[n % RECENT] == n:
+            self.duplicate += 1
+        else:
+            self.out_of_order += 1
+            # Counted lost when the stream moved past it, unless it is from
+            # before the stream was first (or again) followed
+            if n > self.base:
+                self.lost -= 1
+                self.recent[n % RECENT] = n
+        return 0
+
+    def frame(self, smp_cnts, stamps, arrival=None):
+        """Account for one frame: its samples, then its timing"""
+        if arrival is None:
+            arrival = time.time()
+        step = 0
+        for cnt in smp_cnts:
+            step += self.sample(cnt)
+
+        if self.last_arrival is not None and step:
+            expected = step * self.period
+            self.jitter.record(abs(arrival - self.last_arrival - expected) * 1e6)
+        self.last_arrival = arrival
+
+        stamp = stamps[-1] if stamps else None
+        if isinstance(stamp, float) and stamp > 0:
+            latency = arrival - stamp
+            if latency < 0:
+                self.latency_negative += 1
+            self.latency.record(latency * 1e6)
+
+    def as_dict(self):
+        expected = self.received - self.duplicate + self.lost
+        return {
+            "received": self.received,
+            "lost": self.lost,
+            "duplicate": self.duplicate,
+            "outOfOrder": self.out_of_order,
+            "resyncs": self.resyncs,
+            "lossPct": round(100 * self.lost / expected, 4) if expected else 0,
+            "lastSmpCnt": self.last,
+            "jitterUs": self.jitter.as_dict(),
+            "latencyUs": self.latency.as_dict(),
+            "latencyNegative": self.latency_negative
+        }
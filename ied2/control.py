@@ -0,0 +1,355 @@
+"""
+Controls and Interlocking
+
+Author: Zein Ali
+Date: 13/08/2025
+
+Select-before-operate with enhanced security (IEC 61850-7-2) for the
+breaker position, XCBR1.Pos, and the interlocking (CILO1) it is checked
+against.
+
+A client selects the breaker for one ctlVal (SBOw), then operates it
+with the same ctlVal and ctlNum (Oper) before the select timeout runs
+out, or cancels (Cancel). While it is selected, nobody else may select
+or operate it. Once operated, the command is in execution until the
+position in the data model reaches the one commanded, when a positive
+command termination is sent to the client, or until the operate timeout,
+when a negative one is. A refused request is answered with its
+AddCause, e.g. Blocked-by-interlocking or Locked-by-other-client.
+
+Protection trips (GOOSE) are direct operates: they need no select, are
+never interlocked, and abort whatever selection or command is under way.
+
+Interlocking rules are expressions over data model paths, e.g.
+
+    not LLN0.fault and LLN0.sv.quality == "GOOD"
+
+compiled once into functions that read the model's value slots
+directly, so a check costs a few hundred nanoseconds. CILO1.EnaOpn and
+CILO1.EnaCls in the model follow the rules as the values they read
+change.
+
+Requests from SCADA, the RTU and GOOSE arrive on different threads. Each
+is decided under one lock, in order of arrival, against the model as it
+stands, and the commands accepted are executed in the same order. Every
+decision is timed.
+"""
+import ast
+import threading
+import time
+from collections import deque
+
+from sv_supervision import Histogram
+
+
+CTL_MODELS = ("direct-with-enhanced-security", "sbo-with-enhanced-security")
+
+# ctlVal -> position it commands and the interlock that must allow it
+TARGETS = {"TRIP": ("OPEN", "EnaOpn"), "RESET": ("CLOSED", "EnaCls")}
+
+SERVICES = ("select", "operate", "cancel", "direct")
+
+# Expression nodes an interlocking rule may use, besides data model paths
+_ALLOWED = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not,
+            ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+            ast.In, ast.NotIn, ast.Constant, ast.Tuple, ast.Load)
+
+
+def is_protection(role, prefixes):
+    """Whether a GOOSE publisher is a protection IED, by the prefix of its
+    role: P-IED matches the P-IED1 and P-IED2 that the P-IEDs send
+    """
+    return bool(role) and role.startswith(tuple(prefixes))
+
+
+class _RuleCompiler(ast.NodeTransformer):
+    """Turns the paths in a rule into reads of the model's value slots"""
+
+    def __init__(self, model):
+        self.model = model
+        self.paths = set()
+
+    def _slot(self, node):
+        parts = []
+        while isinstance(node, ast.Attribute):
+            parts.append(node.attr)
+            node = node.value
+        if not isinstance(node, ast.Name):
+            raise ValueError("only data model paths may be read")
+        path = ".".join([node.id] + parts[::-1])
+        slot = self.model.resolve(path)
+        if slot is None:
+            raise ValueError(f"no attribute {path} in the model")
+        self.paths.add(path)
+        return ast.Subscript(value=ast.Name(id="v", ctx=ast.Load()), slice=ast.Constant(slot), ctx=ast.Load())
+
+    visit_Attribute = _slot
+    visit_Name = _slot
+
+    def generic_visit(self, node):
+        if not isinstance(node, _ALLOWED):
+            raise ValueError(f"{type(node).__name__} is not allowed")
+        return super().generic_visit(node)
+
+
+def compile_rule(expr, model):
+    """(predicate over the model's value list, paths it reads)"""
+    compiler = _RuleCompiler(model)
+    tree = compiler.visit(ast.parse(expr, mode="eval"))
+    body = ast.Expression(ast.Lambda(
+        args=ast.arguments(posonlyargs=[], args=[ast.arg(arg="v")], kwonlyargs=[],
+                           kw_defaults=[], defaults=[]),
+        body=tree.body))
+    code = compile(ast.fix_missing_locations(body), f"<interlock {expr}>", "eval")
+    return eval(code, {"__builtins__": {}}), frozenset(compiler.paths)
+
+
+class Interlocks:
+    """CILO: compiled rules, and their results kept in the model"""
+
+    def __init__(self, model, rules, ln="CILO1"):
+        self.model = model
+        self.ln = ln
+        self.rules = {}
+        for name, expr in rules.items():
+            try:
+                fn, paths = compile_rule(expr, model)
+            except (SyntaxError, ValueError) as e:
+                raise ValueError(f"{ln}.{name}: {e}") from None
+            self.rules[name] = (expr, fn, paths)
+        self.evaluations = 0
+        model.watch(self.changed)
+
+    def check(self, name):
+        """Evaluate one rule against the model as it stands"""
+        fn = self.rules[name][1]
+        with self.model.lock:
+            self.evaluations += 1
+            return bool(fn(self.model.values))
+
+    def changed(self, changes):
+        """Model watcher: re-evaluate the rules that read a changed path"""
+        out = {f"{self.ln}.{name}.stVal": self.check(name)
+               for name, (_, _, paths) in self.rules.items()
+               if paths.intersection(changes)}
+        if out:
+            self.model.update(out)
+
+    def refresh(self):
+        self.model.update({f"{self.ln}.{name}.stVal": self.check(name) for name in self.rules})
+
+    def as_dict(self):
+        return {name: {"rule": expr, "reads": sorted(paths)}
+                for name, (expr, _, paths) in self.rules.items()}
+
+
+class Command:
+    __slots__ = ("origin", "ctl_val", "ctl_num", "reply", "deadline")
+
+    def __init__(self, origin, ctl_val, ctl_num, reply, deadline):
+        self.origin = origin
+        self.ctl_val = ctl_val
+        self.ctl_num = ctl_num
+        self.reply = reply
+        self.deadline = deadline
+
+
+class ControlObject:
+    def __init__(self, model, ref, interlocks, execute, blocked=None,
+                 ctl_model="sbo-with-enhanced-security", sbo_timeout=30.0, oper_timeout=2.0):
+        """execute(ctl_val, origin) carries out an accepted command. blocked(ctl_val)
+        returns an AddCause if the IED cannot take commands at all (e.g.
+        Blocked-by-Mode), or None.
+        """
+        if ctl_model not in CTL_MODELS:
+            raise ValueError(f"unsupported ctlModel {ctl_model}")
+        self.model = model
+        self.ref = ref
+        self.interlocks = interlocks
+        self.execute = execute
+        self.blocked = blocked
+        self.ctl_model = ctl_model
+        self.sbo_timeout = sbo_timeout
+        self.oper_timeout = oper_timeout
+
+        # Reentrant: an execution run inline writes to the model, whose
+        # watcher comes back here
+        self.lock = threading.RLock()
+        self.selected = None
+        self.executing = None
+        self.seq = 0
+        self.decision_ns = {service: Histogram() for service in SERVICES}
+        self.results = {}
+        self.decisions = deque(maxlen=50)
+        model.watch(self.changed)
+
+    def request(self, service, origin, ctl_val=None, ctl_num=None, reply=None, protection=False):
+        """Decide a control request; (accepted, AddCause). origin names the
+        client, and reply(msg) gets the command termination of an accepted
+        operate
+        """
+        start = time.perf_counter_ns()
+        terminations = []
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+            self._expire(time.monotonic(), terminations)
+            if service == "select":
+                cause = self._select(origin, ctl_val, ctl_num)
+            elif service == "operate":
+                cause = self._operate(origin, ctl_val, ctl_num, reply)
+            elif service == "cancel":
+                cause = self._cancel(origin)
+            elif service == "direct":
+                cause = self._direct(origin, ctl_val, ctl_num, reply, protection, terminations)
+            else:
+                cause = "Not-supported"
+            accepted = cause is None
+            selected = self.selected is not None
+            elapsed = time.perf_counter_ns() - start
+            self.decision_ns[service if service in SERVICES else "direct"].record(elapsed)
+            key = f"{service}:{'accepted' if accepted else cause}"
+            self.results[key] = self.results.get(key, 0) + 1
+            self.decisions.append({"seq": seq, "time": time.time(), "service": service, "origin": origin,
+                                   "ctlVal": ctl_val, "ctlNum": ctl_num, "accepted": accepted,
+                                   "addCause": cause, "decisionUs": round(elapsed / 1e3, 1)})
+            # Still under the lock, so commands run in the order decided
+            if accepted and service in ("operate", "direct"):
+                self.execute(ctl_val, origin)
+        self.model.set(f"{self.ref}.stSeld", selected)
+        self._terminate(terminations)
+        return accepted, cause
+
+    def _check(self, ctl_val, interlock=True):
+        """Why ctl_val may not be carried out now, or None"""
+        if ctl_val not in TARGETS:
+            return "Inconsistent-parameters"
+        if self.blocked:
+            cause = self.blocked(ctl_val)
+            if cause:
+                return cause
+        position, rule = TARGETS[ctl_val]
+        if self.model.get(f"{self.ref}.stVal") == position:
+            return "Position-reached"
+        if interlock and rule in self.interlocks.rules and not self.interlocks.check(rule):
+            return "Blocked-by-interlocking"
+        return None
+
+    def _select(self, origin, ctl_val, ctl_num):
+        if self.ctl_model != "sbo-with-enhanced-security":
+            return "Not-supported"
+        if self.executing is not None:
+            return "Command-already-in-execution"
+        if self.selected is not None:
+            return "Object-already-selected" if self.selected.origin == origin else "Locked-by-other-client"
+        cause = self._check(ctl_val)
+        if cause is None:
+            self.selected = Command(origin, ctl_val, ctl_num, None, time.monotonic() + self.sbo_timeout)
+        return cause
+
+    def _operate(self, origin, ctl_val, ctl_num, reply):
+        if self.executing is not None:
+            return "Command-already-in-execution"
+        if self.ctl_model == "sbo-with-enhanced-security":
+            if self.selected is None:
+                return "Object-not-selected"
+            if self.selected.origin != origin:
+                return "Locked-by-other-client"
+            if (self.selected.ctl_val, self.selected.ctl_num) != (ctl_val, ctl_num):
+                return "Inconsistent-parameters"
+            # An operate ends the selection, whether it is accepted or not
+            self.selected = None
+        cause = self._check(ctl_val)
+        if cause is None:
+            self.executing = Command(origin, ctl_val, ctl_num, reply, time.monotonic() + self.oper_timeout)
+        return cause
+
+    def _cancel(self, origin):
+        if self.executing is not None:
+            return "Command-already-in-execution"
+        if self.selected is None:
+            return "Object-not-selected"
+        if self.selected.origin != origin:
+            return "Locked-by-other-client"
+        self.selected = None
+        return None
+
+    def _direct(self, origin, ctl_val, ctl_num, reply, protection, terminations):
+        if protection and ctl_val == "TRIP":
+            cause = self._check(ctl_val, interlock=False)
+            if cause is None:
+                self.selected = None
+                if self.executing is not None:
+                    terminations.append((self.executing, "Abortion-by-trip"))
+                self.executing = Command(origin, ctl_val, ctl_num, reply, time.monotonic() + self.oper_timeout)
+            return cause
+        if self.executing is not None:
+            return "Command-already-in-execution"
+        if self.selected is not None:
+            return "Locked-by-other-client"
+        cause = self._check(ctl_val)
+        if cause is None:
+            self.executing = Command(origin, ctl_val, ctl_num, reply, time.monotonic() + self.oper_timeout)
+        return cause
+
+    def _expire(self, now, terminations):
+        if self.selected is not None and now >= self.selected.deadline:
+            self.selected = None
+            self.results["select:timeout"] = self.results.get("select:timeout", 0) + 1
+        if self.executing is not None and now >= self.executing.deadline:
+            terminations.append((self.executing, "Time-limit-over"))
+            self.executing = None
+
+    def poll(self):
+        """Run the select and operate timeouts; called periodically"""
+        terminations = []
+        with self.lock:
+            self._expire(time.monotonic(), terminations)
+            selected = self.selected is not None
+        self.model.set(f"{self.ref}.stSeld", selected)
+        self._terminate(terminations)
+
+    def changed(self, changes):
+        """Model watcher: a command ends when the position reaches its target"""
+        position = changes.get(f"{self.ref}.stVal")
+        if position is None:
+            return
+        terminations = []
+        with self.lock:
+            cmd = self.executing
+            if cmd is not None and TARGETS[cmd.ctl_val][0] == position:
+                terminations.append((cmd, None))
+                self.executing = None
+        self._terminate(terminations)
+
+    def _terminate(self, terminations):
+        for cmd, cause in terminations:
+            key = f"cmdTerm:{'positive' if cause is None else cause}"
+            self.results[key] = self.results.get(key, 0) + 1
+            if cmd.reply is None:
+                continue
+            try:
+                cmd.reply({"cmdTerm": self.ref, "ctlVal": cmd.ctl_val, "ctlNum": cmd.ctl_num,
+                           "ok": cause is None, "addCause": cause})
+            except Exception as e:
+                print(f"[CTL] Command termination to {cmd.origin} failed: {e}")
+
+    def counters(self):
+        with self.lock:
+            selected = self.selected
+            executing = self.executing
+            return {
+                "ref": self.ref,
+                "ctlModel": self.ctl_model,
+                "sboTimeoutMs": int(self.sbo_timeout * 1000),
+                "operTimeoutMs": int(self.oper_timeout * 1000),
+                "selected": {"origin": selected.origin, "ctlVal": selected.ctl_val, "ctlNum": selected.ctl_num,
+                             "remainingMs": round((selected.deadline - time.monotonic()) * 1000)}
+                            if selected else None,
+                "executing": {"origin": executing.origin, "ctlVal": executing.ctl_val, "ctlNum": executing.ctl_num}
+                             if executing else None,
+                "requests": self.seq,
+                "results": dict(self.results),
+                "decisionNs": {service: h.as_dict() for service, h in self.decision_ns.items() if h.count},
+                "recent": list(self.decisions)[-10:]
+            }
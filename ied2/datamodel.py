@@ -0,0 +1,159 @@
+"""
+IEC 61850 Data Model
+
+Author: Zein Ali
+Date: 07/08/2025
+
+The IED's logical device held as a tree of logical nodes, data objects
+and data attributes (LD/LN/DO/DA). Every attribute value sits in one flat
+list, and an index maps its path, e.g. "XCBR1.Pos.stVal", to its slot,
+so an MMS read or write is one lookup whatever the depth of the tree.
+
+A write that changes a value bumps the model version. The status served
+at /mms/status and written to the MMS ring is built and serialized once
+per version, and handed out unchanged until the next write, so polls
+from SCADA and the GUI neither rebuild it nor hold up the SV handler.
+Watchers are told of every attribute a write changes, which is what
+drives the MMS server's reports.
+"""
+import json
+import threading
+
+
+PHASES = ("phsA", "phsB", "phsC")
+
+# MMXU1 measurement (as the phasor estimator names it) -> model path
+MMXU_PATHS = {"Freq": "MMXU1.Freq", "P": "MMXU1.TotW.mag.f", "Q": "MMXU1.TotVAr.mag.f",
+              "PF": "MMXU1.TotPF.mag.f", "timestamp": "MMXU1.timestamp"}
+for _prefix, _do in (("U", "PhV"), ("I", "A")):
+    for _phs in PHASES:
+        _name = _prefix + _phs[-1].lower()
+        MMXU_PATHS[_name] = f"MMXU1.{_do}.{_phs}.mag.f"
+        MMXU_PATHS[_name + "Ang"] = f"MMXU1.{_do}.{_phs}.ang.f"
+
+
+def mmxu_template():
+    """MMXU1: RMS magnitudes with angles referenced to phase A voltage,
+    three phase totals and frequency, none measured yet
+    """
+    def cval():
+        return {"mag": {"f": None}, "ang": {"f": None}}
+
+    return {
+        "PhV": {phs: cval() for phs in PHASES},
+        "A": {phs: cval() for phs in PHASES},
+        "TotW": {"mag": {"f": None}},
+        "TotVAr": {"mag": {"f": None}},
+        "TotPF": {"mag": {"f": None}},
+        "Freq": None,
+        "timestamp": None
+    }
+
+
+def status_layout(tree):
+    """The MMS status as SCADA, the GUI and the MMS ring read it"""
+    return {
+        "timestamp": tree["LLN0"]["timestamp"],
+        "ln": "XCBR1",
+        "Pos": tree["XCBR1"]["Pos"],
+        "CILO1": tree.get("CILO1"),
+        "sv": tree["LLN0"]["sv"],
+        "mode": tree["LLN0"]["mode"],
+        "MMXU1": tree["MMXU1"],
+        "MHAI1": tree.get("MHAI1"),
+        "MSQI1": tree.get("MSQI1"),
+        "MMTR1": tree.get("MMTR1")
+    }
+
+
+class Node:
+    """LN, DO or DA. A leaf has the slot of its value, any other node children"""
+
+    __slots__ = ("name", "children", "slot")
+
+    def __init__(self, name):
+        self.name = name
+        self.children = None
+        self.slot = None
+
+
+class DataModel:
+    def __init__(self, name, template, layout=None):
+        """template is the tree as nested dicts, leaves holding initial values"""
+        self.name = name
+        self.values = []
+        self.index = {}
+        self.root = self._build(name, template, None)
+        self.layout = layout
+        self.version = 0
+        self.lock = threading.Lock()
+        # (version, status, serialized status) last built
+        self.cached = (-1, None, None)
+        self.builds = 0
+        self.watchers = []
+
+    def _build(self, name, template, path):
+        node = Node(name)
+        if isinstance(template, dict):
+            node.children = {child: self._build(child, sub, f"{path}.{child}" if path else child)
+                             for child, sub in template.items()}
+        else:
+            node.slot = len(self.values)
+            self.values.append(template)
+            self.index[path] = node.slot
+        return node
+
+    def resolve(self, path):
+        """Slot of an attribute path, or None if the model has no such attribute"""
+        return self.index.get(path)
+
+    def get(self, path):
+        return self.values[self.index[path]]
+
+    def set(self, path, value):
+        self.update({path: value})
+
+    def watch(self, fn):
+        """Call fn({path: value}) with the attributes each write changed. It
+        runs on the writing thread, so it must not block.
+        """
+        self.watchers.append(fn)
+
+    def update(self, values):
+        """Write attributes by path; the version moves on once if any changed"""
+        index = self.index
+        changes = {}
+        with self.lock:
+            for path, value in values.items():
+                slot = index[path]
+                if self.values[slot] != value:
+                    self.values[slot] = value
+                    changes[path] = value
+            if changes:
+                self.version += 1
+        if changes:
+            for fn in self.watchers:
+                fn(changes)
+
+    def _tree(self, node):
+        return {name: self.values[child.slot] if child.children is None else self._tree(child)
+                for name, child in node.children.items()}
+
+    def snapshot(self):
+        """Status and its JSON bytes for the current version. Both are shared
+        between callers and must not be modified.
+        """
+        version, status, data = self.cached
+        if version == self.version:
+            return status, data
+        with self.lock:
+            version = self.version
+            tree = self._tree(self.root)
+        status = self.layout(tree) if self.layout else tree
+        data = json.dumps(status).encode()
+        self.cached = (version, status, data)
+        self.builds += 1
+        return status, data
+
+    def counters(self):
+        return {"version": self.version, "builds": self.builds, "attributes": len(self.values)}
@@ -0,0 +1,218 @@
+"""
+Disturbance Recorder
+
+Author: Zein Ali
+Date: 09/08/2025
+
+Keeps the last few seconds of the subscribed SV stream at full rate in a
+preallocated NumPy ring, with a word of binary states (breaker position,
+GOOSE trip, trip command) beside every sample. A trigger (a GOOSE TRIP,
+an instantaneous current over the threshold, or a manual request) marks
+the sample it arrived at; once the post-trigger window has come in, the
+pre- and post-trigger samples around it are copied out of the ring and
+handed to a writer thread, which saves them as COMTRADE. The ring is
+never locked or paused, so ingestion carries on while a recording is
+captured and written.
+
+Files are COMTRADE 2013 with BINARY32 data, in the same scale as the SV
+frames (mA and 10 mV), so the MU's replay can play them back.
+
+Only the SV handler's thread may call add(); trigger() and set_digital()
+may be called from any thread.
+"""
+import os
+import queue
+import time
+import numpy as np
+
+
+CHANNELS = ("Ia", "Ib", "Ic", "Ua", "Ub", "Uc")
+
+# Gain from the stored integer to primary A or V, as in the SV frames
+CHANNEL_SCALE = (0.001,) * 3 + (0.01,) * 3
+
+# Ring length beyond the pre and post windows, so the pre-trigger samples
+# are still there when the post window completes
+MARGIN = 1.0
+
+
+def _comtrade_time(ts):
+    return time.strftime("%d/%m/%Y,%H:%M:%S", time.gmtime(ts)) + f".{int((ts % 1) * 1e6):06d}"
+
+
+class DisturbanceRecorder:
+    def __init__(self, directory, station, device, rate, digitals, pre=0.2, post=0.5,
+                 threshold=None, nominal_hz=50.0, keep=20):
+        self.directory = directory
+        self.station = station
+        self.device = device
+        self.rate = rate
+        self.digitals = tuple(digitals)
+        self.pre = int(pre * rate)
+        self.post = int(post * rate)
+        self.threshold = threshold
+        self.nominal_hz = nominal_hz
+        self.keep = keep
+
+        size = self.pre + self.post + int(MARGIN * rate)
+        self.samples = np.zeros((size, len(CHANNELS)), dtype=np.float32)
+        self.stamps = np.zeros(size, dtype=np.float64)
+        self.states = np.zeros(size, dtype=np.uint16)
+        # Samples written so far; the newest is at (count - 1) % size
+        self.count = 0
+        self.word = 0
+
+        # Trigger asked for and not yet taken up by add(), and the capture
+        # in progress: (reason, trigger sample, end sample)
+        self.request = None
+        self.capture = None
+        self.queue = queue.Queue()
+        self.triggers = 0
+        self.suppressed = 0
+        self.written = 0
+        self.failed = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def set_digital(self, name, state):
+        bit = 1 << self.digitals.index(name)
+        self.word = self.word | bit if state else self.word & ~bit
+
+    def trigger(self, reason):
+        """Ask for a recording; False if one is already being captured"""
+        if self.request is not None or self.capture is not None:
+            self.suppressed += 1
+            return False
+        self.request = reason
+        return True
+
+    def add(self, values, stamps):
+        """Append one SV frame: an (n, 6) array in CHANNELS order and the
+        sample times (refrTm, or anything else that is not a float for
+        frames without them)
+        """
+        n = len(values)
+        size = len(self.stamps)
+        first = self.count % size
+        end = first + n
+        if isinstance(stamps[0], float) and stamps[0] > 0:
+            times = stamps
+        else:
+            now = time.time()
+            times = now - np.arange(n - 1, -1, -1) / self.rate
+        if end <= size:
+            self.samples[first:end] = values
+            self.stamps[first:end] = times
+            self.states[first:end] = self.word
+        else:
+            cut = size - first
+            self.samples[first:] = values[:cut]
+            self.samples[:end - size] = values[cut:]
+            self.stamps[first:] = times[:cut]
+            self.stamps[:end - size] = times[cut:]
+            self.states[first:] = self.word
+            self.states[:end - size] = self.word
+        self.count += n
+
+        if self.capture is None:
+            if self.request is None and self.threshold is not None \
+                    and np.abs(values[:, :3]).max() > self.threshold:
+                self.trigger("OVERCURRENT")
+            if self.request is not None:
+                self.triggers += 1
+                start = self.count - n
+                self.capture = (self.request, start, start + self.post)
+                self.request = None
+        elif self.count >= self.capture[2]:
+            self.take()
+
+    def take(self):
+        """Copy the finished capture out of the ring for the writer"""
+        reason, trigger, end = self.capture
+        size = len(self.stamps)
+        first = max(trigger - self.pre, self.count - size, 0)
+        idx = np.arange(first, end) % size
+        self.queue.put((reason, trigger - first, self.samples[idx], self.stamps[idx], self.states[idx]))
+        self.capture = None
+
+    def run_writer(self):
+        """Write captured recordings as they come; run on a thread of its own"""
+        while True:
+            reason, trigger, samples, stamps, states = self.queue.get()
+            try:
+                name = self.write(reason, trigger, samples, stamps, states)
+                self.written += 1
+                print(f"[DR] Recorded {name}: {len(samples)} samples, {reason}")
+                self.prune()
+            except Exception as e:
+                self.failed += 1
+                print(f"[DR] Failed to write recording: {e}")
+
+    def write(self, reason, trigger, samples, stamps, states):
+        start = stamps[0]
+        name = f"{self.device}_{time.strftime('%Y%m%d_%H%M%S', time.gmtime(start))}" \
+               f"_{int((start % 1) * 1000):03d}_{reason}"
+        base = os.path.join(self.directory, name)
+
+        words = -(-len(self.digitals) // 16)
+        record = np.dtype([("n", "<u4"), ("t", "<u4"), ("a", "<i4", (len(CHANNELS),)),
+                           ("d", "<u2", (words,))])
+        dat = np.zeros(len(samples), dtype=record)
+        dat["n"] = np.arange(1, len(samples) + 1)
+        dat["t"] = np.round((stamps - start) * 1e6)
+        dat["a"] = np.round(samples / np.array(CHANNEL_SCALE, dtype=np.float32))
+        dat["d"][:, 0] = states
+
+        lines = [f"{self.station},{self.device},2013",
+                 f"{len(CHANNELS) + len(self.digitals)},{len(CHANNELS)}A,{len(self.digitals)}D"]
+        for k, (chan, scale) in enumerate(zip(CHANNELS, CHANNEL_SCALE), 1):
+            unit = "A" if chan[0] == "I" else "V"
+            lines.append(f"{k},{chan},{chan[1]},,{unit},{scale},0,0,-2147483648,2147483647,1,1,P")
+        for k, name_d in enumerate(self.digitals, 1):
+            lines.append(f"{k},{name_d},,,0")
+        lines += [f"{self.nominal_hz:g}", "1", f"{self.rate:g},{len(samples)}",
+                  _comtrade_time(start), _comtrade_time(stamps[trigger]),
+                  "BINARY32", "1", "+0,+0", "F,0"]
+
+        # Written beside and renamed into place, so a download never gets
+        # half a recording; the .cfg last, as it is what lists one
+        dat.tofile(base + ".dat.tmp")
+        os.replace(base + ".dat.tmp", base + ".dat")
+        with open(base + ".cfg.tmp", "w", newline="\r\n") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(base + ".cfg.tmp", base + ".cfg")
+        return name
+
+    def prune(self):
+        """Keep only the newest recordings"""
+        for name in self.recordings()[self.keep:]:
+            for ext in (".cfg", ".dat"):
+                try:
+                    os.remove(os.path.join(self.directory, name["name"] + ext))
+                except FileNotFoundError:
+                    pass
+
+    def recordings(self):
+        """Recordings on disk, newest first"""
+        out = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".cfg"):
+                name = entry.name[:-4]
+                dat = os.path.join(self.directory, name + ".dat")
+                if os.path.exists(dat):
+                    out.append({"name": name, "created": entry.stat().st_mtime,
+                                "bytes": entry.stat().st_size + os.path.getsize(dat),
+                                "files": [name + ".cfg", name + ".dat"]})
+        out.sort(key=lambda r: r["created"], reverse=True)
+        return out
+
+    def counters(self):
+        return {
+            "triggers": self.triggers,
+            "suppressed": self.suppressed,
+            "written": self.written,
+            "failed": self.failed,
+            "capturing": self.capture is not None,
+            "preMs": round(self.pre / self.rate * 1e3),
+            "postMs": round(self.post / self.rate * 1e3),
+            "samplesSeen": self.count
+        }
@@ -14,11 +14,27 @@ import time
 import requests
 import os
 import sys
-from flask import Flask, jsonify, request
+import queue
+from flask import Flask, Response, jsonify, request, send_from_directory
 from collections import deque
 from threading import Lock
 import concurrent.futures
 from datetime import datetime
+import sv_codec
+import prp
+from phasor import PhasorEstimator
+from sv_supervision import StreamSupervisor
+from disturbance import DisturbanceRecorder
+from mms_ring import RingWriter
+from ioloop import EventLoop
+from goose_pub import GoosePublisher
+from goose_sub import GooseSubscriber
+from datamodel import DataModel, MMXU_PATHS, mmxu_template, status_layout
+from power_quality import PowerQuality, pq_template
+from energy import EnergyMeter, mmtr_template, MMTR_DATASET
+from mms_server import MmsServer, ReportControl
+from control import ControlObject, Interlocks, is_protection
+from frame_filter import FrameFilter, goose_id, sv_id, sources_from_env
 from requests.exceptions import RequestException
 
 
@@ -31,21 +47,67 @@ mode_lock = Lock()
 ACTIVE_IED_IP = "ied"
 MERGING_UNIT_PORT = 10010
 sv_window = deque(maxlen=2)
-MMS_FILE = f"/app/shared/mms_{os.environ.get('DEVICE_NAME', 'IED2')}.json"
+# Shared memory ring of MMS status snapshots read by SCADA (see mms_ring)
+MMS_FILE = f"/app/shared/mms_{os.environ.get('DEVICE_NAME', 'IED2')}.ring"
 
-mmxu_measurements = {
-    "Ua": None, "Ub": None, "Uc": None,
-    "Ia": None, "Ib": None, "Ic": None,
-    "Freq": None,
-    "timestamp": None
-}
-mmxu_lock = threading.Lock()
 sv_health = {
     "last_sample_time": 0,
     "packet_count": 0,
     "rate_hz": 0,
-    "quality": "UNKNOWN"
+    "quality": "UNKNOWN",
+    "other_svid": 0,
+    "lost": 0,
+    "cpu_pct": 0,
+    "cpu_us_per_sample": 0
 }
+
+# SV stream to subscribe to, picked by svID: MU1-SV is the 80 samples/cycle
+# protection stream, MU1-PQ the 256 samples/cycle power quality stream
+SV_ID = os.getenv("SV_ID", "MU1-SV")
+SV_GROUP = os.getenv("SV_GROUP", "239.192.0.1")
+
+# SV handler time already counted into sv_health, for the per rate cost
+sv_busy_seen = 0.0
+
+# Samples per cycle of the subscribed stream, and how often its phasors
+# are published into MMXU
+SV_SPC = int(os.getenv("SV_SPC", "80"))
+MMXU_RATE_HZ = float(os.getenv("MMXU_RATE_HZ", "10"))
+sv_phasors = PhasorEstimator(SV_SPC)
+# Sequence, jitter and latency statistics of the subscribed stream
+sv_supervisor = StreamSupervisor(SV_SPC)
+# SV quality each second, from the supervisor's counts against the
+# SV_SPC * 50 samples a second the stream carries: LOST with no samples,
+# LATE with more than SV_LATE_LOSS_PCT of them lost or fewer than
+# SV_LATE_RATE_PCT arriving, else GOOD
+SV_EXPECTED_RATE = SV_SPC * 50
+SV_LATE_LOSS_PCT = float(os.getenv("SV_LATE_LOSS_PCT", "1"))
+SV_LATE_RATE_PCT = float(os.getenv("SV_LATE_RATE_PCT", "90"))
+# Supervisor counts (received, duplicate, lost) at the last health check
+sv_counts_seen = (0, 0, 0)
+
+# Disturbance recorder: full rate SV and binary states around a GOOSE TRIP,
+# an instantaneous phase current over DR_TRIGGER_A or a manual trigger
+DR_DIR = os.getenv("DR_DIR", "/app/recordings")
+DR_TRIGGER_A = float(os.getenv("DR_TRIGGER_A", "3000")) or None
+recorder = DisturbanceRecorder(
+    DR_DIR, "SUBSTATION", os.getenv("DEVICE_NAME", "IED2"), SV_SPC * 50.0,
+    ("XCBR1_CLOSED", "GOOSE_TRIP", "CMD_TRIP"),
+    pre=float(os.getenv("DR_PRE_MS", "200")) / 1000, post=float(os.getenv("DR_POST_MS", "500")) / 1000,
+    threshold=DR_TRIGGER_A, keep=int(os.getenv("DR_KEEP", "20")))
+# Power quality: harmonics, THD, sequence components, unbalance and
+# frequency every 10 cycles, worked out on a thread of its own into
+# MHAI1 and MSQI1
+power_quality = PowerQuality(SV_SPC, on_result=lambda values: datamodel.update(values))
+# Energy registers (MMTR1), integrated from the SV stream in blocks of
+# ENERGY_BLOCK samples (one cycle by default) and checkpointed to the
+# shared volume so they carry on after a restart
+ENERGY_FILE = os.getenv("ENERGY_FILE", f"/app/shared/energy_{os.getenv('DEVICE_NAME', 'IED2')}.json")
+ENERGY_CHECKPOINT_S = float(os.getenv("ENERGY_CHECKPOINT_S", "5"))
+energy = EnergyMeter(SV_SPC, ENERGY_FILE, block=int(os.getenv("ENERGY_BLOCK", "0")))
+mmxu_period = 1.0 / MMXU_RATE_HZ
+next_mmxu = 0.0
+
 sv_data = {
     "Ia": 0.0, "Ib": 0.0, "Ic": 0.0,
     "Ua": 0.0, "Ub": 0.0, "Uc": 0.0,
@@ -58,13 +120,133 @@ last_cmd = None
 fault_active = False
 system_events = []
 
+# Breaker control: select-before-operate with enhanced security, checked
+# against the CILO1 interlocking rules. The rules are expressions over
+# data model paths; CILO_RULES (JSON) replaces any of them
+CTL_MODEL = os.getenv("CTL_MODEL", "sbo-with-enhanced-security")
+SBO_TIMEOUT = float(os.getenv("SBO_TIMEOUT_MS", "30000")) / 1000
+OPER_TIMEOUT = float(os.getenv("OPER_TIMEOUT_MS", "2000")) / 1000
+CILO_RULES = {
+    # Opening is always allowed
+    "EnaOpn": "True",
+    # Closing only an open breaker, with no fault pending and the SV
+    # stream healthy
+    "EnaCls": 'XCBR1.Pos.stVal == "OPEN" and not LLN0.fault and LLN0.sv.quality == "GOOD"'
+}
+CILO_RULES.update(json.loads(os.getenv("CILO_RULES", "{}")))
+# GOOSE publishers whose TRIP is a protection trip, by role prefix: the
+# P-IEDs send their DEVICE_NAME, P-IED1 and P-IED2
+PROTECTION_ROLES = tuple(os.getenv("PROTECTION_ROLES", "P-IED").split(","))
+
+# The IED's data model: XCBR1 position, MMXU1 measurements, and LLN0 with
+# the mode and SV health. /mms/status, the MMS ring and MMS reads and
+# writes all go through it
+datamodel = DataModel(os.getenv("DEVICE_NAME", "IED2"), {
+    "LLN0": {"mode": current_mode, "fault": fault_active, "timestamp": None, "sv": dict(sv_health)},
+    "XCBR1": {"Pos": {"stVal": breaker_status, "ctlVal": "UNKNOWN", "stSeld": False, "ctlModel": CTL_MODEL,
+                      "sboTimeout": int(SBO_TIMEOUT * 1000), "operTimeout": int(OPER_TIMEOUT * 1000),
+                      "SBOw": None, "Oper": None, "Cancel": None}},
+    "CILO1": {name: {"stVal": None} for name in CILO_RULES},
+    "MMXU1": mmxu_template(),
+    **pq_template(power_quality.harmonics),
+    **mmtr_template()
+}, layout=status_layout)
+datamodel.update(energy.values())
+
+
+def control_blocked(ctl_val):
+    return "Blocked-by-Mode" if current_mode != "active" else None
+
+def execute_control(ctl_val, origin):
+    loop.submit("control", operate_breaker, ctl_val, origin)
+
+interlocks = Interlocks(datamodel, CILO_RULES)
+breaker_control = ControlObject(datamodel, "XCBR1.Pos", interlocks, execute_control, blocked=control_blocked,
+                                ctl_model=CTL_MODEL, sbo_timeout=SBO_TIMEOUT, oper_timeout=OPER_TIMEOUT)
+interlocks.refresh()
+
+# MMS report server: SCADA holds one association and is sent the control
+# state as it changes (buffered, so nothing is lost over a reconnect) and
+# the measurements gathered over 100 ms
+MMS_TCP_PORT = int(os.getenv("MMS_TCP_PORT", "10102"))
+STATUS_DATASET = ("XCBR1.Pos.stVal", "XCBR1.Pos.ctlVal", "LLN0.mode", "LLN0.fault", "LLN0.sv.quality")
+MEAS_DATASET = tuple(MMXU_PATHS.values()) + MMTR_DATASET + ("LLN0.sv.rate_hz",)
+
 BREAKER_IP = 'breaker'
-BREAKER_HTTP_PORT = 5002
 GOOSE_GROUP = '224.1.1.1'
 GOOSE_PORT = 10200
-stNum = 1
+
+# PRP duplicate discard for the SV and GOOSE subscriptions
+sv_prp = prp.DuplicateDiscard()
+goose_prp = prp.DuplicateDiscard()
+
+# Early drop of frames this IED does not subscribe to, before any decode.
+# GOOSE_SOURCES and SV_SOURCES list the publishers allowed (empty: any);
+# each GOOSE source is held to GOOSE_RATE frames a second
+GOOSE_RATE = float(os.getenv("GOOSE_RATE", "200"))
+goose_filter = FrameFilter("goose", ["GOOSE1"], goose_id, sources_from_env(os.getenv("GOOSE_SOURCES", "")),
+                           max_len=1024, rate=GOOSE_RATE, burst=int(os.getenv("GOOSE_BURST", "50")))
+sv_filter = FrameFilter("sv", [SV_ID], sv_id, sources_from_env(os.getenv("SV_SOURCES", "")))
+
+# GOOSE commands dropped as redundant, and the pending check of the
+# breaker against the last command sent (a timer, None when there is none)
+goose_coalesced = 0
+breaker_check = None
+
+# Position the breaker multicasts on every change and once a second
+BREAKER_POS_GROUP = '224.1.1.2'
+BREAKER_POS_PORT = 10202
+# Three missed pushes and the breaker is taken as gone
+BREAKER_SILENT = 3.0
+breaker_pos_rx = None
 IED2_UDP_PORT = 10501
 
+# IED1's control state, replicated over multicast. Its heartbeat is how
+# this IED notices IED1 has gone: silence for longer than the failover
+# budget promotes it
+REPL_GROUP = os.getenv("REPL_GROUP", "224.1.1.3")
+REPL_PORT = int(os.getenv("REPL_PORT", "10510"))
+REPL_HEARTBEAT = float(os.getenv("REPL_HEARTBEAT_MS", "50")) / 1000
+# Only IED1's heartbeats count; anyone else multicasting to the group
+# could otherwise hold this IED in standby
+REPL_PEER = os.getenv("REPL_PEER", "172.20.0.14")
+repl_seq = 0
+FAILOVER_BUDGET = float(os.getenv("FAILOVER_BUDGET_MS", "300")) / 1000
+# How often the heartbeat is checked; promotion comes at most this late
+PEER_CHECK = 0.02
+# Heartbeats in a row from a returning IED1 before handing back to it
+recovery_heartbeats = 10
+peer_state = {}
+peer_last_rx = time.monotonic()
+peer_streak = 0
+auto_promoted = False
+failover_stats = {
+    "failovers": 0,
+    "last_failover_ms": None,
+    "worst_failover_ms": None,
+    "demotions": 0,
+    "heartbeats": 0,
+    "lost_heartbeats": 0,
+    "foreign_heartbeats": 0
+}
+
+# All UDP sockets and periodic jobs of the IED run on this one loop
+loop = EventLoop()
+# RTU command socket, also used for control responses
+command_sock = None
+
+goose_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+goose_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+goose_sender = prp.PrpSender(goose_sock)
+
+# While active this IED replicates its control state as IED1 does, so a
+# returning IED1 can carry on from it
+repl_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+repl_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+
+# Events waiting to be forwarded to SCADA off the loop
+log_queue = queue.Queue(maxsize=1000)
+
 app = Flask(__name__)
 
 def log_debug(msg): print(f"[DEBUG] {time.strftime('%H:%M:%S')} | {msg}", flush=True)
@@ -79,60 +261,111 @@ def log_system_event(message):
         system_events.pop(0)
     print(f"[C-IED2 LOG] {message}")
 
+    # Forwarded from its own thread so a slow SCADA never holds up the loop
     try:
-        requests.post("http://scada:5001/log", json=event, timeout=1)
-    except Exception as e:
-        print(f"[C-IED2] Failed to forward log to SCADA: {e}")
+        log_queue.put_nowait(event)
+    except queue.Full:
+        pass
+
+def forward_logs():
+    while True:
+        event = log_queue.get()
+        try:
+            requests.post("http://scada:5001/log", json=event, timeout=1)
+        except Exception as e:
+            print(f"[C-IED2] Failed to forward log to SCADA: {e}")
 
 
 def compute_checksum(msg):
     return abs(hash(json.dumps(msg))) % 100000
 
+goose_pub = GoosePublisher(loop, goose_sender, GOOSE_GROUP, GOOSE_PORT, compute_checksum)
+# Published from promote() on, once this IED is active
+goose_pub.add("GOOSE1", role="C-IED2")
+
+def goose_expired(key, pub):
+    ip, go_id = key
+    log_debug(f"[IED] GOOSE {go_id} from {ip} silent beyond timeAllowedtoLive (stNum {pub.st_num})")
+
+goose_sub = GooseSubscriber(["GOOSE1"], loop, on_expire=goose_expired)
+
 def broadcast_goose(status):
-    global stNum
+    st_num = goose_pub.publish("GOOSE1", status=status, reason="Manual Override")
+    print(f"[IED2] Broadcasting GOOSE: {status} (stNum {st_num})")
+    replicate_state()
+
+def publish_initial_state():
+    """Start GOOSE1 on becoming active: a state carrying no command, so
+    no subscriber acts on it, with its retransmissions and heartbeat
+    """
+    st_num = goose_pub.publish("GOOSE1", status="NONE", reason="Initial state")
+    print(f"[IED2] Publishing initial GOOSE state (stNum {st_num})")
+    replicate_state()
+
+def replicate_state(force=False):
+    """Multicast the control state; only while active, unless forced for
+    the last word on standing down
+    """
+    global repl_seq
+    if current_mode != "active" and not force:
+        return
+    repl_seq += 1
+    block = goose_pub.blocks["GOOSE1"]
+    state = {
+        "type": "ied_state",
+        "source": os.getenv("DEVICE_NAME", "IED2"),
+        "seq": repl_seq,
+        "timestamp": time.time(),
+        "mode": current_mode,
+        # Promoted by SCADA rather than by losing IED1: IED1 stands down
+        "held": current_mode == "active" and not auto_promoted,
+        "stNum": block.st_num,
+        "status": (block.values or {}).get("status"),
+        "last_cmd": last_cmd,
+        "fault_active": fault_active,
+        "breaker_status": breaker_status
+    }
+    repl_sock.sendto(json.dumps(state).encode(), (REPL_GROUP, REPL_PORT))
+
+def open_udp_socket(port, group=None):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-
-    print(f"[IED2] Broadcasting GOOSE: {status} (stNum {stNum})")
-    for sq in range(1, 5):
-        msg = {
-            "goID": "GOOSE1",
-            "status": status,
-            "reason": "Manual Override",
-            "stNum": stNum,
-            "sqNum": sq,
-            "timestamp": time.time(),
-            "role": "C-IED2"
-        }
-        msg["checksum"] = compute_checksum(msg)
-        sock.sendto(json.dumps(msg).encode(), (GOOSE_GROUP, GOOSE_PORT))
-        time.sleep(0.3)
-    
-    stNum += 1
-
-def listen_for_commands():
-    print(f"[IED2] Listening for TRIP/RESET on UDP port {IED2_UDP_PORT}")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(("0.0.0.0", IED2_UDP_PORT))
+    if group:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    if group:
+        prp.join_groups(sock, group)
+    return sock
+
+def handle_command(data, addr):
+    """RTU control: {"command": "TRIP", "action": "select" | "operate" |
+    "cancel", "ctlNum": n}, answered with the decision and, for an
+    operate, later the command termination
+    """
+    try:
+        msg = json.loads(data.decode())
+        cmd = msg.get("command", "").upper()
+        action = msg.get("action", "operate")
+        if cmd not in ["TRIP", "RESET"] or action not in ("select", "operate", "cancel"):
+            log_system_event(f"[IED2] Invalid command received: {cmd} ({action})")
+            return
+    except Exception as e:
+        log_system_event(f"[IED2] Error parsing command: {e}")
+        return
+
+    def reply(term):
+        command_sock.sendto(json.dumps(dict(term, type="cmd_term")).encode(), addr)
+    accepted, cause = breaker_control.request(action, f"rtu:{addr[0]}:{addr[1]}", cmd, msg.get("ctlNum"), reply)
+    command_sock.sendto(json.dumps({"type": "command_resp", "action": action, "command": cmd,
+                                    "ctlNum": msg.get("ctlNum"), "ok": accepted, "addCause": cause}).encode(), addr)
+    if not accepted:
+        log_system_event(f"[IED2] RTU {action} {cmd} refused: {cause}")
 
-    while True:
-        data, addr = sock.recvfrom(1024)
-        try:
-            msg = json.loads(data.decode())
-            cmd = msg.get("command", "").upper()
-            if cmd in ["TRIP", "RESET"]:
-                broadcast_goose(cmd)
-            else:
-                log_system_event(f"[IED2] Invalid command received: {cmd}")
-        except Exception as e:
-            log_system_event(f"[IED2] Error parsing command: {e}")
 
 
 
 
-with open(MMS_FILE, "w") as f:
-    f.write("[]")
-print(f"[IED] Cleared MMS log file at startup: {MMS_FILE}")
+mms_ring = RingWriter(MMS_FILE)
+print(f"[IED] Created MMS snapshot ring at startup: {MMS_FILE}")
 
 
 @app.route('/')
@@ -146,153 +379,201 @@ def get_sv_data():
     return jsonify(sv_data)
 @app.route('/sv-status')
 def get_sv_status():
-    return jsonify({"status": sv_health["quality"], "last_sample": sv_health["last_sample_time"], "rateHz": sv_health["rate_hz"]})
+    return jsonify({"status": sv_health["quality"], "last_sample": sv_health["last_sample_time"], "rateHz": sv_health["rate_hz"],
+                    "svID": SV_ID, "cpuPct": sv_health["cpu_pct"], "cpuUsPerSample": sv_health["cpu_us_per_sample"],
+                    "supervision": {SV_ID: sv_supervisor.as_dict()},
+                    "filter": sv_filter.counters()})
 @app.route('/role')
 def get_role(): return jsonify({"mode": current_mode})
+@app.route('/prp')
+def get_prp_status(): return jsonify({"sv": sv_prp.counters(), "goose": goose_prp.counters()})
+@app.route('/goose')
+def get_goose_status():
+    return jsonify({"published": goose_pub.counters(), "subscribed": goose_sub.counters(),
+                    "coalesced": goose_coalesced, "filter": goose_filter.counters()})
+@app.route('/recordings')
+def list_recordings():
+    return jsonify({"recorder": recorder.counters(), "recordings": recorder.recordings()})
+
+@app.route('/recordings/trigger', methods=["POST"])
+def trigger_recording():
+    if recorder.trigger("MANUAL"):
+        return jsonify({"result": "triggered"})
+    return jsonify({"result": "busy"}), 409
+
+@app.route('/recordings/<path:filename>')
+def download_recording(filename):
+    return send_from_directory(DR_DIR, filename, as_attachment=True)
+
+@app.route('/power-quality')
+def get_power_quality():
+    status, _ = datamodel.snapshot()
+    return jsonify({"analysis": power_quality.counters(),
+                    "MHAI1": status["MHAI1"], "MSQI1": status["MSQI1"]})
+
+@app.route('/energy')
+def get_energy():
+    status, _ = datamodel.snapshot()
+    return jsonify({"meter": energy.counters(), "MMTR1": status["MMTR1"]})
+
+@app.route('/control')
+def get_control():
+    return jsonify({"XCBR1.Pos": breaker_control.counters(), "CILO1": interlocks.as_dict(),
+                    "interlockEvaluations": interlocks.evaluations})
+
+@app.route('/mms/server')
+def get_mms_server():
+    return jsonify(mms_server.counters())
+
+@app.route('/loop-stats')
+def get_loop_stats(): return jsonify(loop.snapshot())
 @app.route('/failover', methods=["POST"])
 def manual_failover():
-    global current_mode
-    with mode_lock:
-        if current_mode != "active":
-            current_mode = "active"
-            log_system_event(f"🟢 Promoted to ACTIVE via SCADA instruction")
+    # The mode only changes on the loop thread, between frames
+    done = threading.Event()
+    def promote_now():
+        global auto_promoted
+        # A promotion ordered by SCADA stands when IED1 returns
+        if not promote("SCADA instruction", auto=False):
+            auto_promoted = False
+            replicate_state()
+        done.set()
+    loop.submit("failover", promote_now)
+    done.wait(1.0)
     return jsonify({"result": "promoted", "new_mode": current_mode})
-
-
-def write_mms_to_file():
-    while True:
-        try:
-            with mmxu_lock:
-                mmxu = dict(mmxu_measurements)
-
-            if mmxu["timestamp"] and all(v is not None for v in [mmxu["Ua"], mmxu["Ub"], mmxu["Uc"], mmxu["Ia"], mmxu["Ib"], mmxu["Ic"], mmxu["Freq"]]):
-                status = {
-                    "timestamp": mmxu["timestamp"],
-                    "ln": "XCBR1",
-                    "Pos": {
-                        "stVal": breaker_status,
-                        "ctlVal": last_cmd or "UNKNOWN"
-                    },
-                    "sv": sv_health,
-                    "mode": current_mode,
-                    "MMXU1": {
-                        "PhV": {
-                            "phsA": {"mag": {"f": mmxu["Ua"]}},
-                            "phsB": {"mag": {"f": mmxu["Ub"]}},
-                            "phsC": {"mag": {"f": mmxu["Uc"]}}
-                        },
-                        "A": {
-                            "phsA": {"mag": {"f": mmxu["Ia"]}},
-                            "phsB": {"mag": {"f": mmxu["Ib"]}},
-                            "phsC": {"mag": {"f": mmxu["Ic"]}}
-                        },
-                        "Freq": mmxu["Freq"]
-                    }
-                }
-
-                entries = []
-                if os.path.exists(MMS_FILE):
-                    with open(MMS_FILE, "r", encoding="utf-8") as f:
-                        try:
-                            entries = json.load(f)
-                        except json.JSONDecodeError:
-                            print("[IED2] Corrupted MMS file — resetting.")
-
-                entries.append(status)
-                entries = entries[-100:]
-                if len(entries) > 100:
-                    print(f"[IED2] ❌ Trim logic failed! {len(entries)} entries remaining.")
-                else:
-                    print(f"[IED2] ✅ Trimmed to {len(entries)} entries.")
-                
-
-                with open(MMS_FILE, "w", encoding="utf-8") as f:
-                    json.dump(entries, f, indent=2, ensure_ascii=False)
-
-        except Exception as e:
-            print("[IED2] Failed to write MMS file:", e)
-
-        time.sleep(1.5)
+@app.route('/failover-status')
+def get_failover_status():
+    return jsonify(dict(failover_stats, mode=current_mode, budget_ms=FAILOVER_BUDGET * 1000,
+                        peer_age_ms=round((time.monotonic() - peer_last_rx) * 1000, 1), peer=peer_state))
+
+
+def sync_datamodel():
+    """Bring the position and mode into the data model; a write that
+    changes nothing leaves the version, and the cached status, as they are
+    """
+    datamodel.update({
+        "XCBR1.Pos.stVal": breaker_status,
+        "XCBR1.Pos.ctlVal": last_cmd or "UNKNOWN",
+        "LLN0.mode": current_mode,
+        "LLN0.fault": fault_active
+    })
+
+
+# MMS write -> control service of XCBR1.Pos
+CONTROL_SERVICES = {"SBOw": "select", "Oper": "operate", "Cancel": "cancel"}
+
+def mms_write(ref, value, origin=None, reply=None):
+    """Write over MMS: only the SBOw, Oper and Cancel services of
+    XCBR1.Pos, with the ctlVal and ctlNum in the value. Returns why a write
+    is refused (an AddCause for a control), or None
+    """
+    obj, _, service = ref.rpartition(".")
+    if obj != "XCBR1.Pos" or service not in CONTROL_SERVICES:
+        return f"{ref} is not writable"
+    if not isinstance(value, dict):
+        return "Inconsistent-parameters"
+    accepted, cause = breaker_control.request(CONTROL_SERVICES[service], origin, value.get("ctlVal"),
+                                              value.get("ctlNum"), reply)
+    print(f"[IED] MMS {service} {value.get('ctlVal')} from {origin}: {'accepted' if accepted else cause}")
+    return cause
+
+
+# Two instances of each block, one per SCADA worker
+mms_server = MmsServer(datamodel, MMS_TCP_PORT, [
+    rcb for n in (1, 2) for rcb in (
+        ReportControl(f"brcbStatus{n:02d}", STATUS_DATASET, buffered=True, intg_pd=5.0),
+        ReportControl(f"urcbMeas{n:02d}", MEAS_DATASET, intg_pd=2.0, buf_tm=0.1))
+], on_write=lambda ref, value, client: mms_write(
+    ref, value, f"mms:{client.peer[0]}:{client.peer[1]}", lambda term: mms_server.send(client, term)))
+
+
+def write_mms_snapshot():
+    sync_datamodel()
+    status, _ = datamodel.snapshot()
+    m = status["MMXU1"]
+    if m["timestamp"] and all(m[do][phs]["mag"]["f"] is not None for do in ("PhV", "A") for phs in m[do]) \
+            and m["Freq"] is not None:
+        mms_ring.write(status)
 
 
 @app.route('/mms/status')
 def get_mms_status():
     try:
-        with mmxu_lock:
-            return jsonify({
-                "ln": "XCBR1",
-                "Pos": {
-                    "stVal": breaker_status,
-                    "ctlVal": last_cmd or "UNKNOWN"
-                },
-                "sv": sv_health,
-                "mode": current_mode,
-                "MMXU1": {
-                    "PhV": {
-                        "phsA": {"mag": {"f": mmxu_measurements.get("Ua")}},
-                        "phsB": {"mag": {"f": mmxu_measurements.get("Ub")}},
-                        "phsC": {"mag": {"f": mmxu_measurements.get("Uc")}}
-                    },
-                    "A": {
-                        "phsA": {"mag": {"f": mmxu_measurements.get("Ia")}},
-                        "phsB": {"mag": {"f": mmxu_measurements.get("Ib")}},
-                        "phsC": {"mag": {"f": mmxu_measurements.get("Ic")}}
-                    },
-                    "Freq": mmxu_measurements.get("Freq"),
-                    "timestamp": mmxu_measurements.get("timestamp")
-                }
-            })
+        sync_datamodel()
+        _, data = datamodel.snapshot()
+        return Response(data, mimetype="application/json")
     except Exception as e:
         print("[IED] MMS status error:", e)
         return jsonify({"error": "Failed to generate MMS status"}), 500
 
-def listen_for_sv():
-    global mmxu_measurements
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(('', 10010))
-    mreq = struct.pack("4sl", socket.inet_aton("239.192.0.1"), socket.INADDR_ANY)
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-
-    print("[IED] Listening for Sampled Values on 239.192.0.1:10010")
-
-    while True:
-        try:
-            data, _ = sock.recvfrom(4096)
-            sv = json.loads(data.decode())
-
-            with mmxu_lock:
-                mmxu_measurements.update({
-                    "Ua": sv.get("Ua"),
-                    "Ub": sv.get("Ub"),
-                    "Uc": sv.get("Uc"),
-                    "Ia": sv.get("Ia"),
-                    "Ib": sv.get("Ib"),
-                    "Ic": sv.get("Ic"),
-                    "Freq": sv.get("freq"),
-                    "timestamp": datetime.utcnow().isoformat() + "Z"
-                })
-
-            sv_health["last_sample_time"] = time.time()
-            sv_health["packet_count"] += 1
 
-        except Exception as e:
-            print("[IED] SV parse error:", e)
+@app.route('/mms/model')
+def get_mms_model():
+    return jsonify(datamodel.counters())
 
 
-def promote_if_needed(source):
-    global current_mode
-    acquired = mode_lock.acquire(timeout=0.2)
-    if not acquired:
-        log_debug(f"⚠️ Could not acquire mode_lock in {source}")
+def handle_sv(data, src):
+    global next_mmxu
+    if not sv_filter.accept(data, src):
+        # Another stream sharing the group or port, or not a frame at all
+        sv_health["other_svid"] = sv_filter.dropped["id"]
         return
-    try:
-        if current_mode != "active":
-            log_debug(f"⚡ Promotion triggered by {source}")
-            current_mode = "active"
-            log_system_event(f"🟢 IED2 promoted to ACTIVE via {source}")
-    finally:
-        mode_lock.release()
+    data = sv_prp.accept(data, src)
+    if data is None:
+        return
+    batch = sv_codec.decode(data)
+    sv_supervisor.frame(batch.smp_cnt, batch.utc_timestamp)
+    recorder.add(batch.values, batch.utc_timestamp)
+    power_quality.add(batch.values)
+    energy.add(batch.values)
+    sv_phasors.update(batch.smp_cnt, batch.values)
+
+    now = time.monotonic()
+    if now >= next_mmxu:
+        next_mmxu = now + mmxu_period
+        measured = sv_phasors.measure()
+        if measured:
+            measured["timestamp"] = datetime.utcnow().isoformat() + "Z"
+            values = {MMXU_PATHS[k]: v for k, v in measured.items() if k in MMXU_PATHS}
+            values["LLN0.timestamp"] = measured["timestamp"]
+            energy.set_frequency(measured["Freq"])
+            values.update(energy.values())
+            datamodel.update(values)
+
+    sv_health["last_sample_time"] = time.time()
+    sv_health["packet_count"] += len(batch)
+
+
+def promote(source, auto):
+    """Take over from IED1's last replicated state; auto when IED1's loss
+    rather than SCADA promoted it. Runs on the loop thread, which every
+    handler reads the mode from, so it takes no lock and the switch
+    applies from the next frame on
+    """
+    global current_mode, peer_streak, auto_promoted
+    if current_mode == "active":
+        return False
+    log_debug(f"⚡ Promotion triggered by {source}")
+    current_mode = "active"
+    auto_promoted = auto
+    peer_streak = 0
+    adopt_peer_state()
+    publish_initial_state()
+    log_system_event(f"🟢 IED2 promoted to ACTIVE via {source}")
+    return True
+
+def demote(reason):
+    """Stand down for IED1, on the loop thread. The GOOSE heartbeat stops,
+    and a last state message tells the listening IED1 it can take over
+    """
+    global current_mode, auto_promoted
+    current_mode = "standby"
+    auto_promoted = False
+    goose_pub.stop("GOOSE1")
+    sync_datamodel()
+    replicate_state(force=True)
+    failover_stats["demotions"] += 1
+    log_system_event(f"🔄 {reason} — demoted to STANDBY")
 
 
 
@@ -327,36 +608,60 @@ def wait_for_ied_ready(timeout_sec=3):
                 print("[IED2] Giving up on IED1 startup wait. Starting in STANDBY anyway.")
                 return
 
-def monitor_active_ied():
-    global current_mode
-    failure_count = 0
-    recovery_count = 0
-    log_debug("🧵 monitor_active_ied thread started")
-    
-    while True:
-        log_debug(f"💓 monitor_active_ied heartbeat — mode: {current_mode}")
-        reachable = check_ied1_reachable()
-
-        if reachable:
-            failure_count = 0
-            recovery_count += 1
-            log_debug("✅ IED1 is reachable")
+def handle_replication(data, src):
+    global peer_last_rx, peer_streak
+    msg = json.loads(data.decode())
+    # This IED's own state comes back on the group while it is active
+    if msg.get("type") != "ied_state" or msg.get("source") == os.getenv("DEVICE_NAME", "IED2"):
+        return
+    if src[0] != REPL_PEER:
+        failover_stats["foreign_heartbeats"] += 1
+        return
+    seq = msg.get("seq", 0)
+    last = peer_state.get("seq", 0)
+    if seq > last + 1 and last:
+        failover_stats["lost_heartbeats"] += seq - last - 1
+    peer_state.update(msg)
+    peer_last_rx = time.monotonic()
+    peer_streak += 1
+    failover_stats["heartbeats"] += 1
+
+    # A returning IED1 listens before taking over. Hand back once it is
+    # steadily back, or at once if it is active already, if it was its loss
+    # that promoted this IED; a promotion ordered by SCADA stands
+    if current_mode != "active" or not auto_promoted:
+        return
+    if msg.get("mode") == "active":
+        demote("IED1 active")
+    elif peer_streak >= recovery_heartbeats:
+        demote("IED1 back online")
+
+def check_peer():
+    """Promote once IED1's heartbeat has been silent long enough that the
+    takeover still lands within the budget"""
+    if current_mode == "active":
+        return
+    silent = time.monotonic() - peer_last_rx
+    if silent < FAILOVER_BUDGET - PEER_CHECK:
+        return
+    if not promote(f"IED1 heartbeat loss ({silent * 1000:.0f} ms)", auto=True):
+        return
 
-            if current_mode == "active" and recovery_count >= 1:
-                with mode_lock:
-                    current_mode = "standby"
-                    log_system_event(f"🔄 IED1 back online — demoted to STANDBY")
-        else:
-            failure_count += 1
-            recovery_count = 0
-            log_debug(f"❌ IED1 unreachable (failures: {failure_count})")
-
-            if current_mode == "standby" and failure_count >= 1:
-                with mode_lock:
-                    current_mode = "active"
-                    log_system_event(f"🟢 IED2 promoted to ACTIVE after IED1 failure")
+    # Failover time: from IED1's last heartbeat to this IED having taken over
+    ms = round((time.monotonic() - peer_last_rx) * 1000, 1)
+    failover_stats["failovers"] += 1
+    failover_stats["last_failover_ms"] = ms
+    failover_stats["worst_failover_ms"] = max(ms, failover_stats["worst_failover_ms"] or 0)
 
-        time.sleep(1)
+def adopt_peer_state():
+    """Carry on from IED1's last replicated control state"""
+    global last_cmd, fault_active
+    if not peer_state:
+        return
+    goose_pub.resume("GOOSE1", peer_state.get("stNum") or 0)
+    last_cmd = peer_state.get("last_cmd") or last_cmd
+    fault_active = bool(peer_state.get("fault_active"))
+    sync_datamodel()
 
 def monitor_active_ied2():
     global current_mode
@@ -376,30 +681,84 @@ def monitor_active_ied2():
                     current_mode = "active"
         time.sleep(3)
 
-def listen_goose():
-    global last_cmd
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(('', GOOSE_PORT))
-    mreq = struct.pack("4sl", socket.inet_aton(GOOSE_GROUP), socket.INADDR_ANY)
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-    log_debug("GOOSE listener started")
-    while True:
-        with mode_lock:
-            if current_mode != "active":
-                time.sleep(1)
-                continue
-        data, _ = sock.recvfrom(1024)
-        try:
-            msg = json.loads(data.decode())
-            if msg.get("goID") == "GOOSE1":
-                cmd = msg.get("status", "")
-                log_debug(f"GOOSE received: {cmd}")
-                send_command_to_breaker(cmd)
-                last_cmd = cmd
-                threading.Timer(1.0, check_breaker_response).start()
-        except Exception as e:
-            log_debug(f"GOOSE parse error: {e}")
+def handle_goose(data, src):
+    if not goose_filter.accept(data, src):
+        return
+    data = goose_prp.accept(data, src)
+    if data is None:
+        return
+    try:
+        msg = json.loads(data.decode())
+    except ValueError as e:
+        log_debug(f"GOOSE parse error: {e}")
+        return
+    # Publishers are tracked in standby as well, just not acted on, so a
+    # promotion applies to the next state change and no old one is replayed
+    if not goose_sub.receive(msg, src):
+        return
+    cmd = msg.get("status", "")
+    recorder.set_digital("GOOSE_TRIP", cmd == "TRIP")
+    if cmd == "TRIP":
+        recorder.trigger("GOOSE_TRIP")
+    role = msg.get("role")
+    # This IED's own GOOSE carries a command it has already executed
+    if current_mode != "active" or role == "C-IED2" or cmd not in ("TRIP", "RESET"):
+        return
+    accepted, cause = breaker_control.request("direct", f"goose:{role}:{src[0]}", cmd,
+                                              msg.get("stNum"), protection=is_protection(role, PROTECTION_ROLES))
+    if accepted:
+        log_debug(f"[IED] Received GOOSE Command: {cmd}")
+    elif cause != "Position-reached":
+        log_debug(f"[IED] GOOSE {cmd} from {role} refused: {cause}")
+
+def operate_breaker(cmd, origin):
+    """Carry out an accepted command. The breaker acts on GOOSE, so an
+    operator's command is published; one that came as GOOSE has already
+    reached it
+    """
+    command_breaker(cmd)
+    if not origin.startswith("goose:"):
+        broadcast_goose(cmd)
+
+def command_breaker(cmd):
+    """Pass a command on to the breaker. A command that would change
+    nothing, because the breaker is already there or the same command is
+    still awaiting its check, is dropped. Each command sent replaces the
+    pending check with one a second later.
+    """
+    global last_cmd, goose_coalesced, breaker_check
+    expected = "OPEN" if cmd == "TRIP" else "CLOSED"
+    if cmd == last_cmd and (breaker_check is not None or breaker_status == expected):
+        goose_coalesced += 1
+        return False
+
+    send_command_to_breaker(cmd)
+    last_cmd = cmd
+    recorder.set_digital("CMD_TRIP", cmd == "TRIP")
+    sync_datamodel()
+    replicate_state()
+    if breaker_check is not None:
+        loop.cancel(breaker_check)
+    breaker_check = loop.call_later(1.0, "breaker_check", check_breaker_response)
+    return True
+
+def handle_breaker_position(data, src):
+    """Breaker position push; confirms a command early, ending its check"""
+    global breaker_status, breaker_check, fault_active, breaker_pos_rx
+    msg = json.loads(data.decode())
+    if msg.get("ln") != "XCBR1" or msg.get("do") != "Pos":
+        return
+    breaker_pos_rx = time.monotonic()
+    breaker_status = msg.get("stVal", breaker_status)
+    recorder.set_digital("XCBR1_CLOSED", breaker_status == "CLOSED")
+    sync_datamodel()
+    if breaker_check is not None and breaker_status == ("OPEN" if last_cmd == "TRIP" else "CLOSED"):
+        loop.cancel(breaker_check)
+        breaker_check = None
+        fault_active = False
+        sync_datamodel()
+        replicate_state()
+
 
 def listen_for_sv1():
     global sv_health
@@ -438,44 +797,56 @@ def listen_for_sv1():
             time.sleep(0.5)
             continue
         try:
-            data, _ = sock.recvfrom(4096)
-            msg = json.loads(data.decode())
+            data, _ = sock.recvfrom(65535)
+            batch = sv_codec.decode(data)
+            msg = batch.latest()
             for key in sv_data:
                 if key in msg:
                     sv_data[key] = msg[key]
             sv_health["last_sample_time"] = time.time()
-            sv_health["packet_count"] += 1
+            sv_health["packet_count"] += len(batch)
         except socket.timeout:
             continue
-        except json.JSONDecodeError:
+        except ValueError:
             log_debug("⚠️ Malformed SV skipped")
         except Exception as e:
             log_debug(f"SV receive error: {e}")
 
-def monitor_sv_health():
-    global sv_health, mmxu_measurements
-    while True:
-        with mode_lock:
-            if current_mode != "active":
-                time.sleep(1)
-                continue
-
-        rate = sv_health["packet_count"]
-        sv_window.append(rate)
-        avg_rate = sum(sv_window) / len(sv_window)
+def update_sv_health():
+    global sv_busy_seen, sv_counts_seen
+    rate = sv_health["packet_count"]
+    sv_window.append(rate)
+    avg_rate = sum(sv_window) / len(sv_window)
+
+    sv_health["rate_hz"] = round(avg_rate, 1)
+    sv_health["packet_count"] = 0
+
+    # SV handler time over the last second, in total and per sample taken
+    busy = loop.stats["sv"].busy
+    cpu, sv_busy_seen = busy - sv_busy_seen, busy
+    sv_health["cpu_pct"] = round(cpu * 100, 2)
+    sv_health["cpu_us_per_sample"] = round(cpu * 1e6 / rate, 2) if rate else 0
+
+    counts = (sv_supervisor.received, sv_supervisor.duplicate, sv_supervisor.lost)
+    received, duplicate, lost = (n - seen for n, seen in zip(counts, sv_counts_seen))
+    sv_counts_seen = counts
+    sv_health["lost"] = lost
+    if received == 0:
+        sv_health["quality"] = "LOST"
+    elif lost > SV_EXPECTED_RATE * SV_LATE_LOSS_PCT / 100 \
+            or received - duplicate < SV_EXPECTED_RATE * SV_LATE_RATE_PCT / 100:
+        sv_health["quality"] = "LATE"
+    else:
+        sv_health["quality"] = "GOOD"
 
-        sv_health["rate_hz"] = round(avg_rate, 1)
-        sv_health["packet_count"] = 0
+    values = {f"LLN0.sv.{k}": v for k, v in sv_health.items()}
+    # The samples counted over the last second rather than the running count
+    values["LLN0.sv.packet_count"] = rate
+    datamodel.update(values)
 
-        if avg_rate == 0:
-            sv_health["quality"] = "LOST"
-        elif avg_rate < 5:
-            sv_health["quality"] = "LATE"
-        else:
-            sv_health["quality"] = "GOOD"
+    print(f"[IED] SV Health: {sv_health['quality']} ({avg_rate:.1f} Hz, {lost} lost, "
+          f"{sv_health['cpu_pct']}% CPU, {sv_health['cpu_us_per_sample']} us/sample)")
 
-        print(f"[IED] SV Health: {sv_health['quality']} ({avg_rate:.1f} Hz)")
-        time.sleep(1)
 
 def send_command_to_breaker(cmd):
     try:
@@ -485,46 +856,72 @@ def send_command_to_breaker(cmd):
     except Exception as e:
         log_debug(f"Breaker send error: {e}")
 
+def check_breaker_silence():
+    """The breaker pushes its position once a second; mark it
+    DISCONNECTED once it has missed BREAKER_SILENT worth of pushes
+    """
+    global breaker_status
+    if breaker_pos_rx is None or breaker_status == "DISCONNECTED":
+        return
+    if time.monotonic() - breaker_pos_rx > BREAKER_SILENT:
+        breaker_status = "DISCONNECTED"
+        sync_datamodel()
+        log_system_event(f"[IED2] No breaker position for {BREAKER_SILENT:.0f} s — DISCONNECTED")
+
 def check_breaker_response():
-    global fault_active
+    global fault_active, breaker_check
+    breaker_check = None
+
     expected = "OPEN" if last_cmd == "TRIP" else "CLOSED"
     if breaker_status != expected:
         fault_active = True
         log_debug("FAULT detected")
     else:
         fault_active = False
-
-def poll_breaker_status():
-    global breaker_status
-    while True:
-        try:
-            r = requests.get(f"http://{BREAKER_IP}:{BREAKER_HTTP_PORT}/status", timeout=1)
-            breaker_status = r.json().get("state", "UNKNOWN")
-        except Exception:
-            breaker_status = "DISCONNECTED"
-        time.sleep(1)
+    sync_datamodel()
+    replicate_state()
+
+def start_event_loop():
+    """Register the UDP handlers and periodic jobs and start the loop.
+    Standby and active register the same, so a standby IED keeps its SV
+    and GOOSE state warm; the handlers check the mode before acting.
+    """
+    global command_sock
+    loop.add_datagram_handler("goose", open_udp_socket(GOOSE_PORT, GOOSE_GROUP), handle_goose, 1024)
+    log_debug("GOOSE listener started")
+    loop.add_datagram_handler("sv", open_udp_socket(MERGING_UNIT_PORT, SV_GROUP), handle_sv)
+    print(f"[IED] Listening for Sampled Values {SV_ID} on {SV_GROUP}:{MERGING_UNIT_PORT}")
+    command_sock = open_udp_socket(IED2_UDP_PORT)
+    loop.add_datagram_handler("command", command_sock, handle_command, 1024)
+    print(f"[IED2] Listening for TRIP/RESET on UDP port {IED2_UDP_PORT}")
+    loop.call_every(1.0, "sv_health", update_sv_health)
+    loop.call_every(1.5, "mms_snapshot", write_mms_snapshot)
+    loop.call_every(ENERGY_CHECKPOINT_S, "energy_checkpoint", energy.checkpoint)
+    loop.call_every(0.1, "control_timeouts", breaker_control.poll)
+    loop.add_datagram_handler("breaker_pos", open_udp_socket(BREAKER_POS_PORT, BREAKER_POS_GROUP), handle_breaker_position, 1024)
+    loop.call_every(1.0, "breaker_silence", check_breaker_silence)
+    loop.add_datagram_handler("replication", open_udp_socket(REPL_PORT, REPL_GROUP), handle_replication, 4096)
+    loop.call_every(PEER_CHECK, "peer_watch", check_peer)
+    loop.call_every(REPL_HEARTBEAT, "replication", replicate_state)
+    threading.Thread(target=loop.run_forever, daemon=True).start()
 
 def start_ied_threads():
+    global peer_last_rx
     print(f"[IED] Starting in {IED_MODE.upper()} mode")
     log_debug(f"{os.getenv('HOSTNAME')} STARTUP — MODE = {IED_MODE}")
+    threading.Thread(target=forward_logs, daemon=True).start()
+    threading.Thread(target=recorder.run_writer, daemon=True).start()
+    threading.Thread(target=power_quality.run, daemon=True).start()
+    threading.Thread(target=mms_server.run, daemon=True).start()
     if IED_MODE == "active":
-        threading.Thread(target=listen_goose, daemon=True).start()
-        threading.Thread(target=poll_breaker_status, daemon=True).start()
-        threading.Thread(target=listen_for_sv, daemon=True).start()
-        threading.Thread(target=monitor_sv_health, daemon=True).start()
-        threading.Thread(target=write_mms_to_file, daemon=True).start()
-        threading.Thread(target=listen_for_commands, daemon=True).start()
+        start_event_loop()
 
 
     elif IED_MODE == "standby":
         wait_for_ied_ready(timeout_sec=5)
-        threading.Thread(target=monitor_active_ied, daemon=True).start()
-        threading.Thread(target=poll_breaker_status, daemon=True).start()
-        threading.Thread(target=listen_goose, daemon=True).start()
-        threading.Thread(target=listen_for_sv, daemon=True).start()
-        threading.Thread(target=monitor_sv_health, daemon=True).start()
-        threading.Thread(target=write_mms_to_file, daemon=True).start()
-        threading.Thread(target=listen_for_commands, daemon=True).start()
+        # IED1 gets the failover budget from here to be heard from
+        peer_last_rx = time.monotonic()
+        start_event_loop()
         #threading.Thread(target=monitor_active_ied2, daemon=True).start()
 
 
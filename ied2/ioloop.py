@@ -0,0 +1,155 @@
+"""
+IED Event Loop
+
+Author: Zein Ali
+Date: 01/08/2025
+
+A single selectors loop serving all of a control IED's UDP sockets (SV,
+GOOSE, MMS, commands) and its periodic jobs, instead of one thread per
+socket. Each socket has a handler called once per datagram; a readable
+socket is drained up to max_burst datagrams per wakeup so a 4 kHz SV
+stream costs few wakeups without starving the others. Timers, kept on a
+hashed timer wheel, replace the sleep loops and threading.Timer calls;
+call_later() returns a handle for cancel().
+
+Handlers read the IED mode on every datagram, so a promotion or demotion
+applies to the very next frame. Every handler and timer is timed, and
+the counters are served at /loop-stats. Handlers and timers must not
+block: anything slow (HTTP, DNS) stays on its own thread.
+
+Only the loop thread may add timers. Other threads hand work to the
+loop with submit(), which wakes it through a socket pair.
+"""
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from timer_wheel import TimerWheel
+
+
+# Datagrams taken from one socket per wakeup before the others get a turn
+max_burst = 64
+
+
+class HandlerStats:
+    """Call count and processing time of one handler or timer"""
+
+    __slots__ = ("calls", "busy", "worst", "errors")
+
+    def __init__(self):
+        self.calls = 0
+        self.busy = 0.0
+        self.worst = 0.0
+        self.errors = 0
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "busy_ms": round(self.busy * 1e3, 3),
+            "mean_us": round(self.busy / self.calls * 1e6, 2) if self.calls else 0,
+            "max_us": round(self.worst * 1e6, 1),
+            "errors": self.errors
+        }
+
+
+class EventLoop:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = TimerWheel()
+        self.stats = {}
+        self.wakeups = 0
+        self.datagrams = 0
+        self.thread = None
+        self.submitted = deque()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_w.setblocking(False)
+        self.add_datagram_handler("submitted", self.wake_r, self.run_submitted, 4096)
+
+    def add_datagram_handler(self, name, sock, handler, bufsize=65535):
+        """Call handler(data, src) for every datagram arriving on sock"""
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, (name, handler, bufsize))
+        self.stats.setdefault(name, HandlerStats())
+
+    def call_later(self, delay, name, fn, *args):
+        return self.timers.call_later(delay, name, fn, *args)
+
+    def call_every(self, period, name, fn):
+        return self.timers.call_every(period, name, fn)
+
+    def cancel(self, timer):
+        self.timers.cancel(timer)
+
+    def submit(self, name, fn, *args):
+        """Run fn(*args) on the loop thread: at once if called from it,
+        otherwise as soon as the loop wakes, in the order submitted
+        """
+        if threading.get_ident() == self.thread:
+            self.dispatch(name, fn, *args)
+            return
+        self.submitted.append((name, fn, args))
+        try:
+            self.wake_w.send(b"\0")
+        except BlockingIOError:
+            # Wake bytes already pending: the loop is waking anyway
+            pass
+
+    def run_submitted(self, data, src):
+        while self.submitted:
+            name, fn, args = self.submitted.popleft()
+            self.dispatch(name, fn, *args)
+
+    def dispatch(self, name, fn, *args):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = HandlerStats()
+        start = time.perf_counter()
+        try:
+            fn(*args)
+        except Exception as e:
+            stats.errors += 1
+            print(f"[IED] {name} handler error: {e}")
+        elapsed = time.perf_counter() - start
+        stats.calls += 1
+        stats.busy += elapsed
+        if elapsed > stats.worst:
+            stats.worst = elapsed
+
+    def run_forever(self):
+        self.thread = threading.get_ident()
+        while True:
+            events = self.selector.select(self.timers.timeout(time.monotonic()))
+            self.wakeups += 1
+
+            for key, _ in events:
+                name, handler, bufsize = key.data
+                sock = key.fileobj
+                for _ in range(max_burst):
+                    try:
+                        data, src = sock.recvfrom(bufsize)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError as e:
+                        self.stats[name].errors += 1
+                        print(f"[IED] {name} receive error: {e}")
+                        break
+                    self.datagrams += 1
+                    self.dispatch(name, handler, data, src)
+
+            self.run_timers()
+
+    def run_timers(self):
+        for timer in self.timers.expired(time.monotonic()):
+            if not timer.cancelled:
+                self.dispatch(timer.name, timer.fn, *timer.args)
+
+    def snapshot(self):
+        return {
+            "wakeups": self.wakeups,
+            "datagrams": self.datagrams,
+            "timers_pending": self.timers.pending,
+            "timer_late_max_ms": round(self.timers.late_max * 1e3, 3),
+            "handlers": {name: s.as_dict() for name, s in self.stats.items()}
+        }
@@ -0,0 +1,311 @@
+"""
+MMS Report Server
+
+Author: Zein Ali
+Date: 10/08/2025
+
+An MMS-like server on a persistent TCP connection, so SCADA subscribes
+once and is sent changes as they happen instead of polling over HTTP.
+Requests and reports are JSON, one object per line:
+
+    {"id": 1, "req": "read", "ref": "XCBR1.Pos.stVal"}
+    {"id": 2, "req": "write", "ref": "XCBR1.Pos.Oper", "value": {"ctlVal": "TRIP", "ctlNum": 3}}
+    {"id": 3, "req": "enable", "rcb": "brcbStatus01", "entryID": 41, "gi": true}
+    {"id": 4, "req": "disable", "rcb": "brcbStatus01"}
+    {"id": 5, "req": "gi", "rcb": "urcbMeas01"}
+    {"id": 6, "req": "dir"}
+
+Each request is answered with {"id": ..., "ok": true, ...} or
+{"id": ..., "ok": false, "error": ...}. Reports, and the termination of
+a command written to a control, come unasked:
+
+    {"rpt": "brcbStatus01", "sqNum": 7, "entryID": 42, "time": ...,
+     "reason": ["dchg"], "values": {"XCBR1.Pos.stVal": "OPEN"}}
+    {"cmdTerm": "XCBR1.Pos", "ctlVal": "TRIP", "ctlNum": 3, "ok": true, "addCause": null}
+
+A report control block watches a dataset of references in the data
+model. A data change (dchg) or quality change (qchg) of a member is
+reported, alone or gathered with others over the block's buffer time;
+integrity reports send the whole dataset every IntgPd, and a general
+interrogation (gi) sends it on request. A block is owned by one client
+at a time. An unbuffered block (URCB) reports only while enabled. A
+buffered block (BRCB) keeps its reports whether or not anyone is
+listening, numbered by entryID, so a client that reconnects and enables
+it with the last entryID it saw is sent everything after it, with
+bufOvfl set if some had already been dropped.
+
+The server runs its own asyncio loop on a thread; the data model's
+watcher hands changes over to it.
+"""
+import asyncio
+import json
+import time
+from collections import deque
+
+
+# Per client bytes queued for sending before it is taken to be stuck and
+# dropped; a buffered block keeps its reports for when it comes back
+MAX_QUEUED = 1 << 20
+
+TRIGGERS = ("dchg", "qchg", "integrity", "gi")
+
+
+class ReportControl:
+    """One report control block and its dataset"""
+
+    def __init__(self, name, dataset, buffered=False, trg_ops=TRIGGERS,
+                 intg_pd=0.0, buf_tm=0.0, max_entries=256):
+        self.name = name
+        self.dataset = tuple(dataset)
+        # Members whose change is a quality change rather than a data change
+        self.quality = {ref for ref in self.dataset if ref.rsplit(".", 1)[-1] in ("q", "quality")}
+        self.buffered = buffered
+        self.trg_ops = set(trg_ops)
+        self.intg_pd = intg_pd
+        self.buf_tm = buf_tm
+        self.buffer = deque(maxlen=max_entries) if buffered else None
+
+        self.owner = None
+        self.enabled = False
+        self.sq_num = 0
+        self.entry_id = 0
+        self.pending = {}
+        self.pending_reasons = set()
+        self.flush_handle = None
+        self.reports = 0
+        self.dropped = 0
+
+    def as_dict(self):
+        return {
+            "buffered": self.buffered,
+            "dataset": list(self.dataset),
+            "trgOps": sorted(self.trg_ops),
+            "intgPd": self.intg_pd,
+            "bufTm": self.buf_tm,
+            "enabled": self.enabled,
+            "sqNum": self.sq_num,
+            "entryID": self.entry_id,
+            "buffered_entries": len(self.buffer) if self.buffered else None,
+            "reports": self.reports,
+            "dropped": self.dropped
+        }
+
+
+class Client:
+    def __init__(self, writer):
+        self.writer = writer
+        self.peer = writer.get_extra_info("peername")
+        self.closed = False
+
+    def send(self, obj):
+        if self.closed:
+            return False
+        if self.writer.transport.get_write_buffer_size() > MAX_QUEUED:
+            print(f"[MMS] Client {self.peer} is not keeping up; dropping it")
+            self.closed = True
+            self.writer.close()
+            return False
+        self.writer.write(json.dumps(obj).encode() + b"\n")
+        return True
+
+
+class MmsServer:
+    def __init__(self, model, port, rcbs, on_write=None, host="0.0.0.0"):
+        """on_write(ref, value, client) returns None when the write is
+        accepted, or the reason it is refused
+        """
+        self.model = model
+        self.host = host
+        self.port = port
+        self.rcbs = {rcb.name: rcb for rcb in rcbs}
+        self.on_write = on_write
+        self.members = {}
+        for rcb in rcbs:
+            for ref in rcb.dataset:
+                if model.resolve(ref) is None:
+                    raise ValueError(f"{rcb.name}: no attribute {ref} in the model")
+                self.members.setdefault(ref, []).append(rcb)
+        self.loop = None
+        self.clients = set()
+        self.requests = 0
+        model.watch(self.notify)
+
+    def run(self):
+        """Serve forever; run on a thread of its own"""
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f"[MMS] Serving reports on TCP {self.port}")
+        for rcb in self.rcbs.values():
+            if rcb.intg_pd and "integrity" in rcb.trg_ops:
+                self.loop.create_task(self.integrity(rcb))
+        async with server:
+            await server.serve_forever()
+
+    # Data model side
+
+    def notify(self, changes):
+        """Model watcher, on the writing thread"""
+        if self.loop is not None and any(ref in self.members for ref in changes):
+            self.loop.call_soon_threadsafe(self.changed, changes, time.time())
+
+    def changed(self, changes, ts):
+        for ref, value in changes.items():
+            for rcb in self.members.get(ref, ()):
+                reason = "qchg" if ref in rcb.quality else "dchg"
+                if reason not in rcb.trg_ops:
+                    continue
+                rcb.pending[ref] = value
+                rcb.pending_reasons.add(reason)
+                if not rcb.buf_tm:
+                    continue
+                if rcb.flush_handle is None:
+                    rcb.flush_handle = self.loop.call_later(rcb.buf_tm, self.flush, rcb, ts)
+        for rcb in self.rcbs.values():
+            if rcb.pending and not rcb.buf_tm:
+                self.flush(rcb, ts)
+
+    def flush(self, rcb, ts):
+        rcb.flush_handle = None
+        values, reasons = rcb.pending, rcb.pending_reasons
+        rcb.pending, rcb.pending_reasons = {}, set()
+        if values:
+            self.report(rcb, sorted(reasons), values, ts)
+
+    def dataset_values(self, rcb):
+        return {ref: self.model.get(ref) for ref in rcb.dataset}
+
+    def report(self, rcb, reasons, values, ts):
+        """Number a report, buffer it if the block is buffered, and send it
+        to the owner if the block is enabled
+        """
+        if not rcb.buffered and not rcb.enabled:
+            return
+        rcb.sq_num = (rcb.sq_num + 1) % 65536
+        msg = {"rpt": rcb.name, "sqNum": rcb.sq_num, "time": ts, "reason": reasons, "values": values}
+        if rcb.buffered:
+            rcb.entry_id += 1
+            msg["entryID"] = rcb.entry_id
+            if len(rcb.buffer) == rcb.buffer.maxlen:
+                rcb.dropped += 1
+            rcb.buffer.append(msg)
+        if rcb.enabled and rcb.owner.send(msg):
+            rcb.reports += 1
+
+    async def integrity(self, rcb):
+        while True:
+            await asyncio.sleep(rcb.intg_pd)
+            if rcb.enabled:
+                self.report(rcb, ["integrity"], self.dataset_values(rcb), time.time())
+
+    def send(self, client, msg):
+        """Send a client something unasked (a command termination) from any
+        thread
+        """
+        self.loop.call_soon_threadsafe(client.send, msg)
+
+    # Client side
+
+    async def handle(self, reader, writer):
+        client = Client(writer)
+        self.clients.add(client)
+        print(f"[MMS] Association from {client.peer}")
+        try:
+            while not client.closed:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    msg = json.loads(line)
+                    reply = self.request(client, msg)
+                except Exception as e:
+                    msg, reply = {}, {"ok": False, "error": str(e)}
+                reply["id"] = msg.get("id") if isinstance(msg, dict) else None
+                client.send(reply)
+                if isinstance(msg, dict) and msg.get("req") == "enable" and reply["ok"]:
+                    self.resume(client, self.rcbs[msg["rcb"]], msg)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.release(client)
+            writer.close()
+            print(f"[MMS] Association from {client.peer} closed")
+
+    def release(self, client):
+        client.closed = True
+        self.clients.discard(client)
+        for rcb in self.rcbs.values():
+            if rcb.owner is client:
+                rcb.owner = None
+                rcb.enabled = False
+
+    def request(self, client, msg):
+        self.requests += 1
+        req = msg.get("req")
+        if req == "read":
+            refs = msg["refs"] if "refs" in msg else [msg["ref"]]
+            missing = [ref for ref in refs if self.model.resolve(ref) is None]
+            if missing:
+                return {"ok": False, "error": f"no such object: {', '.join(missing)}"}
+            values = {ref: self.model.get(ref) for ref in refs}
+            if "refs" in msg:
+                return {"ok": True, "values": values}
+            return {"ok": True, "value": values[msg["ref"]]}
+
+        if req == "write":
+            ref = msg["ref"]
+            if self.model.resolve(ref) is None:
+                return {"ok": False, "error": f"no such object: {ref}"}
+            error = self.on_write(ref, msg.get("value"), client) if self.on_write else "read only"
+            return {"ok": False, "error": error} if error else {"ok": True}
+
+        if req == "dir":
+            return {"ok": True, "objects": list(self.model.index),
+                    "rcbs": {name: rcb.as_dict() for name, rcb in self.rcbs.items()}}
+
+        rcb = self.rcbs.get(msg.get("rcb"))
+        if rcb is None:
+            return {"ok": False, "error": f"no such report control block: {msg.get('rcb')}"}
+        if rcb.owner is not None and rcb.owner is not client:
+            return {"ok": False, "error": f"{rcb.name} is reserved by another client"}
+
+        if req == "enable":
+            rcb.owner = client
+            return {"ok": True, "rcb": rcb.name, "entryID": rcb.entry_id, "sqNum": rcb.sq_num}
+        if req == "disable":
+            rcb.enabled = False
+            rcb.owner = None
+            return {"ok": True}
+        if req == "gi":
+            if not rcb.enabled:
+                return {"ok": False, "error": f"{rcb.name} is not enabled"}
+            self.report(rcb, ["gi"], self.dataset_values(rcb), time.time())
+            return {"ok": True}
+        return {"ok": False, "error": f"unknown request {req}"}
+
+    def resume(self, client, rcb, msg):
+        """After an enable has been answered: replay what a buffered block
+        kept since the client's last entryID, then a GI if asked for
+        """
+        last = msg.get("entryID")
+        if rcb.buffered and isinstance(last, int):
+            if last > rcb.entry_id:
+                # An entryID from before this server started: all of it is new
+                last = 0
+            missed = [e for e in rcb.buffer if e["entryID"] > last]
+            overflow = bool(rcb.buffer) and rcb.buffer[0]["entryID"] > last + 1
+            for entry in missed:
+                client.send(dict(entry, replay=True, bufOvfl=overflow))
+        rcb.enabled = True
+        if msg.get("gi") and "gi" in rcb.trg_ops:
+            self.report(rcb, ["gi"], self.dataset_values(rcb), time.time())
+
+    def counters(self):
+        return {
+            "port": self.port,
+            "clients": [str(c.peer) for c in self.clients],
+            "requests": self.requests,
+            "rcbs": {name: rcb.as_dict() for name, rcb in self.rcbs.items()}
+        }
@@ -0,0 +1,215 @@
+"""
+Power Quality Analysis
+
+Author: Zein Ali
+Date: 12/08/2025
+
+Power quality figures from the subscribed SV stream, in the manner of
+IEC 61000-4-7: gapless windows of ten nominal cycles (200 ms at 50 Hz),
+Hann windowed and transformed with one real FFT per channel. From each
+window:
+
+    harmonics    RMS of each harmonic up to the 50th, summed over the
+                 bin nearest h times the measured fundamental and its
+                 two neighbours, so the groups follow the frequency
+    THD          harmonics 2 and up against the fundamental, in %
+    sequence     zero, positive and negative sequence voltage and current
+    unbalance    negative and zero sequence against positive, in %
+    frequency    fundamental, interpolated between bins, and its
+                 deviation from nominal
+
+A harmonic at or above half the sample rate cannot be seen, so the
+80 samples a cycle protection stream gives the 39th at most; the 256
+samples a cycle stream (MU1-PQ) gives all 50.
+
+The SV handler only copies each frame into one of two preallocated
+window buffers. A full buffer goes to the worker thread, which does the
+FFTs and hands the results (MHAI1 and MSQI1 attributes) to on_result,
+so the SV receive path never waits for an FFT. If the worker is still
+busy with the last window when the next is full, the next is dropped.
+"""
+import math
+import queue
+import time
+import numpy as np
+
+
+A_OP = np.exp(2j * math.pi / 3)
+
+CYCLES = 10
+HARMONICS = 50
+
+PHASES = ("phsA", "phsB", "phsC")
+
+# Channel order of SvBatch.values
+CURRENTS = slice(0, 3)
+VOLTAGES = slice(3, 6)
+
+
+def pq_template(harmonics):
+    """MHAI1 and MSQI1 for the data model, none measured yet"""
+    def mag():
+        return {"mag": {"f": None}}
+
+    def cmv():
+        return {"mag": {"f": None}, "ang": {"f": None}}
+
+    return {
+        "MHAI1": {
+            "NumHar": harmonics,
+            "HPhV": {phs: [None] * harmonics for phs in PHASES},
+            "HA": {phs: [None] * harmonics for phs in PHASES},
+            "ThdPhV": {phs: mag() for phs in PHASES},
+            "ThdA": {phs: mag() for phs in PHASES},
+            "Hz": mag(),
+            "HzDev": mag(),
+            "timestamp": None
+        },
+        "MSQI1": {
+            "SeqV": {"c1": cmv(), "c2": cmv(), "c3": cmv()},
+            "SeqA": {"c1": cmv(), "c2": cmv(), "c3": cmv()},
+            "ImbNgV": mag(),
+            "ImbZroV": mag(),
+            "ImbNgA": mag(),
+            "ImbZroA": mag(),
+            "timestamp": None
+        }
+    }
+
+
+class PowerQuality:
+    def __init__(self, spc, on_result, nominal_hz=50.0, harmonics=HARMONICS):
+        self.spc = spc
+        self.nominal_hz = nominal_hz
+        self.n = CYCLES * spc
+        # Highest harmonic below half the sample rate, with room for its
+        # upper neighbour bin
+        self.harmonics = min(harmonics, (self.n // 2 - 1) // CYCLES)
+        self.on_result = on_result
+
+        self.window = np.hanning(self.n + 1)[:-1]
+        self.power_scale = 2.0 / (self.n * float(np.sum(self.window ** 2)))
+        self.phasor_scale = 2.0 / float(np.sum(self.window)) / math.sqrt(2)
+        self.orders = np.arange(1, self.harmonics + 1)
+        self.spread = np.array([[-1], [0], [1]])
+
+        self.buffers = np.zeros((2, self.n, 6))
+        self.filling = 0
+        self.pos = 0
+        self.free = queue.Queue()
+        self.free.put(1)
+        self.ready = queue.Queue()
+
+        self.windows = 0
+        self.dropped = 0
+        self.cpu_last = 0.0
+        self.cpu_total = 0.0
+        self.cpu_max = 0.0
+
+    def add(self, values):
+        """Copy one SV frame, an (n, 6) array, into the window being filled"""
+        k = 0
+        while k < len(values):
+            take = min(len(values) - k, self.n - self.pos)
+            self.buffers[self.filling, self.pos:self.pos + take] = values[k:k + take]
+            self.pos += take
+            k += take
+            if self.pos == self.n:
+                self.pos = 0
+                try:
+                    nxt = self.free.get_nowait()
+                except queue.Empty:
+                    # Worker still busy: this window is overwritten
+                    self.dropped += 1
+                    continue
+                self.ready.put(self.filling)
+                self.filling = nxt
+
+    def run(self):
+        """Analyse windows as they fill; run on a thread of its own"""
+        while True:
+            i = self.ready.get()
+            start = time.thread_time()
+            try:
+                result = self.analyse(self.buffers[i])
+            except Exception as e:
+                print(f"[PQ] Analysis error: {e}")
+                result = None
+            finally:
+                self.free.put(i)
+            cpu = time.thread_time() - start
+            self.windows += 1
+            self.cpu_last = cpu
+            self.cpu_total += cpu
+            self.cpu_max = max(self.cpu_max, cpu)
+            if result:
+                self.on_result(result)
+
+    def analyse(self, samples):
+        spectrum = np.fft.rfft(samples * self.window[:, None], axis=0)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        freq = self.frequency(np.sqrt(power[:, 3]))
+
+        # RMS of each harmonic (rows) for each channel (columns), over the
+        # bins around where it actually is
+        f = freq if freq is not None else self.nominal_hz
+        centres = np.rint(self.orders * f * CYCLES / self.nominal_hz).astype(int)
+        groups = np.clip(centres + self.spread, 0, len(power) - 1)
+        rms = np.sqrt(power[groups].sum(axis=0) * self.power_scale)
+        fund = rms[0]
+        thd = np.where(fund > 1e-9, np.sqrt((rms[1:] ** 2).sum(axis=0)) / np.maximum(fund, 1e-9) * 100, 0.0)
+
+        # Fundamental phasors (RMS), angles referenced to Ua
+        ph = spectrum[centres[0]] * self.phasor_scale
+        ph = ph * np.exp(-1j * np.angle(ph[3]))
+
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + "Z"
+        out = {"MHAI1.timestamp": stamp, "MSQI1.timestamp": stamp}
+        for k, phs in enumerate(PHASES):
+            out[f"MHAI1.HPhV.{phs}"] = [round(float(v), 2) for v in rms[:, 3 + k]]
+            out[f"MHAI1.HA.{phs}"] = [round(float(v), 2) for v in rms[:, k]]
+            out[f"MHAI1.ThdPhV.{phs}.mag.f"] = round(float(thd[3 + k]), 3)
+            out[f"MHAI1.ThdA.{phs}.mag.f"] = round(float(thd[k]), 3)
+
+        for name, chans in (("V", VOLTAGES), ("A", CURRENTS)):
+            a, b, c = ph[chans]
+            seq = {"c3": (a + b + c) / 3,
+                   "c1": (a + A_OP * b + A_OP ** 2 * c) / 3,
+                   "c2": (a + A_OP ** 2 * b + A_OP * c) / 3}
+            for comp, v in seq.items():
+                out[f"MSQI1.Seq{name}.{comp}.mag.f"] = round(float(abs(v)), 2)
+                out[f"MSQI1.Seq{name}.{comp}.ang.f"] = round(float(np.degrees(np.angle(v))), 2) + 0.0
+            pos = abs(seq["c1"])
+            out[f"MSQI1.ImbNg{name}.mag.f"] = round(float(abs(seq["c2"]) / pos * 100), 3) if pos > 1e-9 else None
+            out[f"MSQI1.ImbZro{name}.mag.f"] = round(float(abs(seq["c3"]) / pos * 100), 3) if pos > 1e-9 else None
+
+        out["MHAI1.Hz.mag.f"] = round(freq, 3) if freq is not None else None
+        out["MHAI1.HzDev.mag.f"] = round(freq - self.nominal_hz, 3) + 0.0 if freq is not None else None
+        return out
+
+    def frequency(self, mag):
+        """Fundamental from the Hann windowed spectrum of Ua: the peak bin
+        near the tenth, moved towards the larger neighbour
+        """
+        k = CYCLES - 1 + int(np.argmax(mag[CYCLES - 1:CYCLES + 2]))
+        if mag[k] < 1e-9:
+            return None
+        if mag[k + 1] >= mag[k - 1]:
+            ratio = mag[k + 1] / mag[k]
+            delta = (2 * ratio - 1) / (ratio + 1)
+        else:
+            ratio = mag[k - 1] / mag[k]
+            delta = -(2 * ratio - 1) / (ratio + 1)
+        return (k + delta) * self.nominal_hz / CYCLES
+
+    def counters(self):
+        return {
+            "windowMs": round(CYCLES / self.nominal_hz * 1e3),
+            "samplesPerWindow": self.n,
+            "harmonics": self.harmonics,
+            "windows": self.windows,
+            "dropped": self.dropped,
+            "cpuMsLast": round(self.cpu_last * 1e3, 3),
+            "cpuMsMean": round(self.cpu_total / self.windows * 1e3, 3) if self.windows else 0,
+            "cpuMsMax": round(self.cpu_max * 1e3, 3)
+        }
@@ -0,0 +1,169 @@
+"""
+Hashed Timer Wheel
+
+Author: Zein Ali
+Date: 06/08/2025
+
+Deferred actions of the IEDs and P-IEDs (breaker response checks, lockout
+cooldowns, GOOSE retransmissions, timeAllowedtoLive expiry) kept on one
+wheel rather than a thread per timer. Time is cut into ticks and a timer
+due at tick t sits in slot t % slots, so adding or cancelling one is
+O(1) and a tick only looks at its own slot. Timers more than one turn
+ahead share a slot and are skipped until their turn comes round. Each
+slot keeps the earliest tick among its timers, so the next tick worth
+waking for is found by walking forward from the hand to the first slot
+with a timer due this turn, usually a few slots away.
+
+The wheel is driven either by an event loop, which calls expired() and
+runs the callbacks itself, or by run_forever() on a thread of its own.
+Callbacks must not block.
+"""
+import threading
+import time
+
+
+# Tick length in seconds and slots per turn: 2 ms ticks, about 1 s a turn
+TICK = 0.002
+SLOTS = 512
+
+
+class Timer:
+    """Handle returned by call_later() and call_every(), for cancel()"""
+
+    __slots__ = ("due", "name", "fn", "args", "period", "active", "cancelled")
+
+    def __init__(self, due, name, fn, args, period):
+        self.due = due
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.period = period
+        # On the wheel, and cancelled (which also stops one already taken
+        # off the wheel but not yet run)
+        self.active = True
+        self.cancelled = False
+
+
+class TimerWheel:
+    def __init__(self, tick=TICK, slots=SLOTS):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.start = time.monotonic()
+        self.current = 0
+        self.pending = 0
+        # Earliest tick a timer may be due; may be early after a cancel
+        self.next_due = None
+        # Earliest tick of each slot's timers; may be early after a cancel
+        self.slot_due = [None] * slots
+        self.late_max = 0.0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def call_later(self, delay, name, fn, *args):
+        return self.add(Timer(None, name, fn, args, None), delay)
+
+    def call_every(self, period, name, fn):
+        return self.add(Timer(None, name, fn, (), period), period)
+
+    def add(self, timer, delay):
+        with self.lock:
+            # Rounded up, so a timer never fires early
+            due = -int(-(time.monotonic() + delay - self.start) // self.tick)
+            self.put(timer, max(due, self.current + 1))
+        self.wakeup.set()
+        return timer
+
+    def put(self, timer, due):
+        timer.due = due
+        timer.active = True
+        slot = due % len(self.slots)
+        self.slots[slot].add(timer)
+        if self.slot_due[slot] is None or due < self.slot_due[slot]:
+            self.slot_due[slot] = due
+        self.pending += 1
+        if self.next_due is None or due < self.next_due:
+            self.next_due = due
+
+    def cancel(self, timer):
+        with self.lock:
+            timer.cancelled = True
+            if timer.active:
+                timer.active = False
+                self.slots[timer.due % len(self.slots)].discard(timer)
+                self.pending -= 1
+
+    def expired(self, now):
+        """Take the timers due by now off the wheel, in order. Periodic ones
+        go back on for their next beat, skipping any missed while late.
+        """
+        target = int((now - self.start) / self.tick)
+        fired = []
+        with self.lock:
+            # Nothing is due before next_due, so the hand can jump there
+            if self.next_due is None or target < self.next_due:
+                self.current = max(self.current, target)
+                return fired
+            self.current = max(self.current, self.next_due - 1)
+            while self.current < target:
+                self.current += 1
+                slot = self.current % len(self.slots)
+                bucket = self.slots[slot]
+                if not bucket:
+                    continue
+                for timer in [t for t in bucket if t.due <= self.current]:
+                    bucket.discard(timer)
+                    timer.active = False
+                    self.pending -= 1
+                    fired.append(timer)
+                self.slot_due[slot] = min((t.due for t in bucket), default=None)
+
+            for timer in fired:
+                late = now - (self.start + timer.due * self.tick)
+                if late > self.late_max:
+                    self.late_max = late
+                if timer.period:
+                    step = max(1, round(timer.period / self.tick))
+                    due = timer.due + step
+                    if due <= self.current:
+                        due = self.current + step
+                    self.put(timer, due)
+
+            self.next_due = self.find_next(self.current + 1) if self.pending else None
+        return fired
+
+    def find_next(self, start):
+        """Earliest tick from start on that a timer may be due. A slot's
+        timers fall due no sooner than its next tick from start, nor than
+        its earliest tick, so the walk stops at the first slot with a timer
+        due in this turn
+        """
+        best = None
+        for tick in range(start, start + len(self.slots)):
+            slot = tick % len(self.slots)
+            if not self.slots[slot]:
+                continue
+            due = max(self.slot_due[slot], tick)
+            if best is None or due < best:
+                best = due
+            if due == tick:
+                break
+        return best
+
+    def timeout(self, now):
+        """Seconds until the next timer may be due, or None with none pending"""
+        if not self.pending or self.next_due is None:
+            return None
+        return max(self.start + self.next_due * self.tick - now, 0.0)
+
+    def run_forever(self):
+        """Drive the wheel from the calling thread, running callbacks on it"""
+        while True:
+            self.wakeup.clear()
+            for timer in self.expired(time.monotonic()):
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.fn(*timer.args)
+                except Exception as e:
+                    print(f"[TIMER] {timer.name} error: {e}")
+            self.wakeup.wait(self.timeout(time.monotonic()))
@@ -0,0 +1,67 @@
+"""
+Anti-alias Decimation
+
+Author: Zein Ali
+Date: 26/07/2025
+
+Cuts lower rate SV streams out of one high-rate source waveform, so the
+MU synthesises (or replays) each bay once and the 80 samples/cycle
+protection stream and the 256 samples/cycle power quality stream are two
+views of the same signal.
+
+Each output stream has its own linear phase Kaiser windowed-sinc low-pass,
+evaluated only at the samples it keeps. All filters are 2 * DELAY + 1 taps,
+so every stream lags the source by exactly DELAY source samples; the source
+runs DELAY samples ahead to cancel that, keeping decimated streams on the
+same time grid as directly synthesised ones.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Filter half length in source samples; a source cycle must be at least 2 * DELAY
+DELAY = 160
+
+# Kaiser window shape, about 80 dB stopband
+KAISER_BETA = 8.0
+
+# -6 dB point as a fraction of the output Nyquist frequency
+CUTOFF = 0.8
+
+
+def design_filter(factor, delay=DELAY):
+    """Unity gain low-pass for keeping every factor-th sample"""
+    n = np.arange(2 * delay + 1) - delay
+    fc = CUTOFF / (2 * factor)
+    taps = 2 * fc * np.sinc(2 * fc * n) * np.kaiser(len(n), KAISER_BETA)
+    return taps / taps.sum()
+
+
+class Decimator:
+    """Turns consecutive source cycles into output cycles of one stream.
+
+    The filter reaches 2 * DELAY samples back into the previous cycle, kept
+    per cycle so a cycle rebuilt after a breaker change sees the same
+    history. After a gap (resync, first cycle) the waveform is taken as
+    periodic and the current cycle stands in for the previous one.
+    """
+
+    def __init__(self, factor, delay=DELAY):
+        self.factor = factor
+        self.delay = delay
+        self.taps = design_filter(factor, delay) if factor > 1 else None
+        self.tails = {}
+
+    def process(self, cycle, block):
+        """Filter and decimate one (n, 7) source cycle to (n // factor, 7)"""
+        span = 2 * self.delay
+        history = self.tails.get(cycle - 1)
+        if history is None:
+            history = block[-span:]
+        self.tails = {cycle - 1: history, cycle: block[-span:]}
+
+        ext = np.concatenate((history, block))
+        if self.taps is None:
+            return ext[self.delay:self.delay + len(block)]
+        windows = sliding_window_view(ext, len(self.taps), axis=0)[::self.factor]
+        return windows[:len(block) // self.factor] @ self.taps
@@ -6,19 +6,85 @@ Date: 17/06/2025
 
 """
 import socket
+import struct
 import json
 import time
 import math
-import random
-import requests
+import os
+import heapq
+import threading
+import multiprocessing as mp
+import numpy as np
+from flask import Flask, jsonify, request
+from sv_codec import encode, ENCODINGS, MAX_ASDU
+from scenarios import load_scenarios, build_scenario, ScenarioPlayer
+from replay import Replay
+from network import Network
+from prp import PrpSender
+from decimate import Decimator, DELAY
 
 
 MCAST = '239.192.0.1'
 svport = 10010
-interval = 0.1
-freq = 50.0 
+freq = 50.0
 omega = 2 * math.pi * freq
 
+# Breaker position push channel (see breaker.publish_position)
+BREAKER_MCAST = '224.1.1.2'
+breaker_port = 10202
+breaker_timeout = 3.0
+BREAKER_STATES = ["UNKNOWN", "CLOSED", "OPEN"]
+
+# Stream definitions; without the file the MU publishes the single MU1-SV stream
+STREAMS_FILE = os.getenv("MU_STREAMS", "streams.json")
+
+# Recording to replay on streams without their own "replay" entry (empty = synthetic)
+replay_file = os.getenv("MU_REPLAY", "")
+replay_speed = float(os.getenv("MU_REPLAY_SPEED", "1"))
+replay_loop = os.getenv("MU_REPLAY_LOOP", "1") not in ("0", "false", "no")
+
+# Network model; streams with a "measure" point publish its voltages and currents
+NETWORK_FILE = os.getenv("MU_NETWORK", "network.json")
+
+# Waveform settings a stream cut from a shared source takes from the first
+# stream of that source
+SOURCE_KEYS = ("measure", "replay", "phase_deg", "current_angle_deg", "load", "follow_breaker")
+
+# Publisher processes the streams are sharded across (0 = one per CPU)
+workers = int(os.getenv("MU_WORKERS", "0")) or os.cpu_count() or 1
+
+STATS_PORT = 5010
+
+# Fault/disturbance scenarios, triggered over HTTP on STATS_PORT or UDP here
+SCENARIOS_FILE = os.getenv("MU_SCENARIOS", "scenarios.json")
+CONTROL_PORT = 10203
+
+# Lead time for triggers that do not name a sample index, long enough to
+# render the scenario and hand it to the publishers before it is due
+trigger_delay_ms = 200
+
+# Defaults for streams that do not set their own.
+# IEC 61850-9-2LE rates: 80 samples/cycle (protection) or 256 (power quality)
+samples_per_cycle = int(os.getenv("SV_SPC", "80"))
+
+# Consecutive samples packed into each frame (9-2LE uses 1 at 80 spc, 8 at 256 spc)
+no_asdu = int(os.getenv("SV_NOASDU", "1"))
+
+# 9-2LE binary frames, or "json" as a human readable debug fallback
+sv_encoding = os.getenv("SV_ENCODING", "binary").lower()
+
+# Busy-wait this long before each deadline instead of sleeping (0 = sleep only)
+spin_time = float(os.getenv("SV_SPIN_US", "0")) / 1e6
+
+# If a stream falls further behind than this it resyncs instead of bursting
+max_lag = 0.1
+stats_period = 1.0
+report_period = 5.0
+
+# Noise table length, not a multiple of samples_per_cycle so the noise
+# pattern does not lock onto the waveform
+noise_len = 8191
+
 
 voltpeak = 11000 / math.sqrt(3) * math.sqrt(2)
 currpeak = 500 * math.sqrt(2)
@@ -30,79 +96,722 @@ PHASE_SHIFT = {
     "Ic": 2 * math.pi / 3
 }
 
-def generate_sample(t, amplitude, shift):
-    """Generate sine wave with noise and phase shift"""
-    noise = random.uniform(-0.01, 0.01) * amplitude
-    return round(amplitude * math.sin(omega * t + shift) + noise, 2)
+# Per-stream statistics, laid out as consecutive slots in a shared array
+STAT_FIELDS = ["rate_hz", "mean_late_us", "jitter_us", "max_late_us", "resyncs", "sent"]
 
-def get_breaker_status():
-    try:
-        response = requests.get("http://breaker:5002/status", timeout=1)
-        if response.ok:
-            data = response.json()
-            return data.get("state", "UNKNOWN")
-            
-    except Exception as e:
-        print("[MU] Failed to get breaker status:", e)
-    return "UNKNOWN"
+app = Flask(__name__)
+stream_configs = []
+shared_stats = None
+publish_start = 0.0
+scenario_library = {}
+network = None
+control_streams = {}
+control_queues = []
+armed_scenarios = {}
+control_lock = threading.Lock()
 
 
-def main():
+def build_wave_table(amplitude, spc, shift=0.0):
+    """One cycle of the three phase sine, shape (spc, 3)"""
+    theta = 2 * np.pi * np.arange(spc) / spc + shift
+    shifts = np.array([PHASE_SHIFT["Ia"], PHASE_SHIFT["Ib"], PHASE_SHIFT["Ic"]])
+    return amplitude * np.sin(theta[:, None] + shifts[None, :])
+
+
+def build_noise_table(seed=None):
+    """Uniform ±1% noise for the six channels plus a ±0.02 Hz frequency wobble"""
+    rng = np.random.default_rng(seed)
+    noise = np.empty((noise_len, 7))
+    noise[:, :6] = rng.uniform(-0.01, 0.01, (noise_len, 6))
+    noise[:, 6] = rng.uniform(-0.02, 0.02, noise_len)
+    return noise
+
+
+NOISE_TABLE = build_noise_table()
+
+
+def load_stream_configs():
+    """Read the stream list and fill in defaults for anything not given"""
+    if os.path.exists(STREAMS_FILE):
+        with open(STREAMS_FILE, "r", encoding="utf-8") as f:
+            configs = json.load(f)
+    else:
+        configs = [{"svID": "MU1-SV", "datSet": "MeasMU1"}]
+
+    # Streams naming the same "source" are decimated from one high-rate
+    # waveform, so only the first of them describes it
+    sources = {}
+    for cfg in configs:
+        if cfg.get("source"):
+            primary = sources.setdefault(cfg["source"], cfg)
+            for key in SOURCE_KEYS:
+                if key in primary and key not in cfg:
+                    cfg[key] = primary[key]
+
+    for i, cfg in enumerate(configs):
+        cfg.setdefault("svID", f"MU1-SV{i + 1}")
+        cfg.setdefault("datSet", f"MeasMU1-{i + 1}")
+        cfg.setdefault("group", MCAST)
+        cfg.setdefault("port", svport)
+        cfg.setdefault("phase_deg", 0.0)
+        cfg.setdefault("current_angle_deg", 0.0)
+        cfg.setdefault("load", 1.0)
+        cfg.setdefault("spc", samples_per_cycle)
+        cfg.setdefault("noASDU", no_asdu)
+        cfg.setdefault("encoding", sv_encoding)
+        cfg.setdefault("follow_breaker", True)
+        if replay_file and "replay" not in cfg:
+            cfg["replay"] = {"file": replay_file}
+        if cfg.get("replay"):
+            cfg["replay"].setdefault("speed", replay_speed)
+            cfg["replay"].setdefault("loop", replay_loop)
+
+    # The source rate defaults to the smallest common multiple of its
+    # streams' rates that leaves room for the decimation filters
+    for name, primary in sources.items():
+        members = [cfg for cfg in configs if cfg.get("source") == name]
+        spc = primary.get("source_spc") or math.lcm(*(cfg["spc"] for cfg in members))
+        if spc < 2 * DELAY:
+            spc *= -(-2 * DELAY // spc)
+        for cfg in members:
+            cfg["source_spc"] = spc
+    return configs
+
+
+def check_config(configs):
+    seen = set()
+    for cfg in configs:
+        name = cfg["svID"]
+        if name in seen:
+            raise ValueError(f"Duplicate svID {name}")
+        seen.add(name)
+        if cfg.get("measure"):
+            if network is None:
+                raise ValueError(f"{name}: has a measurement point but {NETWORK_FILE} is missing")
+            network.check_point(cfg["measure"])
+        if not 1 <= cfg["noASDU"] <= MAX_ASDU:
+            raise ValueError(f"{name}: noASDU must be between 1 and {MAX_ASDU}, got {cfg['noASDU']}")
+        if cfg["spc"] % cfg["noASDU"]:
+            raise ValueError(f"{name}: noASDU ({cfg['noASDU']}) must divide spc ({cfg['spc']})")
+        if cfg["encoding"] not in ENCODINGS:
+            raise ValueError(f"{name}: encoding must be one of {ENCODINGS}, got {cfg['encoding']!r}")
+        if cfg.get("replay"):
+            if not os.path.exists(cfg["replay"]["file"]):
+                raise ValueError(f"{name}: replay file {cfg['replay']['file']} not found")
+            if cfg["replay"]["speed"] <= 0:
+                raise ValueError(f"{name}: replay speed must be positive")
+        if cfg.get("source"):
+            if cfg["source_spc"] % cfg["spc"]:
+                raise ValueError(f"{name}: spc ({cfg['spc']}) must divide the source rate "
+                                 f"({cfg['source_spc']} samples/cycle)")
+            if cfg["source_spc"] < 2 * DELAY:
+                raise ValueError(f"{name}: source rate must be at least {2 * DELAY} samples/cycle")
+
+
+def build_streams(configs, indices):
+    """SvStreams for one shard. Streams sharing a source share one
+    high-rate generator, so a source must never be split across shards.
+    """
+    sources = {}
+    streams = []
+    for i in indices:
+        cfg = configs[i]
+        stream = SvStream(i, cfg)
+        if cfg.get("source"):
+            source = sources.get(cfg["source"])
+            if source is None:
+                source_cfg = dict(cfg, svID=cfg["source"], spc=cfg["source_spc"], noASDU=1)
+                source = sources[cfg["source"]] = SvStream(i, source_cfg, offset=DELAY)
+            stream.attach_source(source)
+        streams.append(stream)
+    return streams
+
+
+class SvStream:
+    """One published SV stream: its waveform tables, sample counter and
+    send statistics. A publisher process serves several of these.
+
+    A stream attached to a source is not synthesised itself but decimated
+    from the source's waveform; the source is an unpublished SvStream at
+    the high rate whose sample n sits offset samples ahead of the grid.
+    """
+
+    def __init__(self, index, cfg, offset=0):
+        self.index = index
+        self.svID = cfg["svID"]
+        self.datSet = cfg["datSet"]
+        self.addr = (cfg["group"], cfg["port"])
+        self.spc = cfg["spc"]
+        self.no_asdu = cfg["noASDU"]
+        self.encoding = cfg["encoding"]
+        self.follow_breaker = cfg["follow_breaker"]
+        # Replays can run faster than real time; samples keep their nominal
+        # spacing and smpCnt, frames simply leave speed times as often
+        self.replay_cfg = cfg.get("replay")
+        self.replay = None
+        self.speed = self.replay_cfg["speed"] if self.replay_cfg else 1.0
+        self.interval = 1.0 / (freq * self.spc * self.speed)
+        self.smp_wrap = int(round(freq * self.spc))
+
+        self.shift = math.radians(cfg["phase_deg"])
+        self.lag = math.radians(cfg["current_angle_deg"])
+        self.curr_amp = currpeak * cfg["load"]
+        # Voltage and current phasors from the network model, once set
+        self.phasors = None
+        self.open_amp = opencurr
+        self.offset = offset
+        lead = 2 * math.pi * offset / self.spc
+        self.volt_table = build_wave_table(voltpeak, self.spc, self.shift + lead)
+        self.curr_tables = {
+            "CLOSED": build_wave_table(self.curr_amp, self.spc, self.shift - self.lag + lead),
+            "OPEN": build_wave_table(opencurr, self.spc, self.shift - self.lag + lead)
+        }
+        # Streams read the shared noise table at different offsets so
+        # their noise is not identical
+        self.noise_offset = index * 997
+
+        self.sample_counter = 0
+        self.cycle = -1
+        self.samples = None
+        self.samples_status = None
+        self.scenario = None
+        self.source = None
+        self.decimator = None
+        self.blocks = {}
+        self.reset_stats()
+
+    def attach_source(self, source):
+        self.source = source
+        self.decimator = Decimator(source.spc // self.spc)
+
+    def reset_stats(self):
+        self.sent = 0
+        self.frames = 0
+        self.late_sum = self.late_sq_sum = self.late_max = 0.0
+
+    def generate_cycle(self, cycle, breaker_status):
+        """Build one cycle of samples, from the precomputed tables or
+        decimated from the source.
+
+        Returns a list of rows [Ia, Ib, Ic, Ua, Ub, Uc, freq] so the send
+        loop only has to index plain Python floats.
+        """
+        if self.source is not None:
+            block = self.decimator.process(cycle, self.source.source_block(cycle, breaker_status))
+            replaying = self.source.replay_cfg is not None
+        else:
+            block = self.synthesise(cycle, breaker_status)
+            replaying = self.replay_cfg is not None
+        block = np.round(block, 2)
+
+        # An armed scenario replaces the samples it covers; once the breaker
+        # has opened only its voltages and frequency still apply. Recordings
+        # play as recorded regardless of the breaker.
+        if self.scenario:
+            self.scenario.overlay(block, cycle * self.spc,
+                                  currents=replaying or breaker_status != "OPEN")
+        return block.tolist()
+
+    def source_block(self, cycle, breaker_status):
+        """One unrounded cycle of a source, kept for the other streams cut from it"""
+        key = (cycle, breaker_status)
+        block = self.blocks.get(key)
+        if block is None:
+            block = self.synthesise(cycle, breaker_status)
+            if len(self.blocks) >= 4:
+                self.blocks.pop(next(iter(self.blocks)))
+            self.blocks[key] = block
+        return block
+
+    def synthesise(self, cycle, breaker_status):
+        """One cycle of the recording or the tables plus noise, as an array"""
+        if self.replay_cfg:
+            block = self.replay_cycle(cycle)
+            if block is not None:
+                return block
+
+        if breaker_status == "OPEN":
+            curr_table, curr_amp = self.curr_tables["OPEN"], self.open_amp
+        else:
+            curr_table, curr_amp = self.curr_tables["CLOSED"], self.curr_amp
+
+        first = cycle * self.spc + self.offset + self.noise_offset
+        noise = NOISE_TABLE[np.arange(first, first + self.spc) % noise_len]
+
+        block = np.empty((self.spc, 7))
+        block[:, 0:3] = curr_table + noise[:, 0:3] * curr_amp
+        block[:, 3:6] = self.volt_table + noise[:, 3:6] * voltpeak
+        block[:, 6] = freq + noise[:, 6]
+        return block
+
+    def replay_cycle(self, cycle):
+        """One cycle of the recording, played as recorded regardless of
+        the breaker. Opened on first use so only the publishing process
+        maps the file.
+        """
+        if self.replay is None:
+            cfg = self.replay_cfg
+            self.replay = Replay(cfg["file"], freq * self.spc, cfg["loop"],
+                                 cfg.get("channels"), cfg.get("rate"))
+        block = self.replay.block(cycle * self.spc + self.offset, self.spc)
+        if block is None:
+            print(f"[MU] {self.svID}: replay finished, back to synthetic waveforms")
+            self.replay_cfg = None
+        return block
+
+    def set_phasors(self, volts, currs):
+        """Take voltages and currents from the network model instead of
+        the configured amplitudes. The model already accounts for the
+        breaker, so both breaker positions use the same table.
+        """
+        if self.source is not None:
+            self.source.set_phasors(volts, currs)
+        self.phasors = (np.array(volts), np.array(currs))
+        theta = 2 * np.pi * (np.arange(self.spc) + self.offset) / self.spc
+        rotation = np.exp(1j * theta)[:, None] * math.sqrt(2)
+        self.volt_table = np.imag(rotation * volts[None, :])
+        curr_table = np.imag(rotation * currs[None, :])
+        self.curr_tables = {"CLOSED": curr_table, "OPEN": curr_table}
+        # Noise stays relative to the actual current
+        self.curr_amp = self.open_amp = max(float(np.abs(currs).max()) * math.sqrt(2), opencurr)
+        self.cycle = -1
+        self.blocks.clear()
+
+    def render_scenario(self, spec, start):
+        return build_scenario(spec, start, self.spc, freq, voltpeak, self.curr_amp,
+                              self.shift, self.lag, phasors=self.phasors)
+
+    def arm(self, name, start, buffer):
+        """Play buffer from sample index start. A trigger that arrives
+        late is pushed back whole cycles so the waveform stays continuous.
+        """
+        if start < self.sample_counter:
+            late = -(-(self.sample_counter - start) // self.spc) * self.spc
+            print(f"[MU] {self.svID}: scenario {name} arrived late, delayed {late} samples")
+            start += late
+        self.scenario = ScenarioPlayer(name, start, buffer)
+        # Rebuild the current cycle in case the scenario starts inside it
+        self.cycle = -1
+        print(f"[MU] {self.svID}: scenario {name} armed at sample {start}")
+
+    def disarm(self):
+        if self.scenario:
+            print(f"[MU] {self.svID}: scenario {self.scenario.name} stopped")
+            self.scenario = None
+            self.cycle = -1
+
+    def deadline(self, start):
+        """A frame leaves once its last sample is due"""
+        return start + (self.sample_counter + self.no_asdu - 1) * self.interval
+
+    def resync(self, now, start):
+        """Skip samples missed while stalled rather than bursting them out"""
+        n = int((now - start) / self.interval) // self.no_asdu + 1
+        self.sample_counter = n * self.no_asdu
+
+    def build_frame(self, wall_start, breaker_status):
+        # no_asdu divides the cycle length so a frame never straddles two
+        # cycles. A breaker change rebuilds the current cycle so it shows
+        # on the next frame.
+        if not self.follow_breaker:
+            breaker_status = "CLOSED"
+        row = self.sample_counter % self.spc
+        cycle = self.sample_counter // self.spc
+        if cycle != self.cycle or breaker_status != self.samples_status:
+            if self.scenario and cycle * self.spc >= self.scenario.end:
+                print(f"[MU] {self.svID}: scenario {self.scenario.name} finished")
+                self.scenario = None
+            self.cycle = cycle
+            self.samples = self.generate_cycle(cycle, breaker_status)
+            self.samples_status = breaker_status
+
+        counters = range(self.sample_counter, self.sample_counter + self.no_asdu)
+        return encode(
+            self.encoding, self.svID, self.datSet,
+            [n % self.smp_wrap for n in counters],
+            self.samples[row:row + self.no_asdu],
+            [wall_start + n * self.interval for n in counters]
+        )
+
+    def record(self, late):
+        self.sample_counter += self.no_asdu
+        self.sent += self.no_asdu
+        self.frames += 1
+        self.late_sum += late
+        self.late_sq_sum += late * late
+        if late > self.late_max:
+            self.late_max = late
+
+    def publish_stats(self, stats, elapsed):
+        """Write achieved sample rate and per-frame lateness for the last
+        period into this stream's slots of the shared stats array
+        """
+        base = self.index * len(STAT_FIELDS)
+        frames = self.frames
+        mean = self.late_sum / frames if frames else 0.0
+        var = max(self.late_sq_sum / frames - mean * mean, 0.0) if frames else 0.0
+        stats[base + 0] = self.sent / elapsed if elapsed else 0.0
+        stats[base + 1] = mean * 1e6
+        stats[base + 2] = math.sqrt(var) * 1e6
+        stats[base + 3] = self.late_max * 1e6
+        stats[base + 5] += self.sent
+        self.reset_stats()
+
+
+def listen_breaker_position(breaker_code):
+    """Track the breaker position pushed by the breaker, off the send loops.
+
+    Publishers only read breaker_code, so a slow or dead breaker can never
+    delay a sample; it just falls back to UNKNOWN after a timeout.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', breaker_port))
+    mreq = struct.pack("4sl", socket.inet_aton(BREAKER_MCAST), socket.INADDR_ANY)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    sock.settimeout(breaker_timeout)
+
+    print(f"[MU] Listening for breaker position on {BREAKER_MCAST}:{breaker_port}")
+
+    while True:
+        try:
+            data, _ = sock.recvfrom(1024)
+            msg = json.loads(data.decode())
+            status = msg.get("stVal", "UNKNOWN")
+            ln = msg.get("ln", "XCBR1")
+        except socket.timeout:
+            status, ln = "UNKNOWN", "XCBR1"
+        except Exception as e:
+            print("[MU] Bad breaker position message:", e)
+            continue
+
+        code = BREAKER_STATES.index(status) if status in BREAKER_STATES else 0
+        if code != breaker_code.value:
+            print(f" Breaker state {status}")
+            breaker_code.value = code
+            if network is not None:
+                follow_breaker(ln, status)
+
+
+def wait_until(deadline):
+    """Sleep until the monotonic deadline, optionally spinning the last stretch"""
+    delay = deadline - time.monotonic()
+    if delay > spin_time:
+        time.sleep(delay - spin_time)
+    if spin_time:
+        while time.monotonic() < deadline:
+            pass
+
+
+def handle_control(streams, commands):
+    """Apply a scenario or network command from the parent process"""
+    by_id = {s.svID: s for s in streams}
+    cmd = commands.get()
+    if cmd[0] == "arm":
+        _, sv_id, name, start, buffer = cmd
+        by_id[sv_id].arm(name, start, buffer)
+    elif cmd[0] == "phasors":
+        _, sv_id, volts, currs = cmd
+        by_id[sv_id].set_phasors(volts, currs)
+    elif cmd[0] == "stop":
+        for sv_id in cmd[1]:
+            if sv_id in by_id:
+                by_id[sv_id].disarm()
+
+
+def run_publisher(configs, indices, start, wall_start, breaker_code, stats, commands, cmd_seq):
+    """Publish one shard of the streams from its own process.
+
+    Every frame has an absolute deadline on the monotonic clock, so
+    processing time never accumulates into drift. A heap keyed on those
+    deadlines always serves whichever stream is due next.
+    """
+    streams = build_streams(configs, indices)
+    handled = 0
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     ttl = struct.pack('b', 1)
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+    sender = PrpSender(sock)
+
+    for s in streams:
+        print(f"[MU] Sending {s.svID} to {s.addr[0]}:{s.addr[1]} at {freq * s.spc * s.speed:.0f} Hz "
+              f"({s.spc} samples/cycle, {s.no_asdu} per frame, {s.encoding})")
+        if s.source is not None:
+            print(f"[MU]   decimated by {s.decimator.factor} from source {s.source.svID} "
+                  f"at {s.source.spc} samples/cycle")
+
+    heap = [(s.deadline(start), k) for k, s in enumerate(streams)]
+    heapq.heapify(heap)
+    stats_start = start
+
+    while True:
+        while handled < cmd_seq.value:
+            handle_control(streams, commands)
+            handled += 1
+
+        deadline, k = heap[0]
+        stream = streams[k]
+        now = time.monotonic()
+
+        if now - deadline > max_lag:
+            # Fell too far behind (e.g. the host stalled)
+            stream.resync(now, start)
+            stats[stream.index * len(STAT_FIELDS) + 4] += 1
+            heapq.heapreplace(heap, (stream.deadline(start), k))
+            continue
+
+        data = stream.build_frame(wall_start, BREAKER_STATES[breaker_code.value])
+
+        wait_until(deadline)
+        sender.sendto(data, stream.addr)
+        stream.record(time.monotonic() - deadline)
+        heapq.heapreplace(heap, (stream.deadline(start), k))
+
+        if deadline - stats_start >= stats_period:
+            elapsed = time.monotonic() - stats_start
+            for s in streams:
+                s.publish_stats(stats, elapsed)
+            stats_start = time.monotonic()
+
+
+def collect_stats():
+    result = []
+    for i, cfg in enumerate(stream_configs):
+        base = i * len(STAT_FIELDS)
+        speed = cfg["replay"]["speed"] if cfg.get("replay") else 1.0
+        entry = {"svID": cfg["svID"], "target_hz": freq * cfg["spc"] * speed}
+        for j, field in enumerate(STAT_FIELDS):
+            entry[field] = round(shared_stats[base + j], 1)
+        result.append(entry)
+    return result
+
+
+@app.route('/stats')
+def get_stats():
+    return jsonify(collect_stats())
+
+
+def trigger_scenario(name, sv_ids=None, sample=None, delay_ms=None):
+    """Render a scenario for each selected stream and arm it at a sample
+    index: the one given, or the first sample due after delay_ms.
+    """
+    if name not in scenario_library:
+        raise ValueError(f"Unknown scenario {name!r}")
+    streams = select_streams(sv_ids)
+    spec = scenario_library[name]
+    if delay_ms is None:
+        delay_ms = trigger_delay_ms
+    due = time.monotonic() + delay_ms / 1000.0
+
+    armed = {}
+    with control_lock:
+        for sv_id in streams:
+            stream, worker = control_streams[sv_id]
+            if sample is None:
+                first = max(math.ceil((due - publish_start) / stream.interval), 0)
+            else:
+                first = int(sample)
+            buffer = stream.render_scenario(spec, first)
+            send_control(worker, ("arm", sv_id, name, first, buffer))
+            armed[sv_id] = first
+            armed_scenarios[sv_id] = {"scenario": name, "start": first, "end": first + len(buffer)}
+    log_line = ", ".join(f"{k}@{v}" for k, v in armed.items())
+    print(f"[MU] Scenario {name} triggered on {log_line}")
+    return armed
+
 
-    print(f"[MU] Sending Sampled Values to {MCAST}:{svport} at 1 kHz")
+def stop_scenario(sv_ids=None):
+    streams = select_streams(sv_ids)
+    with control_lock:
+        for worker in {control_streams[s][1] for s in streams}:
+            send_control(worker, ("stop", streams))
+        for sv_id in streams:
+            armed_scenarios.pop(sv_id, None)
+    return streams
 
-    sample_counter = 0
-    t0 = time.time()
 
-    breaker_status = "UNKNOWN"
-    last_status_check = 0
+def select_streams(sv_ids):
+    if sv_ids is None:
+        return list(control_streams)
+    if isinstance(sv_ids, str):
+        sv_ids = [sv_ids]
+    unknown = [s for s in sv_ids if s not in control_streams]
+    if unknown:
+        raise ValueError(f"Unknown svID(s) {unknown}")
+    return list(sv_ids)
+
+
+def send_control(worker, cmd):
+    commands, cmd_seq = control_queues[worker]
+    commands.put(cmd)
+    cmd_seq.value += 1
+
+
+def run_control_command(msg):
+    cmd = msg.get("cmd", "trigger")
+    if cmd == "trigger":
+        return {"scenario": msg.get("name"),
+                "armed": trigger_scenario(msg.get("name"), msg.get("svID"),
+                                          msg.get("sample"), msg.get("delay_ms"))}
+    if cmd == "stop":
+        return {"stopped": stop_scenario(msg.get("svID"))}
+    raise ValueError(f"Unknown command {cmd!r}")
+
+
+@app.route('/scenarios')
+def list_scenarios():
+    return jsonify({
+        "scenarios": {name: spec.get("description", "") for name, spec in scenario_library.items()},
+        "armed": armed_scenarios
+    })
+
+
+@app.route('/scenario', methods=["POST"])
+def post_scenario():
+    try:
+        return jsonify(run_control_command(request.get_json(force=True) or {}))
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
+
+
+def control_listener():
+    """UDP control channel taking the same JSON commands as POST /scenario"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', CONTROL_PORT))
+    print(f"[MU] Scenario control listening on UDP {CONTROL_PORT}")
 
     while True:
-        now = time.time()
-        t = now - t0
-        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + f".{int((t % 1) * 1000):03d}Z"
+        data, addr = sock.recvfrom(4096)
+        try:
+            reply = run_control_command(json.loads(data.decode()))
+        except (ValueError, TypeError, AttributeError) as e:
+            reply = {"error": str(e)}
+        sock.sendto(json.dumps(reply).encode(), addr)
 
-        if now - last_status_check > 1:
-            breaker_status = get_breaker_status()
-            print(f" Breaker state {breaker_status}")
-            last_status_check = now
 
-        Ua = generate_sample(t, voltpeak, PHASE_SHIFT["Ia"])
-        Ub = generate_sample(t, voltpeak, PHASE_SHIFT["Ib"])
-        Uc = generate_sample(t, voltpeak, PHASE_SHIFT["Ic"])
+def update_network():
+    """Re-solve the network and hand every measured stream its new phasors"""
+    with control_lock:
+        network.solve()
+        for sv_id, (stream, worker) in control_streams.items():
+            point = stream_configs[stream.index].get("measure")
+            if point:
+                volts, currs = network.measure(point)
+                stream.set_phasors(volts, currs)
+                send_control(worker, ("phasors", sv_id, volts, currs))
+    print(f"[MU] Network solved in {network.solve_ms:.2f} ms")
+
+
+def follow_breaker(ln, status):
+    """Mirror the physical breaker on the model breaker that follows it.
+    An unknown position keeps it closed, as the waveform tables always did.
+    """
+    name = network.breaker_follows.get(ln)
+    if name:
+        with control_lock:
+            network.set_breaker(name, status != "OPEN")
+        update_network()
 
-        if breaker_status == "OPEN":
-            Ia = generate_sample(t, opencurr, PHASE_SHIFT["Ia"])
-            Ib = generate_sample(t, opencurr, PHASE_SHIFT["Ib"])
-            Ic = generate_sample(t, opencurr, PHASE_SHIFT["Ic"])
-        else:
-            Ia = generate_sample(t, currpeak, PHASE_SHIFT["Ia"])
-            Ib = generate_sample(t, currpeak, PHASE_SHIFT["Ib"])
-            Ic = generate_sample(t, currpeak, PHASE_SHIFT["Ic"])
-
-        sv_payload = {
-            "svID": "MU1-SV",
-            "datSet": "MeasMU1",
-            "vlan": 10,
-            "priority": 4,
-            "utc_timestamp": timestamp,
-            "sampleCount": sample_counter,
-            "freq": round(freq + random.uniform(-0.02, 0.02), 2),
-            "Ia": Ia,
-            "Ib": Ib,
-            "Ic": Ic,
-            "Ua": Ua,
-            "Ub": Ub,
-            "Uc": Uc
-        }
 
-        sock.sendto(json.dumps(sv_payload).encode(), (MCAST, svport))
-        sample_counter += 1
-        time.sleep(interval)
+@app.route('/network')
+def get_network():
+    if network is None:
+        return jsonify({"error": "No network model loaded"}), 404
+    with control_lock:
+        return jsonify(network.summary())
+
+
+@app.route('/network', methods=["POST"])
+def post_network():
+    """Change breakers, load level or the applied fault, e.g.
+    {"breakers": {"CB2": "OPEN"}, "load_scale": 1.2, "fault": {"bus": "B1", "type": "SLG"}}
+    """
+    if network is None:
+        return jsonify({"error": "No network model loaded"}), 404
+    msg = request.get_json(force=True) or {}
+    try:
+        with control_lock:
+            for name, state in msg.get("breakers", {}).items():
+                if name not in network.breakers:
+                    raise ValueError(f"Unknown breaker {name!r}")
+                network.set_breaker(name, state == "CLOSED")
+            if "load_scale" in msg:
+                network.load_scale = float(msg["load_scale"])
+            if "fault" in msg:
+                if msg["fault"]:
+                    network.check_fault(msg["fault"])
+                network.fault = msg["fault"]
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
+    update_network()
+    with control_lock:
+        return jsonify(network.summary())
+
+
+def report_stats():
+    for s in collect_stats():
+        print(f"[MU] {s['svID']}: {s['rate_hz']:.1f} Hz (target {s['target_hz']:.0f}), "
+              f"lateness mean {s['mean_late_us']:.0f} us, jitter {s['jitter_us']} us, "
+              f"max {s['max_late_us']} us, resyncs {s['resyncs']:.0f}")
+
+
+def main():
+    global stream_configs, shared_stats, scenario_library, publish_start, network
+    if os.path.exists(NETWORK_FILE):
+        with open(NETWORK_FILE, "r", encoding="utf-8") as f:
+            network = Network(json.load(f))
+        print(f"[MU] Loaded network model from {NETWORK_FILE}")
+    stream_configs = load_stream_configs()
+    check_config(stream_configs)
+    if os.path.exists(SCENARIOS_FILE):
+        scenario_library = load_scenarios(SCENARIOS_FILE)
+        print(f"[MU] Loaded {len(scenario_library)} scenario(s) from {SCENARIOS_FILE}")
+
+    # Each stats slot has exactly one writing process, so no lock is needed
+    shared_stats = mp.Array('d', len(stream_configs) * len(STAT_FIELDS), lock=False)
+    breaker_code = mp.Value('b', 0, lock=False)
+
+    # Long-lived processes rather than a pool: publishers never return.
+    # Streams of one source stay together so it is synthesised once.
+    units = {}
+    for i, cfg in enumerate(stream_configs):
+        units.setdefault(cfg.get("source") or i, []).append(i)
+    nworkers = max(1, min(workers, len(units)))
+    shards = [[] for _ in range(nworkers)]
+    for k, unit in enumerate(units.values()):
+        shards[k % nworkers].extend(unit)
+    print(f"[MU] {len(stream_configs)} stream(s) across {nworkers} publisher process(es)")
+
+    # Common time base so all streams sample on the same grid
+    start = time.monotonic() + 0.5
+    wall_start = time.time() + 0.5
+    publish_start = start
+    procs = []
+    for w, shard in enumerate(shards):
+        commands, cmd_seq = mp.Queue(), mp.Value('i', 0, lock=False)
+        control_queues.append((commands, cmd_seq))
+        for stream in build_streams(stream_configs, shard):
+            control_streams[stream.svID] = (stream, w)
+        p = mp.Process(target=run_publisher, daemon=True,
+                       args=(stream_configs, shard, start, wall_start, breaker_code, shared_stats,
+                             commands, cmd_seq))
+        p.start()
+        procs.append(p)
+
+    if network is not None:
+        update_network()
+
+    threading.Thread(target=listen_breaker_position, args=(breaker_code,), daemon=True).start()
+    threading.Thread(target=control_listener, daemon=True).start()
+    threading.Thread(target=lambda: app.run(host="0.0.0.0", port=STATS_PORT), daemon=True).start()
+
+    while True:
+        time.sleep(report_period)
+        report_stats()
+        dead = [p for p in procs if not p.is_alive()]
+        if dead:
+            print(f"[MU] {len(dead)} publisher process(es) stopped, exiting")
+            raise SystemExit(1)
 
 if __name__ == "__main__":
-    import struct
     main()
@@ -0,0 +1,257 @@
+"""
+Substation Network Model
+
+Author: Zein Ali
+Date: 16/07/2025
+
+Small NumPy power flow and short circuit model of the substation so that
+every MU stream publishes measurements from the same operating point:
+feeder currents add up at the busbar and all bays see the same voltage.
+
+The network (network.json) is a single voltage level of buses joined by
+lines, fed from a grid source with a given short circuit level. Breakers
+open or close lines. Loads are constant power. Work is done per phase in
+volts, amps and ohms.
+
+Load flow is a fixed point iteration on the bus impedance matrix of the
+energised part of the network. Faults (LLL, SLG, LL) are superimposed on
+the pre-fault state using the positive, negative and zero sequence bus
+impedance matrices, with negative equal to positive sequence.
+"""
+import math
+import time
+import numpy as np
+
+
+A_OP = np.exp(2j * math.pi / 3)
+
+# Symmetrical components to phase quantities, [a, b, c] = SEQ_TO_PHASE @ [0, 1, 2]
+SEQ_TO_PHASE = np.array([
+    [1, 1, 1],
+    [1, A_OP ** 2, A_OP],
+    [1, A_OP, A_OP ** 2]
+])
+
+FAULT_TYPES = ("LLL", "SLG", "LL")
+
+# Phases referenced to A for each fault: SLG on the named phase, LL between
+# the other two, so an SLG-B is solved as SLG-A with phases rotated
+FAULT_REFERENCE = {"A": 0, "B": 1, "C": 2, "BC": 0, "CA": 1, "AC": 1, "AB": 2, "BA": 2, "CB": 0}
+
+max_iterations = 50
+tolerance = 1e-7
+
+
+class Network:
+    """Buses, lines, loads and breakers of the substation.
+
+    measure() returns RMS phase phasors of bus voltage and branch current
+    for the configured measurement points, recomputed by solve() whenever
+    a breaker, load or fault changes.
+    """
+
+    def __init__(self, spec):
+        self.buses = [b["name"] for b in spec["buses"]]
+        self.bus_index = {name: i for i, name in enumerate(self.buses)}
+        self.kv = spec.get("kv", 11.0)
+        self.v_nominal = self.kv * 1e3 / math.sqrt(3)
+
+        # The grid source is an ideal voltage behind its short circuit impedance,
+        # modelled as an extra node joined to its bus by branch GRID
+        src = spec["source"]
+        self.source_node = len(self.buses)
+        zs = self.kv ** 2 / src.get("sc_mva", 250.0)
+        angle = math.atan(src.get("x_r", 10.0))
+        z_src = complex(zs * math.cos(angle), zs * math.sin(angle))
+
+        self.branches = [{
+            "name": src.get("name", "GRID"), "from": self.source_node,
+            "to": self.bus_index[src["bus"]], "z1": z_src,
+            "z0": z_src * src.get("z0_ratio", 1.0), "b": 0.0
+        }]
+        for line in spec["lines"]:
+            z1 = complex(line["r"], line["x"])
+            self.branches.append({
+                "name": line["name"], "from": self.bus_index[line["from"]],
+                "to": self.bus_index[line["to"]], "z1": z1,
+                "z0": z1 * line.get("z0_ratio", 3.0), "b": line.get("b", 0.0)
+            })
+        self.branch_index = {br["name"]: k for k, br in enumerate(self.branches)}
+
+        self.breakers = {}
+        self.breaker_follows = {}
+        for cb in spec.get("breakers", []):
+            self.breakers[cb["name"]] = {"branch": self.branch_index[cb["branch"]],
+                                         "closed": cb.get("closed", True)}
+            if cb.get("follows"):
+                self.breaker_follows[cb["follows"]] = cb["name"]
+
+        # Loads in VA per phase
+        self.loads = np.zeros(len(self.buses), dtype=complex)
+        for load in spec.get("loads", []):
+            self.loads[self.bus_index[load["bus"]]] += complex(load["p_mw"], load.get("q_mvar", 0.0)) * 1e6 / 3
+        self.load_scale = 1.0
+        self.fault = None
+
+        self.bus_voltage = None
+        self.branch_current = None
+        self.solve_ms = 0.0
+
+    def check_point(self, point):
+        if point["bus"] not in self.bus_index:
+            raise ValueError(f"Unknown bus {point['bus']!r}")
+        if point["branch"] not in self.branch_index:
+            raise ValueError(f"Unknown branch {point['branch']!r}")
+        if point.get("end", "from") not in ("from", "to"):
+            raise ValueError("Measurement end must be 'from' or 'to'")
+
+    def check_fault(self, fault):
+        if fault.get("type") not in FAULT_TYPES:
+            raise ValueError(f"Fault type must be one of {FAULT_TYPES}")
+        if fault.get("bus") not in self.bus_index:
+            raise ValueError(f"Unknown bus {fault.get('bus')!r}")
+        phases = fault.get("phases", "A" if fault["type"] == "SLG" else "BC")
+        if fault["type"] != "LLL" and phases.upper() not in FAULT_REFERENCE:
+            raise ValueError(f"Bad fault phases {phases!r}")
+
+    def set_breaker(self, name, closed):
+        self.breakers[name]["closed"] = bool(closed)
+
+    def closed_branches(self):
+        open_branches = {cb["branch"] for cb in self.breakers.values() if not cb["closed"]}
+        return [k for k in range(len(self.branches)) if k not in open_branches]
+
+    def energised(self, closed):
+        """Buses connected to the source through closed branches"""
+        adjacent = {}
+        for k in closed:
+            br = self.branches[k]
+            adjacent.setdefault(br["from"], []).append(br["to"])
+            adjacent.setdefault(br["to"], []).append(br["from"])
+        seen = {self.source_node}
+        stack = [self.source_node]
+        while stack:
+            for nxt in adjacent.get(stack.pop(), []):
+                if nxt not in seen:
+                    seen.add(nxt)
+                    stack.append(nxt)
+        seen.discard(self.source_node)
+        return sorted(seen)
+
+    def _bus_admittance(self, closed, live, z_key):
+        """Admittance matrix of the live buses, the source folded into its
+        bus as a shunt, so its inverse is the fault bus impedance matrix
+        """
+        pos = {bus: k for k, bus in enumerate(live)}
+        y = np.zeros((len(live), len(live)), dtype=complex)
+        y_src = np.zeros(len(live), dtype=complex)
+        for k in closed:
+            br = self.branches[k]
+            ys = 1 / br[z_key]
+            f, t = br["from"], br["to"]
+            if f == self.source_node:
+                y[pos[t], pos[t]] += ys
+                y_src[pos[t]] += ys
+                continue
+            if f not in pos:
+                continue
+            i, j = pos[f], pos[t]
+            shunt = 0.5j * br["b"] if z_key == "z1" else 0.0
+            y[i, i] += ys + shunt
+            y[j, j] += ys + shunt
+            y[i, j] -= ys
+            y[j, i] -= ys
+        return y, y_src
+
+    def solve(self):
+        """Load flow plus any applied fault; fills bus_voltage (3 x buses,
+        sequence 0/1/2) and branch_current (3 x branches, from end)
+        """
+        started = time.perf_counter()
+        closed = self.closed_branches()
+        live = self.energised(closed)
+        n = len(self.buses)
+        v_seq = np.zeros((3, n + 1), dtype=complex)
+        v_seq[1, self.source_node] = self.v_nominal
+
+        if live:
+            y1, y_src = self._bus_admittance(closed, live, "z1")
+            z1 = np.linalg.inv(y1)
+            e = self.v_nominal
+            s_load = self.loads[live] * self.load_scale
+            v = np.full(len(live), e, dtype=complex)
+            for _ in range(max_iterations):
+                v_new = z1 @ (y_src * e - np.conj(s_load / v))
+                done = np.max(np.abs(v_new - v)) < tolerance * e
+                v = v_new
+                if done:
+                    break
+            v_seq[1, live] = v
+
+            if self.fault and self.fault["bus"] in [self.buses[b] for b in live]:
+                y0, _ = self._bus_admittance(closed, live, "z0")
+                z0 = np.linalg.inv(y0)
+                self._apply_fault(v_seq, live, z0, z1)
+
+        i_seq = np.zeros((3, len(self.branches)), dtype=complex)
+        for k in closed:
+            br = self.branches[k]
+            f, t = br["from"], br["to"]
+            for s, z_key in ((0, "z0"), (1, "z1"), (2, "z1")):
+                i_seq[s, k] = (v_seq[s, f] - v_seq[s, t]) / br[z_key]
+            i_seq[1, k] += v_seq[1, f] * 0.5j * br["b"]
+
+        self.bus_voltage = v_seq
+        self.branch_current = i_seq
+        self.solve_ms = (time.perf_counter() - started) * 1e3
+
+    def _apply_fault(self, v_seq, live, z0, z1):
+        """Superimpose the fault's sequence voltage changes on the pre-fault state"""
+        fault = self.fault
+        k = live.index(self.bus_index[fault["bus"]])
+        zf = complex(fault.get("zf", 0.0))
+        kind = fault["type"]
+        phases = fault.get("phases", "A" if kind == "SLG" else "BC").upper()
+        ref = 0 if kind == "LLL" else FAULT_REFERENCE[phases]
+
+        # Solve with the faulted phase as reference, then rotate back
+        rot = A_OP ** (-ref)
+        vk = v_seq[1, live[k]] * rot
+        if kind == "LLL":
+            i1, i2, i0 = vk / (z1[k, k] + zf), 0.0, 0.0
+        elif kind == "SLG":
+            i1 = i2 = i0 = vk / (2 * z1[k, k] + z0[k, k] + 3 * zf)
+        else:
+            i1 = vk / (2 * z1[k, k] + zf)
+            i2, i0 = -i1, 0.0
+
+        # Sequence quantities rotate by a^ref (positive), a^-ref (negative)
+        v_seq[1, live] -= z1[:, k] * i1 / rot
+        v_seq[2, live] = -z1[:, k] * i2 * rot
+        v_seq[0, live] = -z0[:, k] * i0
+
+    def measure(self, point):
+        """Phase voltage at point's bus and current into point's branch from
+        its end, as RMS complex phasors of shape (3,) each
+        """
+        if self.bus_voltage is None:
+            self.solve()
+        bus = self.bus_index[point["bus"]]
+        branch = self.branch_index[point["branch"]]
+        sign = 1 if point.get("end", "from") == "from" else -1
+        v = SEQ_TO_PHASE @ self.bus_voltage[:, bus]
+        i = SEQ_TO_PHASE @ self.branch_current[:, branch] * sign
+        return v, i
+
+    def summary(self):
+        """Bus voltages and branch currents for the status endpoint"""
+        v = np.abs(SEQ_TO_PHASE @ self.bus_voltage[:, :len(self.buses)])
+        i = np.abs(SEQ_TO_PHASE @ self.branch_current)
+        return {
+            "solve_ms": round(self.solve_ms, 3),
+            "load_scale": self.load_scale,
+            "fault": self.fault,
+            "breakers": {name: "CLOSED" if cb["closed"] else "OPEN" for name, cb in self.breakers.items()},
+            "buses": {name: [round(float(x) / 1e3, 3) for x in v[:, k]] for k, name in enumerate(self.buses)},
+            "branches": {br["name"]: [round(float(x), 1) for x in i[:, k]] for k, br in enumerate(self.branches)}
+        }
@@ -0,0 +1,151 @@
+"""
+PRP-style Redundant Multicast
+
+Author: Zein Ali
+Date: 23/07/2025
+
+Simulates IEC 62439-3 PRP on top of UDP multicast. With PRP_ENABLED=1 a
+sender transmits every frame twice, to its LAN A group and the matching
+LAN B group (third octet + 1, e.g. 239.192.0.1 -> 239.192.1.1), each copy
+ending in a 6 byte redundancy control trailer like the PRP RCT:
+
+    seqNr (16 bits) | LAN id (4 bits) + LSDU size (12 bits) | suffix 0x88FB
+
+Receivers join both groups and keep a sliding window of recent sequence
+numbers per sender address, so the second copy of a frame is discarded in
+O(1) with bounded memory. Frames without a trailer (single attached
+senders, the attacker scripts) pass through untouched.
+"""
+import os
+import socket
+import struct
+from collections import OrderedDict
+
+
+PRP_ENABLED = os.getenv("PRP_ENABLED", "0") not in ("0", "false", "no", "")
+
+SUFFIX = 0x88FB
+LAN_A = 0xA
+LAN_B = 0xB
+TRAILER = struct.Struct(">HHH")
+TRAILER_LEN = TRAILER.size
+
+# Sequence numbers remembered per sender, and senders remembered
+WINDOW = 128
+MAX_SOURCES = 64
+
+
+def lan_b_group(group):
+    """LAN B counterpart of a LAN A multicast group"""
+    a, b, c, d = group.split(".")
+    return f"{a}.{b}.{(int(c) + 1) % 256}.{d}"
+
+
+def join_groups(sock, group):
+    """Join the LAN A group and, with PRP enabled, its LAN B twin"""
+    groups = [group, lan_b_group(group)] if PRP_ENABLED else [group]
+    for g in groups:
+        mreq = struct.pack("4sl", socket.inet_aton(g), socket.INADDR_ANY)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    return groups
+
+
+class PrpSender:
+    """Sends each frame on LAN A and LAN B with a shared sequence number.
+
+    Both copies leave from the same socket, so receivers see the same
+    source address on both LANs, as PRP nodes use one MAC on both ports.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.seq = 0
+        self.lan_b = {}
+
+    def sendto(self, data, addr):
+        if not PRP_ENABLED:
+            self.sock.sendto(data, addr)
+            return
+        seq = self.seq
+        self.seq = (seq + 1) & 0xFFFF
+        size = (len(data) + TRAILER_LEN) & 0x0FFF
+        addr_b = self.lan_b.get(addr)
+        if addr_b is None:
+            addr_b = self.lan_b[addr] = (lan_b_group(addr[0]), addr[1])
+        self.sock.sendto(data + TRAILER.pack(seq, LAN_A << 12 | size, SUFFIX), addr)
+        self.sock.sendto(data + TRAILER.pack(seq, LAN_B << 12 | size, SUFFIX), addr_b)
+
+
+class DuplicateDiscard:
+    """Per-sender duplicate filter over the last WINDOW sequence numbers.
+
+    Each sender keeps the newest sequence number seen and a bitmask of
+    which of the WINDOW before it have arrived. Frames further behind than
+    the window are accepted, as PRP does.
+    """
+
+    def __init__(self, window=WINDOW, max_sources=MAX_SOURCES):
+        self.window = window
+        self.full = (1 << window) - 1
+        self.max_sources = max_sources
+        self.sources = OrderedDict()
+        self.received_a = 0
+        self.received_b = 0
+        self.duplicates = 0
+        self.unmarked = 0
+
+    def accept(self, data, source):
+        """Return the frame without its trailer, or None for a duplicate"""
+        if len(data) < TRAILER_LEN:
+            self.unmarked += 1
+            return data
+        seq, lan_size, suffix = TRAILER.unpack_from(data, len(data) - TRAILER_LEN)
+        if suffix != SUFFIX or (lan_size & 0x0FFF) != (len(data) & 0x0FFF):
+            self.unmarked += 1
+            return data
+
+        if lan_size >> 12 == LAN_B:
+            self.received_b += 1
+        else:
+            self.received_a += 1
+
+        entry = self.sources.get(source)
+        if entry is None:
+            self.sources[source] = [seq, 1]
+            if len(self.sources) > self.max_sources:
+                self.sources.popitem(last=False)
+            return data[:-TRAILER_LEN]
+        self.sources.move_to_end(source)
+
+        top, mask = entry
+        ahead = (seq - top) & 0xFFFF
+        if ahead == 0:
+            self.duplicates += 1
+            return None
+        if ahead < 0x8000:
+            entry[0] = seq
+            entry[1] = ((mask << ahead) | 1) & self.full if ahead < self.window else 1
+            return data[:-TRAILER_LEN]
+
+        behind = 0x10000 - ahead
+        if behind < self.window:
+            bit = 1 << behind
+            if mask & bit:
+                self.duplicates += 1
+                return None
+            entry[1] = mask | bit
+        return data[:-TRAILER_LEN]
+
+    def counters(self):
+        # A frame seen on both LANs leaves one duplicate behind, so whatever
+        # a LAN received beyond the duplicates arrived on that LAN alone
+        return {
+            "enabled": PRP_ENABLED,
+            "received_a": self.received_a,
+            "received_b": self.received_b,
+            "duplicates_dropped": self.duplicates,
+            "only_a": max(self.received_a - self.duplicates, 0),
+            "only_b": max(self.received_b - self.duplicates, 0),
+            "unmarked": self.unmarked,
+            "sources": len(self.sources)
+        }
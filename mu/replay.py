@@ -0,0 +1,319 @@
+"""
+Recording Replay for the Merging Unit
+
+Author: Zein Ali
+Date: 09/07/2025
+
+Publishes recorded disturbances instead of synthetic waveforms. Reads
+COMTRADE (.cfg + .dat in ASCII, BINARY, BINARY32 or FLOAT32) and CSV files
+through mmap, so only the rows being played are ever parsed, then linearly
+resamples them to the stream's sample rate.
+
+Channels are picked from the COMTRADE phase and unit fields (or CSV
+column names) unless given explicitly as {"Ia": 1, "Ua": 4, ...}, using
+1-based analog channel numbers or CSV column names.
+"""
+import io
+import math
+import mmap
+import os
+import numpy as np
+
+
+SLOTS = ("Ia", "Ib", "Ic", "Ua", "Ub", "Uc", "freq")
+
+# CSV column names accepted for each slot, lower case
+CSV_NAMES = {
+    "Ia": ("ia", "i_a", "ia_a"),
+    "Ib": ("ib", "i_b", "ib_a"),
+    "Ic": ("ic", "i_c", "ic_a"),
+    "Ua": ("ua", "va", "u_a", "v_a"),
+    "Ub": ("ub", "vb", "u_b", "v_b"),
+    "Uc": ("uc", "vc", "u_c", "v_c"),
+    "freq": ("freq", "f", "frequency", "hz")
+}
+CSV_TIME = ("time", "t", "seconds", "timestamp")
+
+# Lines per entry in the sparse line index of text files
+TEXT_BLOCK = 512
+
+UNIT_SCALE = {"": 1.0, "k": 1e3, "m": 1e-3, "M": 1e6}
+
+
+class TextRows:
+    """Random row access to a text file through a sparse line index.
+
+    Only every TEXT_BLOCK-th line offset is kept, so the index of a
+    multi-gigabyte file stays a few megabytes.
+    """
+
+    def __init__(self, path, skip_lines=0, delimiter=","):
+        self.delimiter = delimiter
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.start = 0
+        for _ in range(skip_lines):
+            self.start = self.map.find(b"\n", self.start) + 1
+        # Ignore trailing blank lines
+        self.end = len(self.map)
+        while self.end > self.start and self.map[self.end - 1] in b" \t\r\n":
+            self.end -= 1
+        self.offsets, self.rows = self._index()
+        self.cache = {}
+
+    def _index(self):
+        offsets = []
+        rows = 0
+        piece = 1 << 24
+        for base in range(self.start, self.end, piece):
+            size = min(piece, self.end - base)
+            chunk = np.frombuffer(self.map, np.uint8, size, base)
+            line_starts = np.flatnonzero(chunk == 10) + base + 1
+            if base == self.start:
+                line_starts = np.concatenate(([self.start], line_starts))
+            numbers = rows + np.arange(len(line_starts))
+            offsets.extend(int(o) for o in line_starts[numbers % TEXT_BLOCK == 0])
+            rows += len(line_starts)
+        return offsets, rows
+
+    def _block(self, b):
+        if b in self.cache:
+            return self.cache[b]
+        start = self.offsets[b]
+        end = self.offsets[b + 1] if b + 1 < len(self.offsets) else self.end
+        data = np.loadtxt(io.BytesIO(self.map[start:end]), delimiter=self.delimiter, ndmin=2)
+        # A read can straddle two blocks, keep a couple around
+        if len(self.cache) >= 4:
+            self.cache.pop(next(iter(self.cache)))
+        self.cache[b] = data
+        return data
+
+    def read(self, first, last):
+        """Rows first..last-1 as a float array of all columns"""
+        parts = []
+        for b in range(first // TEXT_BLOCK, (last - 1) // TEXT_BLOCK + 1):
+            data = self._block(b)
+            lo = max(first - b * TEXT_BLOCK, 0)
+            hi = min(last - b * TEXT_BLOCK, len(data))
+            parts.append(data[lo:hi])
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+
+class BinaryRows:
+    """COMTRADE binary .dat records mapped straight into a NumPy array"""
+
+    SAMPLE_TYPES = {"BINARY": "<i2", "BINARY32": "<i4", "FLOAT32": "<f4"}
+
+    def __init__(self, path, fmt, n_analog, n_digital):
+        fields = [("n", "<u4"), ("t", "<u4"), ("a", self.SAMPLE_TYPES[fmt], (n_analog,))]
+        if n_digital:
+            fields.append(("d", "<u2", (math.ceil(n_digital / 16),)))
+        dtype = np.dtype(fields)
+        self.records = np.memmap(path, dtype, mode="r", shape=(os.path.getsize(path) // dtype.itemsize,))
+        self.rows = len(self.records)
+
+    def read(self, first, last):
+        """Rows first..last-1 as [n, t, analog...] like the ASCII layout"""
+        rec = self.records[first:last]
+        out = np.empty((len(rec), 2 + rec["a"].shape[1]))
+        out[:, 0] = rec["n"]
+        out[:, 1] = rec["t"]
+        out[:, 2:] = rec["a"]
+        return out
+
+
+class Recording:
+    """A recording reduced to the seven MU slots, in primary A, V and Hz.
+
+    read(first, last) returns an (n, 7) array; slots the recording does
+    not have are left at zero (frequency at the nominal value).
+    """
+
+    def __init__(self, path, channels=None, rate=None):
+        self.path = path
+        self.nominal = 50.0
+        if path.lower().endswith(".csv"):
+            self._open_csv(path, channels or {}, rate)
+        else:
+            self._open_comtrade(path, channels or {}, rate)
+        missing = [slot for slot in SLOTS[:6] if slot not in self.columns]
+        if len(missing) == 6:
+            raise ValueError(f"{path}: no current or voltage channels found")
+        if missing:
+            print(f"[MU] {os.path.basename(path)}: no channel for {', '.join(missing)}, sending zeros")
+
+    def __len__(self):
+        return self.source.rows
+
+    def _open_csv(self, path, channels, rate):
+        with open(path, "r", encoding="utf-8") as f:
+            header = [h.strip() for h in f.readline().split(",")]
+        lower = [h.lower() for h in header]
+        self.source = TextRows(path, skip_lines=1)
+        self.columns = {}
+        self.scale = {}
+        for slot in SLOTS:
+            name = channels.get(slot)
+            if name is not None:
+                self.columns[slot] = header.index(name)
+            else:
+                for alias in CSV_NAMES[slot]:
+                    if alias in lower:
+                        self.columns[slot] = lower.index(alias)
+                        break
+            self.scale[slot] = (1.0, 0.0)
+
+        if rate is None:
+            time_col = next((lower.index(t) for t in CSV_TIME if t in lower), None)
+            if time_col is None:
+                raise ValueError(f"{path}: no time column, give the sample rate")
+            times = self.source.read(0, min(len(self), 1000))[:, time_col]
+            rate = (len(times) - 1) / float(times[-1] - times[0])
+        self.rate = float(rate)
+
+    def _open_comtrade(self, path, channels, rate):
+        base = os.path.splitext(path)[0]
+        cfg = read_cfg(base + ".cfg")
+        dat = base + ".dat"
+        if not os.path.exists(dat):
+            dat = base + ".DAT"
+        self.nominal = cfg["frequency"]
+
+        if cfg["format"] == "ASCII":
+            self.source = TextRows(dat)
+        else:
+            self.source = BinaryRows(dat, cfg["format"], len(cfg["analog"]), cfg["digital"])
+
+        # Analog channel k is column k + 1 after the sample number and timestamp
+        self.columns = {}
+        self.scale = {}
+        for slot in SLOTS:
+            if slot in channels:
+                number = int(channels[slot])
+                chan = next(c for c in cfg["analog"] if c["index"] == number)
+            else:
+                chan = find_channel(cfg["analog"], slot)
+            if chan is not None:
+                self.columns[slot] = chan["index"] + 1
+                self.scale[slot] = channel_scale(chan)
+
+        if rate is None:
+            rate = cfg["rate"]
+        if not rate:
+            # Variable rate files carry only timestamps
+            times = self.source.read(0, min(len(self), 1000))[:, 1] * cfg["timemult"] * 1e-6
+            rate = (len(times) - 1) / float(times[-1] - times[0])
+        self.rate = float(rate)
+
+    def read(self, first, last):
+        raw = self.source.read(first, last)
+        out = np.zeros((len(raw), 7))
+        out[:, 6] = self.nominal
+        for k, slot in enumerate(SLOTS):
+            col = self.columns.get(slot)
+            if col is not None:
+                a, b = self.scale[slot]
+                out[:, k] = raw[:, col] * a + b
+        return out
+
+
+def read_cfg(path):
+    """Parse the parts of a COMTRADE 1991/1999/2013 .cfg the MU needs"""
+    with open(path, "r", encoding="latin-1") as f:
+        lines = [line.strip() for line in f if line.strip()]
+
+    counts = lines[1].split(",")
+    n_analog = int(counts[1].strip().rstrip("Aa"))
+    n_digital = int(counts[2].strip().rstrip("Dd"))
+
+    analog = []
+    for line in lines[2:2 + n_analog]:
+        f = [x.strip() for x in line.split(",")]
+        analog.append({
+            "index": int(f[0]), "id": f[1], "ph": f[2], "units": f[4],
+            "a": float(f[5]), "b": float(f[6]),
+            "primary": float(f[10]) if len(f) > 12 else 1.0,
+            "secondary": float(f[11]) if len(f) > 12 else 1.0,
+            "ps": f[12].upper() if len(f) > 12 else "P"
+        })
+
+    pos = 2 + n_analog + n_digital
+    frequency = float(lines[pos])
+    nrates = int(lines[pos + 1])
+    rate = float(lines[pos + 2].split(",")[0]) if nrates else 0.0
+    if nrates > 1:
+        raise ValueError(f"{path}: {nrates} sample rates, only single rate files are supported")
+    pos += 2 + max(nrates, 1) + 2
+    fmt = lines[pos].upper() if pos < len(lines) else "ASCII"
+    timemult = float(lines[pos + 1]) if pos + 1 < len(lines) else 1.0
+
+    if fmt not in ("ASCII",) + tuple(BinaryRows.SAMPLE_TYPES):
+        raise ValueError(f"{path}: unknown data file type {fmt}")
+    return {"analog": analog, "digital": n_digital, "frequency": frequency,
+            "rate": rate, "format": fmt, "timemult": timemult}
+
+
+def find_channel(analog, slot):
+    """Pick the analog channel for a slot from its phase and unit fields"""
+    if slot == "freq":
+        return next((c for c in analog if c["units"].lower() == "hz"), None)
+    phase = slot[1].upper()
+    kind = "A" if slot[0] == "I" else "V"
+    for chan in analog:
+        ph = chan["ph"].upper()
+        units = chan["units"]
+        if units.endswith(kind) and (ph == phase or ph.endswith(phase) and len(ph) <= 2):
+            return chan
+    return None
+
+
+def channel_scale(chan):
+    """Gain and offset taking a raw sample to primary units without prefixes"""
+    prefix = chan["units"][:-1] if len(chan["units"]) > 1 else ""
+    unit = UNIT_SCALE.get(prefix, 1.0)
+    ratio = chan["primary"] / chan["secondary"] if chan["ps"] == "S" and chan["secondary"] else 1.0
+    return chan["a"] * unit * ratio, chan["b"] * unit * ratio
+
+
+class Replay:
+    """Plays a recording into a stream, resampled to the stream's rate.
+
+    Output sample k maps to source position k * source_rate / out_rate and
+    is linearly interpolated between the two neighbouring rows. With loop
+    the recording starts over at the end, otherwise block() returns None
+    once it has run out.
+    """
+
+    def __init__(self, path, out_rate, loop=True, channels=None, rate=None):
+        self.recording = Recording(path, channels, rate)
+        self.step = self.recording.rate / out_rate
+        self.loop = loop
+        self.length = len(self.recording)
+        print(f"[MU] Replaying {os.path.basename(path)}: {self.length} samples at "
+              f"{self.recording.rate:.0f} Hz, {self.length / self.recording.rate:.1f} s"
+              f"{', looping' if loop else ''}")
+
+    def block(self, first, n):
+        """Output samples first..first+n-1 as an (n, 7) array"""
+        pos = (first + np.arange(n)) * self.step
+        if self.loop:
+            pos %= self.length - 1
+        elif pos[-1] >= self.length - 1:
+            return None
+
+        # A loop can wrap inside the block; interpolate each side separately
+        wrap = np.flatnonzero(np.diff(pos) < 0)
+        if len(wrap):
+            cut = wrap[0] + 1
+            return np.concatenate((self._interp(pos[:cut]), self._interp(pos[cut:])))
+        return self._interp(pos)
+
+    def _interp(self, pos):
+        lo = int(pos[0])
+        hi = min(int(pos[-1]) + 2, self.length)
+        data = self.recording.read(lo, hi)
+        x = pos - lo
+        i = np.minimum(x.astype(int), len(data) - 1)
+        j = np.minimum(i + 1, len(data) - 1)
+        frac = (x - i)[:, None]
+        return data[i] * (1 - frac) + data[j] * frac
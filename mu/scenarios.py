@@ -0,0 +1,194 @@
+"""
+Scenario Waveform Engine
+
+Author: Zein Ali
+Date: 02/07/2025
+
+Precomputes fault and disturbance waveforms for the Merging Unit into
+NumPy buffers, so the publishers only copy rows and never evaluate a
+sine per sample. A scenario is described in scenarios.json by any mix of:
+
+    cycles              length of the scenario in power system cycles
+    fault               {"type": "SLG" | "LL" | "LLL", "phases": "A", "start_cycle",
+                         "cycles", "current_pu", "voltage_pu", "x_r", "dc_offset"}
+    harmonics           {"5": 0.08, ...} current harmonics, per unit of the fundamental
+    voltage_harmonics   same for the voltages
+    freq_ramp_hz_s      frequency ramp from the nominal frequency
+    freq_limit          frequency the ramp stops at
+    load_profile        per unit load points spread evenly over the scenario
+    noise               uniform noise level (default 0.01), seeded so runs repeat
+    seed                noise seed
+
+Buffer rows are [Ia, Ib, Ic, Ua, Ub, Uc, freq], the same layout the MU uses.
+"""
+import json
+import math
+import numpy as np
+
+
+PHASES = "ABC"
+PHASE_SHIFTS = np.array([0.0, -2 * math.pi / 3, 2 * math.pi / 3])
+FAULT_TYPES = ("SLG", "LL", "LLL")
+
+# Upper bound on a buffer, 10 minutes at 50 Hz
+MAX_CYCLES = 30000
+
+
+def load_scenarios(path):
+    with open(path, "r", encoding="utf-8") as f:
+        scenarios = json.load(f)
+    for name, spec in scenarios.items():
+        check_scenario(name, spec)
+    return scenarios
+
+
+def check_scenario(name, spec):
+    cycles = spec.get("cycles", 10)
+    if not 1 <= cycles <= MAX_CYCLES:
+        raise ValueError(f"Scenario {name}: cycles must be between 1 and {MAX_CYCLES}")
+    fault = spec.get("fault")
+    if fault:
+        if fault.get("type") not in FAULT_TYPES:
+            raise ValueError(f"Scenario {name}: fault type must be one of {FAULT_TYPES}")
+        phases = fault.get("phases", "ABC" if fault["type"] == "LLL" else "A")
+        if any(p not in PHASES for p in phases.upper()):
+            raise ValueError(f"Scenario {name}: bad fault phases {phases!r}")
+        needed = {"SLG": 1, "LL": 2, "LLL": 3}[fault["type"]]
+        if len(phases) != needed:
+            raise ValueError(f"Scenario {name}: {fault['type']} fault needs {needed} phase(s)")
+
+
+def build_scenario(spec, start, spc, freq, volt_amp, curr_amp, shift=0.0, lag=0.0, phasors=None):
+    """Render a scenario into an (n, 7) buffer starting at sample index start.
+
+    start only sets where the scenario begins on the wave, so the buffer
+    continues the phase of the stream it interrupts. phasors, the RMS
+    voltage and current phasors of a stream driven by the network model,
+    give each phase its own pre-fault magnitude and angle in place of
+    volt_amp, curr_amp, shift and lag; curr_amp still scales the fault
+    current and the noise.
+    """
+    n = spec.get("cycles", 10) * spc
+    dt = 1.0 / (freq * spc)
+    t = np.arange(n) * dt
+
+    # Instantaneous frequency, integrated into phase so ramps stay continuous
+    f = np.full(n, freq)
+    ramp = spec.get("freq_ramp_hz_s")
+    if ramp:
+        f = freq + ramp * t
+        limit = spec.get("freq_limit")
+        if limit is not None:
+            f = np.maximum(f, limit) if ramp < 0 else np.minimum(f, limit)
+    phase = 2 * math.pi * (start % spc) / spc
+    theta = phase + 2 * math.pi * np.concatenate(([0.0], np.cumsum(f[:-1]) * dt))
+
+    # Per unit load envelope on the current
+    load = np.ones(n)
+    profile = spec.get("load_profile")
+    if profile:
+        load = np.interp(np.linspace(0, len(profile) - 1, n), np.arange(len(profile)), profile)
+
+    if phasors is None:
+        volt_mag, curr_mag = volt_amp, curr_amp
+        volt_ang = shift + PHASE_SHIFTS
+        curr_ang = volt_ang - lag
+    else:
+        volt_ph, curr_ph = phasors
+        volt_mag, curr_mag = np.abs(volt_ph) * math.sqrt(2), np.abs(curr_ph) * math.sqrt(2)
+        volt_ang, curr_ang = np.angle(volt_ph), np.angle(curr_ph)
+        volt_amp = float(volt_mag.max())
+
+    angles = theta[:, None] + volt_ang[None, :]
+    volts = volt_mag * _with_harmonics(angles, spec.get("voltage_harmonics"))
+    currs = curr_mag * load[:, None] * _with_harmonics(theta[:, None] + curr_ang[None, :], spec.get("harmonics"))
+
+    fault = spec.get("fault")
+    if fault:
+        _apply_fault(fault, angles, t, spc, freq, curr_amp, volts, currs)
+
+    noise_level = spec.get("noise", 0.01)
+    if noise_level:
+        rng = np.random.default_rng(spec.get("seed", 0))
+        currs += rng.uniform(-noise_level, noise_level, (n, 3)) * curr_amp
+        volts += rng.uniform(-noise_level, noise_level, (n, 3)) * volt_amp
+
+    buf = np.empty((n, 7))
+    buf[:, 0:3] = currs
+    buf[:, 3:6] = volts
+    buf[:, 6] = f
+    return np.round(buf, 2)
+
+
+def _with_harmonics(angles, harmonics):
+    wave = np.sin(angles)
+    for order, mag in (harmonics or {}).items():
+        wave += mag * np.sin(int(order) * angles)
+    return wave
+
+
+def _apply_fault(fault, angles, t, spc, freq, curr_amp, volts, currs):
+    """Overwrite the faulted phases between fault inception and clearance.
+
+    Fault current lags the source by atan(X/R) and carries the decaying DC
+    offset i(t) = If * (sin(wt + a - phi) - sin(a - phi) * exp(-t / tau)).
+    """
+    first = fault.get("start_cycle", 1) * spc
+    last = min(first + fault.get("cycles", 5) * spc, len(t))
+    if first >= last:
+        return
+    span = slice(first, last)
+
+    kind = fault["type"]
+    idx = [PHASES.index(p) for p in fault.get("phases", "ABC" if kind == "LLL" else "A").upper()]
+    x_r = fault.get("x_r", 10.0)
+    phi = math.atan(x_r)
+    tau = x_r / (2 * math.pi * freq)
+    i_f = fault.get("current_pu", 8.0) * curr_amp
+    v_f = fault.get("voltage_pu", 0.2)
+
+    ang = angles[span] - phi
+    decay = np.exp(-(t[span] - t[first]) / tau)[:, None]
+    fault_curr = np.sin(ang)
+    if fault.get("dc_offset", True):
+        fault_curr = fault_curr - np.sin(ang[0])[None, :] * decay
+
+    if kind == "LL":
+        # Loop current flows out on one phase and back on the other, at
+        # sqrt(3)/2 of the three phase level (fa - fb has amplitude sqrt(3))
+        a, b = idx
+        loop = i_f * (fault_curr[:, a] - fault_curr[:, b]) / 2
+        currs[span, a] = loop
+        currs[span, b] = -loop
+        # Faulted phase voltages collapse towards their common midpoint
+        mid = (volts[span, a] + volts[span, b]) / 2
+        for p in idx:
+            volts[span, p] = mid + v_f * (volts[span, p] - mid)
+    else:
+        for p in idx:
+            currs[span, p] = i_f * fault_curr[:, p]
+            volts[span, p] *= v_f
+
+
+class ScenarioPlayer:
+    """Scenario armed on one SV stream at an absolute sample index"""
+
+    __slots__ = ("name", "start", "buffer")
+
+    def __init__(self, name, start, buffer):
+        self.name = name
+        self.start = start
+        self.buffer = buffer
+
+    @property
+    def end(self):
+        return self.start + len(self.buffer)
+
+    def overlay(self, block, first, currents=True):
+        """Copy the part of the scenario covering samples first.. onto block"""
+        lo = max(self.start, first)
+        hi = min(self.end, first + len(block))
+        if lo >= hi:
+            return
+        cols = slice(0, 7) if currents else slice(3, 7)
+        block[lo - first:hi - first, cols] = self.buffer[lo - self.start:hi - self.start, cols]
@@ -13,7 +13,13 @@ import json
 import time
 import threading
 import os
+import queue
 import requests
+import numpy as np
+import sv_codec
+import prp
+from timer_wheel import TimerWheel
+from frame_filter import FrameFilter, sv_id, sources_from_env
 
 
 app = Flask(__name__)
@@ -22,11 +28,17 @@ last_sv_packet_time = time.time()
 system_events = []
 
 
+SV_ID = os.getenv("SV_ID", "MU1-SV")
 SV_GROUP = "239.192.0.1"
 SV_PORT = 10010
 GOOSE_GROUP = "224.1.1.1"
 GOOSE_PORT = 10200
 
+# One socket and PRP sender for every trip, as the control IEDs keep
+goose_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+goose_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+goose_sender = prp.PrpSender(goose_sock)
+
 overcurrent_threshold = 800 
 freq_min = 48.0
 freq_max = 52.0
@@ -36,13 +48,35 @@ DEVICE_NAME = os.getenv("DEVICE_NAME", "P-IED")
 last_trip_time = 0
 trip_holdoff = 2
 
-breaker_status_url = "http://breaker:5002/status"
+# Position the breaker multicasts on every change and once a second,
+# which confirms or fails a trip without polling
+BREAKER_POS_GROUP = "224.1.1.2"
+BREAKER_POS_PORT = 10202
+breaker_state = None
 
 trip_failures = 0
 trip_failure_limit = 3
 trip_lockout_active = False
 lockout_cooldown = 30  
 
+# Trip supervision and lockout cooldown run on one timer wheel thread;
+# trip_check is the pending check of the last trip sent, if any
+timers = TimerWheel()
+trip_check = None
+
+# Events waiting to be forwarded to SCADA, so no caller blocks on it
+log_queue = queue.Queue(maxsize=1000)
+
+# GOOSE state number, raised for every trip sent; a trip is a single
+# state change frame, so its sqNum is always 0
+stNum = 0
+
+# PRP duplicate discard for the SV subscription
+sv_prp = prp.DuplicateDiscard()
+# Early drop of other streams and unlisted publishers (SV_SOURCES, empty
+# for any) before the frame is decoded
+sv_filter = FrameFilter("sv", [SV_ID], sv_id, sources_from_env(os.getenv("SV_SOURCES", "")))
+
 def reset_trip_lockout():
     global trip_failures, trip_lockout_active
     trip_failures = 0
@@ -63,11 +97,18 @@ def log_system_event(message):
         system_events.pop(0)
     print(f"[P-IED1 LOG] {message}")
 
-
     try:
-        requests.post("http://scada:5001/log", json=event, timeout=1)
-    except Exception as e:
-        print(f"[P-IED1] Failed to forward log to SCADA: {e}")
+        log_queue.put_nowait(event)
+    except queue.Full:
+        pass
+
+def forward_logs():
+    while True:
+        event = log_queue.get()
+        try:
+            requests.post("http://scada:5001/log", json=event, timeout=1)
+        except Exception as e:
+            print(f"[P-IED1] Failed to forward log to SCADA: {e}")
 
 def listen_for_sv():
     global last_trip_time
@@ -86,8 +127,7 @@ def listen_for_sv():
         return
 
     try:
-        mreq = struct.pack("4sl", socket.inet_aton(SV_GROUP), socket.INADDR_ANY)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        prp.join_groups(sock, SV_GROUP)
     except Exception as e:
         log(f"❌ Failed to join multicast group: {e}")
         return
@@ -97,29 +137,35 @@ def listen_for_sv():
 
     while True:
         try:
-            data, _ = sock.recvfrom(4096)
-            if not data.strip():
+            data, src = sock.recvfrom(65535)
+            if not sv_filter.accept(data, src):
+                continue
+            data = sv_prp.accept(data, src)
+            if not data or not data.strip():
                 continue
 
             try:
-                msg = json.loads(data.decode())
-            except json.JSONDecodeError:
+                batch = sv_codec.decode(data)
+            except ValueError:
                 log("⚠️ Malformed SV packet — skipped")
                 continue
 
-            Ia = msg.get("Ia", 0.0)
-            Ib = msg.get("Ib", 0.0)
-            Ic = msg.get("Ic", 0.0)
-            freq = msg.get("freq", 50.0)
+            # Check every sample in the frame at once
+            currents = np.abs(batch.values[:, 0:3])
+            worst = int(currents.max(axis=1).argmax())
+            f_lo = min(batch.freq)
+            f_hi = max(batch.freq)
 
             now = time.time()
-            if any(abs(i) > overcurrent_threshold for i in [Ia, Ib, Ic]):
+            if currents[worst].max() > overcurrent_threshold:
                 if now - last_trip_time > trip_holdoff:
+                    Ia, Ib, Ic = batch.values[worst, 0:3]
                     log_system_event(f"⚡ Overcurrent detected! Ia={Ia:.2f} Ib={Ib:.2f} Ic={Ic:.2f}")
                     send_goose_trip("OVER_CURRENT")
                     last_trip_time = now
-            elif freq < freq_min or freq > freq_max:
+            elif f_lo < freq_min or f_hi > freq_max:
                 if now - last_trip_time > trip_holdoff:
+                    freq = f_lo if f_lo < freq_min else f_hi
                     log_system_event(f"⚠️ Frequency anomaly: {freq:.2f} Hz")
                     send_goose_trip("BAD_FREQ")
                     last_trip_time = now
@@ -130,46 +176,71 @@ def listen_for_sv():
 
 
 def send_goose_trip(reason):
-    global trip_failures, trip_lockout_active
+    global stNum, trip_check
 
     if trip_lockout_active:
         log_system_event(f"⛔ DANGER — TRIP blocked — breaker in lockout mode, investigate and resolve immediately")
         return
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-
+    stNum += 1
     payload = {
         "goID": "GOOSE1",
         "status": "TRIP",
         "reason": reason,
-        "stNum": 1,
-        "sqNum": int(time.time()*1000) % 10000,
+        "stNum": stNum,
+        "sqNum": 0,
         "timestamp": time.time(),
         "checksum": 0,
         "role": os.environ.get('DEVICE_NAME', 'P-IED')
     }
 
-    sock.sendto(json.dumps(payload).encode(), (GOOSE_GROUP, GOOSE_PORT))
+    goose_sender.sendto(json.dumps(payload).encode(), (GOOSE_GROUP, GOOSE_PORT))
     log_system_event(f"🚨 Sent GOOSE TRIP ({reason}) to {GOOSE_GROUP}:{GOOSE_PORT}")
 
-    time.sleep(1)
-    try:
-        r = requests.get(breaker_status_url, timeout=1)
-        state = r.json().get("state", "UNKNOWN")
-
-        if state != "OPEN":
-            trip_failures += 1
-            log_system_event(f"⚠️ TRIP ineffective — Breaker still {state} (fail {trip_failures}/{trip_failure_limit})")
-            if trip_failures >= trip_failure_limit:
-                trip_lockout_active = True
-                log_system_event(f"⛔ TRIP lockout activated due to repeated failure")
-                threading.Timer(lockout_cooldown, reset_trip_lockout).start()
-        else:
-            trip_failures = 0
+    # The breaker has a second to open; its position push ends the check early
+    if trip_check is not None:
+        timers.cancel(trip_check)
+    trip_check = timers.call_later(1.0, "trip_check", check_trip)
 
-    except Exception as e:
-        log_system_event(f"❌ Error checking breaker status: {e}")
+def check_trip():
+    global trip_failures, trip_lockout_active, trip_check
+    trip_check = None
+    if breaker_state is None:
+        log_system_event("❌ Error checking breaker status: no position received from the breaker")
+        return
+
+    if breaker_state != "OPEN":
+        trip_failures += 1
+        log_system_event(f"⚠️ TRIP ineffective — Breaker still {breaker_state} (fail {trip_failures}/{trip_failure_limit})")
+        if trip_failures >= trip_failure_limit:
+            trip_lockout_active = True
+            log_system_event(f"⛔ TRIP lockout activated due to repeated failure")
+            timers.call_later(lockout_cooldown, "lockout_cooldown", reset_trip_lockout)
+    else:
+        trip_failures = 0
+
+def listen_breaker_position():
+    global breaker_state, trip_check, trip_failures
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("", BREAKER_POS_PORT))
+    mreq = struct.pack("4sl", socket.inet_aton(BREAKER_POS_GROUP), socket.INADDR_ANY)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    log(f"✅ Listening for breaker position on {BREAKER_POS_GROUP}:{BREAKER_POS_PORT}")
+
+    while True:
+        try:
+            msg = json.loads(sock.recv(1024).decode())
+            if msg.get("ln") != "XCBR1" or msg.get("do") != "Pos":
+                continue
+            breaker_state = msg.get("stVal")
+            check = trip_check
+            if check is not None and breaker_state == "OPEN":
+                timers.cancel(check)
+                trip_check = None
+                trip_failures = 0
+        except Exception as e:
+            log(f"⚠️ Breaker position error: {e}")
 
 @app.route('/status')
 def status():
@@ -178,9 +249,20 @@ def status():
         "trip_failures": trip_failures
     })
 
+@app.route('/prp')
+def prp_status():
+    return jsonify({"sv": sv_prp.counters()})
+
+@app.route('/filters')
+def filter_status():
+    return jsonify({"sv": sv_filter.counters()})
+
 
 if __name__ == "__main__":
     log("Protection IED starting...")
+    threading.Thread(target=forward_logs, daemon=True).start()
+    threading.Thread(target=timers.run_forever, daemon=True).start()
+    threading.Thread(target=listen_breaker_position, daemon=True).start()
     threading.Thread(target=listen_for_sv, daemon=True).start()
     threading.Thread(target=lambda: app.run(host="0.0.0.0", port=5008), daemon=True).start()
     while True:
@@ -52,6 +52,41 @@ app = Flask(__name__)
 def status():
     return jsonify({"status": "RTU is running"})
 
+# ctlNum of the last command, tying its select, operate and termination
+# together
+ctl_num = 0
+
+def control_ied(host, port, cmd):
+    """Select, then operate, the breaker through one IED and wait for the
+    command termination. Returns (ok, addCause), or None if the IED did
+    not answer
+    """
+    global ctl_num
+    ctl_num = (ctl_num + 1) % 256
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.settimeout(1.5)
+        for action in ("select", "operate"):
+            request = {"command": cmd, "action": action, "ctlNum": ctl_num, "timestamp": time.time()}
+            s.sendto(json.dumps(request).encode(), (host, port))
+            try:
+                while True:
+                    resp = json.loads(s.recv(1024))
+                    if resp.get("type") == "command_resp" and resp.get("action") == action \
+                            and resp.get("ctlNum") == ctl_num:
+                        break
+            except (socket.timeout, OSError, ValueError):
+                return None if action == "select" else (False, "No-response")
+            if not resp["ok"]:
+                return False, resp["addCause"]
+        s.settimeout(3.0)
+        try:
+            while True:
+                term = json.loads(s.recv(1024))
+                if term.get("type") == "cmd_term" and term.get("ctlNum") == ctl_num:
+                    return term["ok"], term["addCause"]
+        except (socket.timeout, OSError, ValueError):
+            return False, "No-command-termination"
+
 def listen_and_forward():
     while True:
         data, addr = sock.recvfrom(1024)
@@ -63,33 +98,49 @@ def listen_and_forward():
 
         log_system_event(f"[RTU] Received command from HMI: {cmd}")
 
-        command = {
-            "command": cmd,
-            "timestamp": time.time()
-        }
-
-        sent_to = None
-
-        try:
-            sock1 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock1.settimeout(1.5)
-            sock1.sendto(json.dumps(command).encode(), ("ied", 10500))
-            log_system_event(f"[RTU] Forwarded to ied1")
-            sent_to = "ied1"
-        except Exception as e:
-            log_system_event(f"[RTU] ied1 unreachable: {e}")
-
-        if sent_to is None:
+        sent_to = "NONE"
+        result = None
+        # Why each IED passed on the command: its AddCause if it answered
+        # with a refusal, else why it could not be reached
+        refused = {}
+        unreachable = {}
+        # ied2 only if ied1 does not answer or is in standby
+        for name, host, port in (("ied1", "ied", 10500), ("ied2", "ied2", 10501)):
             try:
-                sock2 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock2.sendto(json.dumps(command).encode(), ("ied2", 10501))
-                log_system_event(f"[RTU] Fallback: forwarded to ied2")
-                sent_to = "ied2"
-            except Exception as e:
-                log_system_event(f"[RTU] FATAL: Both ied1 and ied2 unreachable")
-                sent_to = "NONE"
-
-        notify_msg = f"[RTU] Command {cmd} sent to {sent_to}"
+                result = control_ied(host, port, cmd)
+            except OSError as e:
+                unreachable[name] = str(e)
+                log_system_event(f"[RTU] {name} unreachable: {e}")
+                continue
+            if result is None:
+                unreachable[name] = "no answer"
+                log_system_event(f"[RTU] {name} did not answer")
+                continue
+            if result == (False, "Blocked-by-Mode"):
+                refused[name] = result[1]
+                log_system_event(f"[RTU] {name} refused {cmd}: Blocked-by-Mode")
+                continue
+            sent_to = name
+            break
+
+        if result and result[0]:
+            log_system_event(f"[RTU] {cmd} completed through {sent_to}")
+        elif sent_to != "NONE":
+            log_system_event(f"[RTU] {cmd} through {sent_to} failed: {result[1]}")
+        elif refused:
+            reasons = [f"{name} refused ({cause})" for name, cause in refused.items()]
+            reasons += [f"{name} unreachable ({why})" for name, why in unreachable.items()]
+            log_system_event(f"[RTU] {cmd} not carried out: {', '.join(reasons)}")
+        else:
+            log_system_event("[RTU] FATAL: Both ied1 and ied2 unreachable")
+
+        if result and result[0]:
+            outcome = "done"
+        elif sent_to != "NONE":
+            outcome = result[1]
+        else:
+            outcome = ", ".join(refused.values()) or "no answer"
+        notify_msg = f"[RTU] Command {cmd} sent to {sent_to}: {outcome}"
         sock.sendto(notify_msg.encode(), (scada_ip, scada_port))
 
 
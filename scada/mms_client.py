@@ -0,0 +1,241 @@
+"""
+MMS Report Client
+
+Author: Zein Ali
+Date: 11/08/2025
+
+SCADA's end of an association with a control IED's MMS report server.
+It connects once, enables a free instance of each report control block
+it wants (a buffered one from the last entryID it saw, so changes made
+while it was away are replayed), asks for a general interrogation, and
+from then on only listens. Every report updates the values held here
+and is passed to on_report, within milliseconds of the change in the
+IED. A dropped association is retried every second.
+
+Writes go over the same association and wait for their answer. A
+control is selected (SBOw), then operated (Oper), and its command
+termination waited for.
+"""
+import itertools
+import json
+import socket
+import threading
+import time
+
+
+# Silence, in seconds, after which the association is taken to be dead;
+# the integrity reports arrive well within it
+RX_TIMEOUT = 10.0
+
+
+class MmsAssociation:
+    def __init__(self, name, host, port, reports, on_report=None, retry=1.0):
+        """reports maps a report name to the block instances that may serve
+        it, in order of preference
+        """
+        self.name = name
+        self.host = host
+        self.port = port
+        self.reports = reports
+        self.on_report = on_report
+        self.retry = retry
+
+        self.values = {}
+        self.connected = False
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.pending = {}
+        # ctlNum -> waiter for the command termination
+        self.ctl_nums = itertools.count(1)
+        self.terminations = {}
+        self.last_control = None
+        # Instance enabled for each report, and the last entryID and sqNum
+        # seen from each instance
+        self.enabled = {}
+        self.entry_ids = {}
+        self.sq_nums = {}
+
+        self.last_rx = 0.0
+        self.associations = 0
+        self.reports_rx = 0
+        self.replayed = 0
+        self.missed = 0
+        self.overflows = 0
+        # Per instance: last and worst time from a change to its report
+        # arriving, buffer time included
+        self.latency = {}
+
+    def run(self):
+        """Hold the association up; run on a thread of its own"""
+        while True:
+            try:
+                self.session()
+            except (OSError, ValueError) as e:
+                if self.connected:
+                    print(f"[SCADA] MMS association with {self.name} lost: {e}")
+            self.close()
+            time.sleep(self.retry)
+
+    def session(self):
+        sock = socket.create_connection((self.host, self.port), timeout=2)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(RX_TIMEOUT)
+        self.sock = sock
+        self.connected = True
+        self.associations += 1
+        self.enabled = {}
+        print(f"[SCADA] MMS association with {self.name} up")
+
+        # Instances tried in turn, any this client had buffered reports
+        # from first; enable requests in flight: id -> (report, index)
+        order = {report: sorted(rcbs, key=lambda rcb: rcb not in self.entry_ids)
+                 for report, rcbs in self.reports.items()}
+        enabling = {}
+        for report in self.reports:
+            enabling[self.enable(order[report][0])] = (report, 0)
+
+        rx = sock.makefile("rb")
+        for line in rx:
+            self.last_rx = time.monotonic()
+            msg = json.loads(line)
+            if "rpt" in msg:
+                self.report(msg)
+            elif "cmdTerm" in msg:
+                waiter = self.terminations.get(msg.get("ctlNum"))
+                if waiter is not None:
+                    waiter[1].append(msg)
+                    waiter[0].set()
+            elif msg.get("id") in enabling:
+                report, k = enabling.pop(msg["id"])
+                if msg.get("ok"):
+                    self.enabled[report] = msg["rcb"]
+                    self.sq_nums.pop(msg["rcb"], None)
+                elif k + 1 < len(order[report]):
+                    enabling[self.enable(order[report][k + 1])] = (report, k + 1)
+                else:
+                    print(f"[SCADA] MMS {self.name}: no free block for {report}: {msg.get('error')}")
+            else:
+                waiter = self.pending.pop(msg.get("id"), None)
+                if waiter is not None:
+                    waiter[1].append(msg)
+                    waiter[0].set()
+        raise ConnectionError("closed by the IED")
+
+    def enable(self, rcb):
+        req = {"req": "enable", "rcb": rcb, "gi": True}
+        if rcb in self.entry_ids:
+            req["entryID"] = self.entry_ids[rcb]
+        return self.send(req)
+
+    def send(self, req):
+        req["id"] = next(self.ids)
+        with self.send_lock:
+            self.sock.sendall(json.dumps(req).encode() + b"\n")
+        return req["id"]
+
+    def report(self, msg):
+        rcb = msg["rpt"]
+        self.reports_rx += 1
+        if "entryID" in msg:
+            self.entry_ids[rcb] = msg["entryID"]
+        if msg.get("bufOvfl") and msg.get("replay"):
+            self.overflows += 1
+        last = self.sq_nums.get(rcb)
+        self.sq_nums[rcb] = msg["sqNum"]
+        if msg.get("replay"):
+            self.replayed += 1
+        else:
+            if last is not None and msg["sqNum"] != (last + 1) % 65536:
+                self.missed += (msg["sqNum"] - last - 1) % 65536
+            if "dchg" in msg["reason"] or "qchg" in msg["reason"]:
+                ms = round((time.time() - msg["time"]) * 1e3, 3)
+                worst = self.latency.get(rcb, {}).get("maxMs", 0.0)
+                self.latency[rcb] = {"lastMs": ms, "maxMs": max(worst, ms)}
+        self.values.update(msg["values"])
+        if self.on_report:
+            self.on_report(self, msg)
+
+    def call(self, req, timeout=1.0):
+        """Send a request and wait for its answer; None if there is none"""
+        if not self.connected:
+            return None
+        waiter = (threading.Event(), [])
+        req["id"] = next(self.ids)
+        self.pending[req["id"]] = waiter
+        try:
+            with self.send_lock:
+                self.sock.sendall(json.dumps(req).encode() + b"\n")
+        except OSError:
+            self.pending.pop(req["id"], None)
+            return None
+        if not waiter[0].wait(timeout):
+            self.pending.pop(req["id"], None)
+            return None
+        return waiter[1][0] if waiter[1] else None
+
+    def write(self, ref, value, timeout=1.0):
+        return self.call({"req": "write", "ref": ref, "value": value}, timeout)
+
+    def control(self, ref, ctl_val, timeout=3.0):
+        """Select, operate and wait for the termination of one command.
+        Returns {"ok", "phase", "addCause", "ms"}, phase being where it
+        ended: SBOw, Oper or CmdTerm
+        """
+        start = time.perf_counter()
+        ctl_num = next(self.ctl_nums) % 256
+        value = {"ctlVal": ctl_val, "ctlNum": ctl_num}
+        waiter = (threading.Event(), [])
+        self.terminations[ctl_num] = waiter
+        try:
+            for service in ("SBOw", "Oper"):
+                reply = self.write(f"{ref}.{service}", value)
+                if reply is None or not reply.get("ok"):
+                    result = {"ok": False, "phase": service,
+                              "addCause": reply.get("error") if reply else "No-response"}
+                    break
+            else:
+                if waiter[0].wait(timeout) and waiter[1]:
+                    term = waiter[1][0]
+                    result = {"ok": term["ok"], "phase": "CmdTerm", "addCause": term["addCause"]}
+                else:
+                    result = {"ok": False, "phase": "CmdTerm", "addCause": "No-command-termination"}
+        finally:
+            self.terminations.pop(ctl_num, None)
+        result["ms"] = round((time.perf_counter() - start) * 1e3, 3)
+        self.last_control = dict(result, ctlVal=ctl_val, ctlNum=ctl_num)
+        return result
+
+    def age(self):
+        """Seconds since anything was heard from the IED"""
+        return time.monotonic() - self.last_rx
+
+    def close(self):
+        self.connected = False
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        for waiter in self.pending.values():
+            waiter[0].set()
+        self.pending.clear()
+        for waiter in self.terminations.values():
+            waiter[0].set()
+
+    def counters(self):
+        return {
+            "connected": self.connected,
+            "associations": self.associations,
+            "enabled": self.enabled,
+            "entryIDs": self.entry_ids,
+            "reports": self.reports_rx,
+            "replayed": self.replayed,
+            "missed": self.missed,
+            "overflows": self.overflows,
+            "latency": self.latency,
+            "lastControl": self.last_control,
+            "ageS": round(self.age(), 3) if self.connected else None,
+            "values": self.values
+        }
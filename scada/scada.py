@@ -17,6 +17,9 @@ import shutil
 from datetime import datetime
 import tempfile
 import traceback
+import socket
+from mms_ring import RingReader
+from mms_client import MmsAssociation
 
 ied1 = "http://ied:5003"
 ied2 = "http://ied2:5003"
@@ -39,8 +42,36 @@ system_events = []
 lastmms = None
 last_timestamp = None
 
-ied1_mmsfile = "/app/shared/mms_IED1.json"
-ied2_mmsfile = "/app/shared/mms_IED2.json"
+# MMS snapshot rings written by the IEDs; only the newest record is read
+ied1_mmsfile = "/app/shared/mms_IED1.ring"
+ied2_mmsfile = "/app/shared/mms_IED2.ring"
+mms_readers = {path: RingReader(path) for path in (ied1_mmsfile, ied2_mmsfile)}
+
+# MMS associations with both control IEDs: the IED state is pushed in
+# reports as it changes, and HTTP polling is only the fallback while
+# neither is reachable. Each gunicorn worker takes its own block instance.
+MMS_TCP_PORT = 10102
+MMS_REPORTS = {"status": ["brcbStatus01", "brcbStatus02"], "meas": ["urcbMeas01", "urcbMeas02"]}
+
+
+def on_mms_report(assoc, msg):
+    global latest_status
+    if "XCBR1.Pos.stVal" in msg["values"] and assoc.values.get("LLN0.mode") == "active":
+        latest_status = msg["values"]["XCBR1.Pos.stVal"]
+
+
+mms_assocs = {
+    ied1: MmsAssociation("IED1", "ied", MMS_TCP_PORT, MMS_REPORTS, on_report=on_mms_report),
+    ied2: MmsAssociation("IED2", "ied2", MMS_TCP_PORT, MMS_REPORTS, on_report=on_mms_report)
+}
+
+
+def mms_active():
+    """URL and association of the IED reporting itself active, or (None, None)"""
+    for url, assoc in mms_assocs.items():
+        if assoc.connected and assoc.values.get("LLN0.mode") == "active":
+            return url, assoc
+    return None, None
 
 syslog_file = "/app/shared/system_log.json"
 max_log_entries = 500
@@ -144,26 +175,58 @@ except Exception as e:
         print("[SCADA] Failed to promote ied2:", ee)
 
 
+def udp_control(cmd, host="ied", port=10201, timeout=1.0):
+    """SBOw, then Oper, over the UDP MMS service, waiting for the command
+    termination as the association does
+    """
+    ctl_num = int(time.time() * 1000) % 256
+    value = {"ctlVal": cmd, "ctlNum": ctl_num}
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        for service in ("SBOw", "Oper"):
+            message = {"type": "mms_write", "ln": "XCBR1", "do": "Pos", "da": service, "value": value}
+            sock.sendto(json.dumps(message).encode(), (host, port))
+            try:
+                while True:
+                    resp = json.loads(sock.recv(4096))
+                    if resp.get("type") == "mms_write_resp" and resp.get("da") == service:
+                        break
+            except (socket.timeout, ValueError):
+                return {"ok": False, "phase": service, "addCause": "No-response"}
+            if not resp["ok"]:
+                return {"ok": False, "phase": service, "addCause": resp["addCause"]}
+        sock.settimeout(3 * timeout)
+        try:
+            while True:
+                term = json.loads(sock.recv(4096))
+                if term.get("type") == "mms_cmd_term" and term.get("ctlNum") == ctl_num:
+                    return {"ok": term["ok"], "phase": "CmdTerm", "addCause": term["addCause"]}
+        except (socket.timeout, ValueError):
+            return {"ok": False, "phase": "CmdTerm", "addCause": "No-command-termination"}
+
+
 @app.route('/mms/control', methods=['POST'])
 def mms_control():
     cmd = request.json.get("ctlVal")
     if cmd not in ["TRIP", "RESET"]:
         return jsonify({"error": "Invalid ctlVal"}), 400
 
-    message = {
-        "type": "mms_write",
-        "ln": "XCBR1",
-        "do": "Pos",
-        "da": "ctlVal",
-        "value": cmd
-    }
+    # Select-before-operate: SBOw, Oper, then the command termination
+    _, assoc = mms_active()
+    if assoc:
+        result = assoc.control("XCBR1.Pos", cmd)
+        if result["ok"]:
+            return jsonify({"result": "done", "ctlVal": cmd, "via": assoc.name, "ms": result["ms"]})
+        if result["addCause"] != "No-response":
+            return jsonify({"error": result["addCause"], "phase": result["phase"], "via": assoc.name}), 409
 
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(json.dumps(message).encode(), ("ied", 10201))
-        return jsonify({"result": "sent", "ctlVal": cmd})
+        result = udp_control(cmd)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    if result["ok"]:
+        return jsonify({"result": "done", "ctlVal": cmd})
+    return jsonify({"error": result["addCause"], "phase": result["phase"]}), 409
 
 
 @app.route('/system-log1')
@@ -195,6 +258,12 @@ def send_command():
 def poll_ied():
     global latest_status, active_ied
     while True:
+        url, assoc = mms_active()
+        if assoc:
+            # latest_status is kept by the status reports
+            active_ied = url
+            time.sleep(1)
+            continue
         try:
             r = requests.get(f"{ied1}/breaker-status", timeout=1)
             active_ied = ied1
@@ -209,21 +278,17 @@ def poll_ied():
                 latest_status = "DISCONNECTED"
         time.sleep(1)
 
+def load_latest(filepath):
+    try:
+        return mms_readers[filepath].latest()
+    except Exception as e:
+        print(f"[SCADA] Failed to load {filepath}: {e}")
+    return None
+
 @app.route('/mms/status')
 def get_mms_from_file():
     global lastmms, last_timestamp
 
-    def load_latest(filepath):
-        try:
-            if os.path.exists(filepath):
-                with open(filepath, "r") as f:
-                    content = json.load(f)
-                    if isinstance(content, list) and content:
-                        return content[-1]
-        except Exception as e:
-            print(f"[SCADA] Failed to load {filepath}: {e}")
-        return None
-
     def is_alive(url):
         try:
             r = requests.get(f"{url}/breaker-status", timeout=0.5)
@@ -270,17 +335,6 @@ def poll_sv_status():
     def generate():
         global lastmms, last_timestamp
 
-        def load_latest(filepath):
-            try:
-                if os.path.exists(filepath):
-                    with open(filepath, "r") as f:
-                        content = json.load(f)
-                        if isinstance(content, list) and content:
-                            return content[-1]
-            except Exception as e:
-                print(f"[SCADA] Failed to load {filepath}: {e}")
-            return None
-
         def is_alive(url):
             try:
                 r = requests.get(f"{url}/breaker-status", timeout=0.5)
@@ -296,18 +350,18 @@ def poll_sv_status():
                 if not ied1_up and os.path.exists(ied1_mmsfile):
                     try:
                         os.remove(ied1_mmsfile)
-                        print("[SCADA] Deleted mms_ied1.json — ied1 unreachable")
-                        append_to_system_log("Deleted mms_ied1.json — ied1 unreachable", "SCADA")
+                        print("[SCADA] Deleted mms_IED1.ring — ied1 unreachable")
+                        append_to_system_log("Deleted mms_IED1.ring — ied1 unreachable", "SCADA")
                     except Exception as e:
-                        print(f"[SCADA] Failed to delete mms_ied1.json: {e}")
+                        print(f"[SCADA] Failed to delete mms_IED1.ring: {e}")
 
                 if not ied2_up and os.path.exists(ied2_mmsfile):
                     try:
                         os.remove(ied2_mmsfile)
-                        print("[SCADA] Deleted mms_ied2.json — ied2 unreachable")
-                        append_to_system_log("Deleted mms_ied2.json — ied2 unreachable", "SCADA")
+                        print("[SCADA] Deleted mms_IED2.ring — ied2 unreachable")
+                        append_to_system_log("Deleted mms_IED2.ring — ied2 unreachable", "SCADA")
                     except Exception as e:
-                        print(f"[SCADA] Failed to delete mms_ied2.json: {e}")
+                        print(f"[SCADA] Failed to delete mms_IED2.ring: {e}")
 
                 active_file = None
                 if ied1_up:
@@ -378,6 +432,9 @@ def get_breaker_status():
 
 @app.route('/fault-status')
 def fault_status():
+    _, assoc = mms_active()
+    if assoc:
+        return jsonify({"fault": bool(assoc.values.get("LLN0.fault"))})
     try:
         for url in ["http://ied:5003/fault-status", "http://ied2:5003/fault-status"]:
             try:
@@ -429,6 +486,16 @@ def monitor_ied_health():
         first_check = False
         time.sleep(2)
 
+@app.route('/mms/associations')
+def get_mms_associations():
+    return jsonify({assoc.name: assoc.counters() for assoc in mms_assocs.values()})
+
+@app.route('/energy')
+def get_energy():
+    """MMTR1 energy registers of each IED, as last reported over MMS"""
+    return jsonify({assoc.name: {ref: v for ref, v in assoc.values.items() if ref.startswith("MMTR1.")}
+                    for assoc in mms_assocs.values()})
+
 @app.route('/active-ied')
 def get_active_ied():
     return jsonify({"active": active_ied})
@@ -437,8 +504,15 @@ def poll_sv_status():
     global sv_status, active_ied, last_sv_quality
     while True:
         try:
-            r = requests.get(f"{active_ied}/sv-status", timeout=3)
-            data = r.json()
+            _, assoc = mms_active()
+            if assoc:
+                # From the reports; the measurement reports stop with the SV
+                data = {"status": assoc.values.get("LLN0.sv.quality", "UNKNOWN"),
+                        "rateHz": assoc.values.get("LLN0.sv.rate_hz", 0),
+                        "last_sample": time.time() - assoc.age()}
+            else:
+                r = requests.get(f"{active_ied}/sv-status", timeout=3)
+                data = r.json()
             current_quality = data.get("status", "UNKNOWN")
             rate = data.get("rateHz", 0)
             last_sample = data.get("last_sample", 0)
@@ -579,6 +653,8 @@ def set_breaker_fault_mode():
         return jsonify({"error": str(e)}), 500
 
 def start_threads():
+    for assoc in mms_assocs.values():
+        threading.Thread(target=assoc.run, daemon=True).start()
     threading.Thread(target=poll_ied, daemon=True).start()
     threading.Thread(target=poll_sv_status, daemon=True).start()
     threading.Thread(target=monitor_protection_ieds, daemon=True).start()
@@ -0,0 +1,75 @@
+"""
+Breaker control (ied1/control.py, copied in ied2)
+
+Author: Zein Ali
+Date: 19/08/2025
+
+Run from the repository root with python -m pytest tests
+"""
+import pathlib
+import re
+import sys
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "ied1"))
+
+from control import ControlObject, Interlocks, is_protection  # noqa: E402
+from datamodel import DataModel  # noqa: E402
+
+RULES = {
+    "EnaOpn": "True",
+    "EnaCls": 'XCBR1.Pos.stVal == "OPEN" and not LLN0.fault and LLN0.sv.quality == "GOOD"'
+}
+
+
+def make_control():
+    model = DataModel("IED1", {
+        "LLN0": {"mode": "active", "fault": False, "sv": {"quality": "GOOD"}},
+        "XCBR1": {"Pos": {"stVal": "CLOSED", "ctlVal": "UNKNOWN", "stSeld": False}},
+        "CILO1": {name: {"stVal": None} for name in RULES}
+    })
+    interlocks = Interlocks(model, RULES)
+    executed = []
+    control = ControlObject(model, "XCBR1.Pos", interlocks, lambda ctl_val, origin: executed.append(ctl_val))
+    interlocks.refresh()
+    return control, executed
+
+
+def p_ied_roles():
+    """DEVICE_NAME of each P-IED in docker-compose.yml, the role its trips carry"""
+    compose = (ROOT / "docker-compose.yml").read_text()
+    return re.findall(r"DEVICE_NAME=(P-IED\w*)", compose)
+
+
+def test_p_ied_roles_are_protection():
+    roles = p_ied_roles()
+    assert roles
+    for role in roles:
+        assert is_protection(role, ("P-IED",))
+    assert not is_protection("C-IED1", ("P-IED",))
+    assert not is_protection(None, ("P-IED",))
+
+
+def test_protection_trip_overrides_held_select():
+    control, executed = make_control()
+    assert control.request("select", "scada", "RESET", 1) == (False, "Position-reached")
+    assert control.request("select", "scada", "TRIP", 1) == (True, None)
+    # An ordinary direct operate is locked out by the selection
+    assert control.request("direct", "goose:C-IED2", "TRIP", 7) == (False, "Locked-by-other-client")
+
+    role = p_ied_roles()[0]
+    assert control.request("direct", f"goose:{role}", "TRIP", 8,
+                           protection=is_protection(role, ("P-IED",))) == (True, None)
+    assert executed == ["TRIP"]
+    assert control.selected is None
+
+
+def test_protection_trip_aborts_command_in_execution():
+    control, executed = make_control()
+    terms = []
+    assert control.request("select", "rtu", "TRIP", 3) == (True, None)
+    assert control.request("operate", "rtu", "TRIP", 3, reply=terms.append) == (True, None)
+    assert control.request("direct", "goose:P-IED1", "TRIP", 9,
+                           protection=is_protection("P-IED1", ("P-IED",))) == (True, None)
+    assert executed == ["TRIP", "TRIP"]
+    assert [t.get("addCause") for t in terms] == ["Abortion-by-trip"]
@@ -0,0 +1,44 @@
+"""
+Energy metering accuracy (ied1/energy.py, copied in ied2)
+
+Author: Zein Ali
+Date: 18/08/2025
+
+Run from the repository root with python -m pytest tests
+"""
+import importlib.util
+import pathlib
+
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+spec = importlib.util.spec_from_file_location("energy", ROOT / "ied1" / "energy.py")
+energy = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(energy)
+
+# Net energy error allowed, in percent. Blocks that are not whole cycles
+# are compared pro rata, and the first quarter cycle has no Q, so a short
+# run is off by a few hundredths of a percent
+TOLERANCE_PCT = 0.1
+
+
+def test_copies_identical():
+    assert (ROOT / "ied1" / "energy.py").read_bytes() == (ROOT / "ied2" / "energy.py").read_bytes()
+
+
+@pytest.mark.parametrize("case", list(energy.CASES))
+@pytest.mark.parametrize("spc, frame", [(80, 1), (256, 8)])
+@pytest.mark.parametrize("hz", [50.0, 49.5])
+def test_net_energy(case, spc, frame, hz):
+    # Single samples, part cycles, a cycle and a half, and whole cycles
+    blocks = (1, frame * 4 + 1, spc // 4, spc, spc * 3 // 2, spc * 10)
+    for row in energy.benchmark(case, spc=spc, seconds=5, frame=frame, hz=hz, blocks=blocks):
+        assert abs(row["pErrPct"]) < TOLERANCE_PCT, row
+        assert abs(row["qErrPct"]) < TOLERANCE_PCT, row
+
+
+@pytest.mark.parametrize("case", list(energy.CASES))
+def test_whole_cycles_keep_a_load_out_of_supply(case):
+    for row in energy.benchmark(case, seconds=5, blocks=(80, 800)):
+        assert row["supPct"] == 0, row
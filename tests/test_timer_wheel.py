@@ -0,0 +1,72 @@
+"""
+Hashed timer wheel (ied1/timer_wheel.py, copied in ied2 and p_ied)
+
+Author: Zein Ali
+Date: 19/08/2025
+
+Run from the repository root with python -m pytest tests
+"""
+import importlib.util
+import pathlib
+import random
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+spec = importlib.util.spec_from_file_location("timer_wheel", ROOT / "ied1" / "timer_wheel.py")
+timer_wheel = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(timer_wheel)
+
+
+def test_copies_identical():
+    source = (ROOT / "ied1" / "timer_wheel.py").read_bytes()
+    for copy in ("ied2", "p_ied"):
+        assert (ROOT / copy / "timer_wheel.py").read_bytes() == source
+
+
+def test_timers_fire_on_their_tick():
+    """Timers within and beyond one turn, a third of them cancelled, and a
+    periodic one, with the hand driven tick by tick and in jumps
+    """
+    rng = random.Random(7)
+    wheel = timer_wheel.TimerWheel(slots=64)
+    timers = []
+    for k in range(2000):
+        timer = timer_wheel.Timer(None, str(k), None, (), None)
+        wheel.put(timer, rng.randint(1, 64 * 5))
+        timers.append(timer)
+    for timer in rng.sample(timers, 700):
+        wheel.cancel(timer)
+    beat = timer_wheel.Timer(None, "beat", None, (), 10 * wheel.tick)
+    wheel.put(beat, 10)
+
+    fired = {}
+    beats = []
+    tick = 0
+    while tick < 64 * 6:
+        live = [t.due for t in timers if t.active] + [beat.due]
+        # next_due is never later than the earliest timer
+        assert wheel.next_due is not None and wheel.next_due <= min(live)
+        tick += rng.choice((1, 1, 3, 17, 70))
+        for timer in wheel.expired(wheel.start + (tick + 0.5) * wheel.tick):
+            if timer is beat:
+                # Already back on the wheel for its next beat
+                assert timer.due > tick
+                beats.append(tick)
+            elif not timer.cancelled:
+                assert timer.due <= tick
+                assert timer.name not in fired
+                fired[timer.name] = (timer.due, tick)
+
+    assert len(fired) == 1300
+    # Fired at the first call that reached its tick, never before
+    for due, at in fired.values():
+        assert due <= at < due + 70
+    assert len(beats) >= 64 * 6 // 70
+    assert wheel.pending == 1
+
+
+def test_idle_wheel_has_no_timeout():
+    wheel = timer_wheel.TimerWheel()
+    timer = wheel.call_later(0.01, "once", None)
+    wheel.cancel(timer)
+    assert wheel.timeout(wheel.start) is None